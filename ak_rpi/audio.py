@@ -1,62 +1,480 @@
 """Audio player."""
 
 import logging
+import threading
 import time
+from collections.abc import Callable
 from pathlib import Path
+from typing import Any, cast
 
 import pygame
-from pydantic import BaseModel
-from pydub.utils import mediainfo
+from pydantic import BaseModel, Field, PrivateAttr
+
+from ak_rpi.ntp import NTP
+from ak_rpi.pcm_cache import PCMCache
+from ak_rpi.probe import probe
+from ak_rpi.scheduler import Scheduler
+from ak_rpi.timebase import monotonic_ms
 
 logger = logging.getLogger(__name__)
 
+MIXER_BUFFER_FRAMES = 512
+
+
+def init_mixer():
+    """Initialize the mixer if needed.
+
+    Returns:
+        format (tuple[int, int, int]): The frequency, signed sample size in bits, and channel count.
+    """
+    if not pygame.mixer.get_init():
+        pygame.mixer.init(buffer=MIXER_BUFFER_FRAMES)
+    return pygame.mixer.get_init()
+
+
+def silence(duration_ms: float):
+    """Create a silent sound in the mixer's format.
+
+    Args:
+        duration_ms (float): The duration of the silence in ms; rounded to the nearest sample.
+
+    Returns:
+        sound (pygame.mixer.Sound): The silent sound.
+    """
+    frequency, size, channels = init_mixer()
+    n_frames = round(duration_ms * frequency / 1000)
+    sample_bytes = abs(size) // 8
+    # unsigned formats are centered on half their range rather than zero
+    sample = (
+        bytes(sample_bytes)
+        if size < 0 or size == 32
+        else (1 << (abs(size) - 1)).to_bytes(sample_bytes, "little")
+    )
+    return pygame.mixer.Sound(buffer=sample * (n_frames * channels))
+
+
+class LoopStats(BaseModel):
+    """Statistics about gapless loop boundaries."""
+
+    n_boundaries: int = 0
+    gaps: int = Field(
+        default=0, description="Boundaries at which the mixer had run out of audio."
+    )
+    total_lag_ms: float = 0
+    max_lag_ms: float = Field(
+        default=0,
+        description="The largest delay between a boundary and observing the mixer switch over in ms.",
+    )
+    last_boundary_time: float | None = Field(
+        default=None, description="The monotonic time of the last boundary in ms."
+    )
+    buffer_ms: float = Field(
+        default=0, description="The duration of one mixer buffer in ms."
+    )
+
+    @property
+    def mean_lag_ms(self):
+        """Get the mean delay between a boundary and observing the switch over in ms."""
+        return self.total_lag_ms / self.n_boundaries if self.n_boundaries else 0.0
+
 
 class AudioPlayer(BaseModel, arbitrary_types_allowed=True):
     """A class for playing audio."""
 
     channel: pygame.mixer.Channel
-    sound: pygame.mixer.Sound
+    sound: pygame.mixer.Sound | None = Field(
+        default=None, description="The decoded sound; None for players which stream it."
+    )
     duration: int
     audio_file: Path
-    start_time: int = 0
+    start_time: float = Field(
+        default=0,
+        description="The monotonic time at which the current iteration started in ms.",
+    )
+    load_ms: float = Field(default=0, description="How long loading took in ms.")
+    cache_hit: bool | None = Field(
+        default=None, description="Whether the decoded PCM was already cached."
+    )
+    max_gapless_error_ms: float = Field(
+        default=5,
+        ge=0,
+        description="How far a queued iteration may be from its target before it is restarted instead in ms.",
+    )
+    join_chunk_ms: float = Field(
+        default=5000,
+        gt=0,
+        description="How much of the sound to hand to the mixer at a time when starting part-way through in ms.",
+    )
+    gain: float = Field(
+        default=1.0,
+        ge=0,
+        le=1,
+        description="The output gain, carried over whenever playback moves to another channel.",
+    )
+    loop_stats: LoopStats = Field(default_factory=LoopStats)
+    _boundary: float = PrivateAttr(default=0)
+    _offset_ms: float = PrivateAttr(default=0)
+    _looping: bool = PrivateAttr(default=False)
+    _joiner: threading.Thread | None = PrivateAttr(default=None)
+    _stop_joining: threading.Event = PrivateAttr(default_factory=threading.Event)
 
     @classmethod
-    def Load(cls, audio_file: str):
+    def Load(cls, audio_file: str, cache: PCMCache | None = None):
         """Load an audio file.
 
+        The decoded PCM is read from (or written to) the PCM cache through a memory map,
+        so a warm load skips decoding. The mixer copies it into its own buffer, and the
+        map is closed straight after, so only the mixer's copy stays resident.
+
+        Args:
+            audio_file (str): The path of the audio file.
+            cache (PCMCache | None): The PCM cache; the default cache in `media/` is used if not provided.
+
         Returns:
             player (AudioPlayer): The audio player
         """
         logger.info(f"Playing {audio_file}")
-        # initialize the mixer
-        if not pygame.mixer.get_init():
-            pygame.mixer.init()
-        sound = pygame.mixer.Sound(audio_file)
-        duration = int(float(mediainfo(audio_file)["duration"]) * 1000)
+        started = time.perf_counter()
+        init_mixer()
+        cache = cache or PCMCache()
+        pcm, hit = cache.open(audio_file)
+        try:
+            sound = pygame.mixer.Sound(buffer=pcm)
+        finally:
+            pcm.close()
+        duration = int(probe(audio_file).duration_ms)
         channel = pygame.mixer.find_channel()
         if channel is None:
             msg = "No available channels."
             logger.error(msg)
             raise ValueError(msg)
-        return cls(
-            channel=channel, sound=sound, duration=duration, audio_file=Path(audio_file)
+        load_ms = (time.perf_counter() - started) * 1000
+        logger.info(
+            f"Loaded {audio_file} in {load_ms:.0f}ms ({'warm' if hit else 'cold'} cache)."
+        )
+        player = cls(
+            channel=channel,
+            sound=sound,
+            duration=duration,
+            audio_file=Path(audio_file),
+            load_ms=load_ms,
+            cache_hit=hit,
         )
+        return player
+
+    @property
+    def loaded_sound(self):
+        """Get the decoded sound.
+
+        Returns:
+            sound (pygame.mixer.Sound): The sound.
+        """
+        if self.sound is None:
+            msg = "No sound is loaded."
+            raise ValueError(msg)
+        return self.sound
+
+    @property
+    def pcm(self):
+        """Get the raw PCM of the sound in the mixer's format.
+
+        Returns:
+            pcm (memoryview): A view of the mixer's own buffer; nothing is copied.
+        """
+        # pygame's stubs leave out that a Sound exposes its buffer
+        return memoryview(cast(bytes, self.loaded_sound)).cast("B")
+
+    @property
+    def sound_ms(self):
+        """Get the exact length of the decoded sound in ms."""
+        return self.loaded_sound.get_length() * 1000
 
     def play(self):
         """Play the audio file."""
-        self.channel.play(self.sound)
-        self.start_time = int(time.perf_counter() * 1000)
+        self._stop_joiner()
+        self.channel.play(self.loaded_sound)
+        self._boundary = monotonic_ms()
+        self._offset_ms = 0
+        self.start_time = self._boundary
+
+    def sound_from(self, offset_ms: float, duration_ms: float | None = None):
+        """Get part of the sound, starting at an offset.
+
+        The mixer copies the part into a new sound, so long parts are best taken a chunk
+        at a time (see `join_chunk_ms`).
+
+        Args:
+            offset_ms (float): The offset into the sound in ms; rounded to the nearest sample.
+            duration_ms (float | None): The length of the part in ms; the rest of the sound if not provided.
+
+        Returns:
+            sound (pygame.mixer.Sound): The part of the sound.
+        """
+        frequency, size, channels = init_mixer()
+        frame_bytes = abs(size) // 8 * channels
+        start = round(offset_ms * frequency / 1000) * frame_bytes
+        if duration_ms is None:
+            return pygame.mixer.Sound(buffer=self.pcm[start:])
+        end = round((offset_ms + duration_ms) * frequency / 1000) * frame_bytes
+        return pygame.mixer.Sound(buffer=self.pcm[start:end])
+
+    def join_chunk_end(self, offset_ms: float):
+        """Get where the chunk of the sound starting at an offset ends.
+
+        Args:
+            offset_ms (float): The offset of the chunk into the sound in ms.
+
+        Returns:
+            end_ms (float): The end of the chunk in ms; a short last chunk is merged into the one before it.
+        """
+        sound_ms = self.sound_ms
+        end_ms = offset_ms + self.join_chunk_ms
+        return sound_ms if sound_ms - end_ms < self.join_chunk_ms / 2 else end_ms
+
+    def play_at(self, start_time: float, offset_ms: float = 0):
+        """Start the audio at a monotonic time with sample accuracy.
+
+        Plays a pre-roll buffer of silence sized so that it ends exactly at `start_time`
+        and queues the sound behind it, so the mixer switches over on the exact sample
+        regardless of when this method was called. The sound and channel are prepared
+        first and the clock is read just before the pre-roll is handed to the mixer, so
+        the preparation does not delay the start. Should be called shortly (tens of ms)
+        before `start_time`; if it is already late the audio starts immediately, skipping
+        ahead to stay on schedule when joining mid-way.
+        If the current channel is still playing (e.g. the tail of the previous loop), the
+        pre-roll runs on a spare channel so the tail is not cut off.
+        When starting part-way, the rest of the sound is handed to the mixer
+        `join_chunk_ms` at a time from a background thread, so it is never copied whole.
+
+        Args:
+            start_time (float): The monotonic time at which to start, in ms (see `ak_rpi.timebase.monotonic_ms`).
+            offset_ms (float): Where in the sound to start in ms, e.g. to join a loop mid-way.
+        """
+        self._stop_joiner()
+        lead_ms = start_time - monotonic_ms()
+        if lead_ms <= 0:
+            logger.warning(f"Scheduled start is {-lead_ms:.1f}ms late.")
+            if offset_ms <= 0:
+                self.play()
+                return
+            now = monotonic_ms()
+            offset_ms += now - start_time
+            start_time = now
+            self.channel.play(
+                self.sound_from(offset_ms, self._first_chunk_ms(offset_ms))
+            )
+        else:
+            sound = (
+                self.loaded_sound
+                if offset_ms <= 0
+                else self.sound_from(offset_ms, self._first_chunk_ms(offset_ms))
+            )
+            channel = self.channel
+            if channel.get_busy():
+                spare = pygame.mixer.find_channel()
+                if spare is None:
+                    channel.stop()
+                else:
+                    channel = spare
+            self.use_channel(channel)
+            preroll = silence(start_time - monotonic_ms())
+            # the mixer crashes on an empty sound, so a start due now is just queued
+            if preroll.get_length() > 0:
+                channel.play(preroll)
+            channel.queue(sound)
+        self._boundary = start_time
+        self._offset_ms = max(offset_ms, 0)
+        self.start_time = start_time - self._offset_ms
+        if offset_ms > 0 and self.join_chunk_end(offset_ms) < self.sound_ms:
+            self._stop_joining.clear()
+            self._joiner = threading.Thread(
+                target=self._join,
+                args=(self.channel, start_time, offset_ms),
+                name="audio-join",
+                daemon=True,
+            )
+            self._joiner.start()
+
+    def _first_chunk_ms(self, offset_ms: float):
+        return self.join_chunk_end(offset_ms) - offset_ms
+
+    def _join(self, channel: pygame.mixer.Channel, start_time: float, offset_ms: float):
+        # the mixer holds one queued sound, so each chunk is queued once the one before
+        # it is playing, halfway through it
+        chunk_start, chunk_end = offset_ms, self.join_chunk_end(offset_ms)
+        while chunk_end < self.sound_ms:
+            midway = start_time + (chunk_start + chunk_end) / 2 - offset_ms
+            if self._stop_joining.wait(max(midway - monotonic_ms(), 0) / 1000):
+                return
+            next_end = self.join_chunk_end(chunk_end)
+            channel.queue(self.sound_from(chunk_end, next_end - chunk_end))
+            chunk_start, chunk_end = chunk_end, next_end
+
+    def _stop_joiner(self):
+        self._stop_joining.set()
+        if self._joiner is not None and self._joiner is not threading.current_thread():
+            self._joiner.join()
+        self._joiner = None
+
+    @property
+    def boundary_time(self):
+        """Get the monotonic time at which the current or queued iteration starts, to the sample, in ms.
+
+        When joining mid-way this is when the iteration would have started.
+        """
+        return self._boundary - self._offset_ms
+
+    @property
+    def next_boundary_time(self):
+        """Get the monotonic time at which the current iteration ends, to the sample, in ms."""
+        return self.boundary_time + self.sound_ms
+
+    def can_queue_at(self, start_time: float):
+        """Whether the next iteration can be queued gaplessly to start at a monotonic time.
+
+        Args:
+            start_time (float): The target start time in ms.
+
+        Returns:
+            can_queue (bool): True if the current iteration is playing, nothing is queued, and it ends within `max_gapless_error_ms` of the target.
+        """
+        return (
+            self.channel.get_busy()
+            and self.channel.get_queue() is None
+            and abs(self.next_boundary_time - start_time) <= self.max_gapless_error_ms
+        )
+
+    def queue_next(self):
+        """Queue the next iteration directly behind the current one.
+
+        The mixer switches over within its audio callback, so there is no gap at the
+        boundary. `start_time` moves to the boundary straight away.
+
+        Returns:
+            boundary (float): The monotonic time at which the next iteration starts in ms.
+        """
+        boundary = self.next_boundary_time
+        self.channel.queue(self.loaded_sound)
+        self._boundary = boundary
+        self._offset_ms = 0
+        self.start_time = boundary
+        return boundary
+
+    def observe_boundary(self):
+        """Check whether the mixer has switched to the iteration starting at the last boundary.
+
+        Once it has, the delay since the boundary and whether the mixer had run dry are
+        recorded in `loop_stats`.
+
+        Returns:
+            observed (bool): True once the switch has happened.
+        """
+        if self.channel.get_queue() is not None:
+            return False
+        now = monotonic_ms()
+        frequency, _, _ = init_mixer()
+        stats = self.loop_stats
+        lag = max(now - self._boundary, 0)
+        stats.n_boundaries += 1
+        stats.total_lag_ms += lag
+        stats.max_lag_ms = max(stats.max_lag_ms, lag)
+        stats.last_boundary_time = self._boundary
+        stats.buffer_ms = MIXER_BUFFER_FRAMES * 1000 / frequency
+        if not self.channel.get_busy():
+            stats.gaps += 1
+            logger.warning("The mixer ran out of audio at a loop boundary.")
+        return True
+
+    def watch_boundary(
+        self,
+        scheduler: Scheduler,
+        on_boundary: Callable[[], Any] | None = None,
+        poll_ms: float = 0.5,
+    ):
+        """Observe the next boundary on a scheduler.
+
+        Args:
+            scheduler (Scheduler): The scheduler to poll on.
+            on_boundary (Callable | None): Called once the mixer has switched over.
+            poll_ms (float): How often to re-check after the boundary in ms.
+        """
+
+        def check():
+            if not self.observe_boundary():
+                scheduler.call_later(poll_ms, check)
+            elif on_boundary is not None:
+                on_boundary()
+
+        scheduler.call_at(self._boundary, check)
+
+    def loop(self, scheduler: Scheduler):
+        """Play the audio in a gapless loop, always keeping the next iteration queued.
+
+        Args:
+            scheduler (Scheduler): The scheduler used to re-queue at each boundary.
+        """
+
+        def requeue():
+            if not self._looping:
+                return
+            self.queue_next()
+            self.watch_boundary(scheduler, on_boundary=requeue)
+
+        self._looping = True
+        self.play()
+        requeue()
+
+    def stop_looping(self):
+        """Stop re-queueing started by `loop`; the iteration already queued still plays."""
+        self._looping = False
+
+    def play_at_server_time(self, server_time: int, ntp: NTP):
+        """Start the audio at a server time.
+
+        Args:
+            server_time (int): The server time at which to start in ms.
+            ntp (NTP): The synced clock used to convert to local time.
+        """
+        self.play_at(ntp.monotonic_from_server_time(server_time))
 
     @property
     def remaining_ms(self):
         """Get the remaining time in ms.
 
         Returns:
-            remaining_time (int): The remaining time in ms.
+            remaining_time (float): The remaining time in ms.
         """
-        return self.duration - int(time.perf_counter() * 1000 - self.start_time)
+        return self.end_time - monotonic_ms()
+
+    @property
+    def end_time(self):
+        """Get the monotonic time at which the current playthrough ends in ms.
+
+        Returns:
+            end_time (float): The end time in ms.
+        """
+        return self.start_time + self.sound_ms
 
     def stop(self):
         """Stop the audio."""
+        self._stop_joiner()
         self.channel.stop()
         self.start_time = 0
+
+    def set_gain(self, gain: float):
+        """Set the output gain, taking effect immediately, including on the playing sound.
+
+        Args:
+            gain (float): The gain, from 0 (silent) to 1 (full scale).
+        """
+        self.gain = min(max(gain, 0.0), 1.0)
+        self.channel.set_volume(self.gain)
+
+    def use_channel(self, channel: pygame.mixer.Channel):
+        """Play on another channel from now on, at the same gain.
+
+        Args:
+            channel (pygame.mixer.Channel): The channel.
+        """
+        channel.set_volume(self.gain)
+        self.channel = channel
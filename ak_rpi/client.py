@@ -1,11 +1,26 @@
 """Settings for the player."""
 
+import asyncio
+import importlib.util
 import json
 import logging
+import random
+import threading
+import time
+from collections.abc import Callable, Coroutine
+from concurrent.futures import Future
 from pathlib import Path
+from typing import Any, TypeVar
 
 import httpx
-from pydantic import BaseModel, HttpUrl, IPvAnyAddress, SecretStr
+from pydantic import (
+    BaseModel,
+    Field,
+    HttpUrl,
+    IPvAnyAddress,
+    PrivateAttr,
+    SecretStr,
+)
 
 from ak_rpi.errors import (
     CouldNotFindPlayerError,
@@ -13,6 +28,7 @@ from ak_rpi.errors import (
     NoRegistrationPossibleError,
     RegistrationError,
 )
+from ak_rpi.metrics import HTTP_FAILURES
 from ak_rpi.utils import (
     get_ip_addresses,
     get_mac_address,
@@ -24,6 +40,213 @@ REGISTRATION_PATH = Path("registered")
 
 logger = logging.getLogger(__name__)
 
+T = TypeVar("T")
+
+RETRY_STATUS_CODES = {429, 502, 503, 504}
+
+
+class ClientOptions(BaseModel):
+    """Timeouts, retries and pooling for the HTTP clients."""
+
+    timeout_s: float = Field(
+        default=5.0, gt=0, description="The timeout of a single attempt in seconds."
+    )
+    connect_timeout_s: float = Field(
+        default=3.0,
+        gt=0,
+        description="The timeout for establishing a connection in seconds.",
+    )
+    deadline_s: float = Field(
+        default=15.0,
+        gt=0,
+        description="The total time allowed for a call, including retries, in seconds.",
+    )
+    max_retries: int = Field(
+        default=3, ge=0, description="The number of retries after a failed attempt."
+    )
+    backoff_base_s: float = Field(
+        default=0.25, gt=0, description="The delay before the first retry in seconds."
+    )
+    backoff_max_s: float = Field(
+        default=4.0, gt=0, description="The longest delay between retries in seconds."
+    )
+    max_connections: int = Field(
+        default=4, gt=0, description="The size of the connection pool."
+    )
+    max_keepalive_connections: int = Field(
+        default=2, ge=0, description="The number of idle connections to keep alive."
+    )
+    keepalive_expiry_s: float = Field(
+        default=60.0, ge=0, description="How long to keep idle connections in seconds."
+    )
+    http2: bool = Field(
+        default=False, description="Whether to use HTTP/2 when `h2` is installed."
+    )
+
+    @property
+    def use_http2(self):
+        """Whether HTTP/2 is requested and available."""
+        if not self.http2:
+            return False
+        if importlib.util.find_spec("h2") is None:
+            logger.warning(
+                "HTTP/2 requested but `h2` is not installed; using HTTP/1.1."
+            )
+            return False
+        return True
+
+    def client_kwargs(self):
+        """Get the keyword arguments shared by the sync and async httpx clients.
+
+        Returns:
+            kwargs (dict[str, Any]): The keyword arguments.
+        """
+        return {
+            "timeout": httpx.Timeout(self.timeout_s, connect=self.connect_timeout_s),
+            "limits": httpx.Limits(
+                max_connections=self.max_connections,
+                max_keepalive_connections=self.max_keepalive_connections,
+                keepalive_expiry=self.keepalive_expiry_s,
+            ),
+            "http2": self.use_http2,
+        }
+
+    def backoff(self, attempt: int):
+        """Get the delay before a retry, with full jitter.
+
+        Args:
+            attempt (int): The number of attempts made so far.
+
+        Returns:
+            delay_s (float): The delay in seconds.
+        """
+        ceiling = min(self.backoff_base_s * 2 ** (attempt - 1), self.backoff_max_s)
+        return random.uniform(ceiling / 2, ceiling)  # noqa: S311
+
+    def should_retry(
+        self, response: httpx.Response | None, attempt: int, deadline: float
+    ):
+        """Whether to retry after an attempt.
+
+        Args:
+            response (httpx.Response | None): The response, or None if the attempt failed in transport.
+            attempt (int): The number of attempts made so far.
+            deadline (float): The monotonic deadline of the call in seconds.
+
+        Returns:
+            retry (bool): True if another attempt should be made.
+        """
+        if response is not None and response.status_code not in RETRY_STATUS_CODES:
+            return False
+        return attempt <= self.max_retries and time.monotonic() < deadline
+
+
+class RetryingCall(BaseModel):
+    """The attempts of one request, shared by the sync and async clients.
+
+    The clients make each attempt and sleep between them; this decides the timeout of
+    each attempt, whether to retry and how long to back off, and records failures.
+    """
+
+    method: str
+    url: str
+    options: ClientOptions
+    deadline: float = Field(
+        ..., description="The monotonic deadline of the call in seconds."
+    )
+    idempotent: bool = Field(
+        default=True,
+        description="Whether the request may be repeated; if not, only attempts which failed to connect are retried.",
+    )
+    attempt: int = Field(default=0, description="The number of attempts started.")
+
+    @classmethod
+    def Start(
+        cls,
+        method: str,
+        url: str,
+        options: ClientOptions,
+        retries: int | None = None,
+        deadline_s: float | None = None,
+        idempotent: bool = True,
+    ):
+        """Start a call.
+
+        Args:
+            method (str): The HTTP method.
+            url (str): The url.
+            options (ClientOptions): The client's options.
+            retries (int | None): Overrides `options.max_retries`.
+            deadline_s (float | None): Overrides `options.deadline_s`.
+            idempotent (bool): Whether the request may be repeated.
+
+        Returns:
+            call (RetryingCall): The call, before its first attempt.
+        """
+        if retries is not None:
+            options = options.model_copy(update={"max_retries": retries})
+        return cls(
+            method=method,
+            url=url,
+            options=options,
+            deadline=time.monotonic() + (deadline_s or options.deadline_s),
+            idempotent=idempotent,
+        )
+
+    def next_timeout(self):
+        """Start an attempt.
+
+        Returns:
+            timeout_s (float): The timeout of the attempt, which ends by the deadline, in seconds.
+        """
+        self.attempt += 1
+        remaining = self.deadline - time.monotonic()
+        return max(min(self.options.timeout_s, remaining), 0.001)
+
+    def failed(self, error: httpx.TransportError):
+        """Handle an attempt which failed in transport.
+
+        Args:
+            error (httpx.TransportError): The error.
+
+        Returns:
+            delay_s (float | None): How long to back off before retrying in seconds, or None to give up.
+        """
+        HTTP_FAILURES.labels("transport").inc()
+        # a request which never connected was never sent, so it is always safe to repeat
+        if not self.idempotent and not isinstance(
+            error, httpx.ConnectError | httpx.ConnectTimeout
+        ):
+            return None
+        if not self.options.should_retry(None, self.attempt, self.deadline):
+            return None
+        logger.warning(f"{self.method} {self.url} failed ({error!r}), retrying...")
+        return self._delay()
+
+    def responded(self, response: httpx.Response):
+        """Handle an attempt which got a response.
+
+        Args:
+            response (httpx.Response): The response.
+
+        Returns:
+            delay_s (float | None): How long to back off before retrying in seconds, or None to return the response.
+        """
+        if response.status_code >= 400:
+            HTTP_FAILURES.labels(str(response.status_code)).inc()
+        if not self.idempotent or not self.options.should_retry(
+            response, self.attempt, self.deadline
+        ):
+            return None
+        logger.warning(
+            f"{self.method} {self.url} returned {response.status_code}, retrying..."
+        )
+        return self._delay()
+
+    def _delay(self):
+        remaining = max(self.deadline - time.monotonic(), 0)
+        return min(self.options.backoff(self.attempt), remaining)
+
 
 class Client(BaseModel, arbitrary_types_allowed=True):
     """A client for the player."""
@@ -31,6 +254,85 @@ class Client(BaseModel, arbitrary_types_allowed=True):
     syncUrl: HttpUrl
     password: SecretStr
     client: httpx.Client
+    options: ClientOptions = Field(default_factory=ClientOptions)
+    _async_client: "AsyncClient | None" = PrivateAttr(default=None)
+    _runner: "AsyncRunner | None" = PrivateAttr(default=None)
+
+    def request(
+        self,
+        method: str,
+        url: str,
+        retries: int | None = None,
+        deadline_s: float | None = None,
+        idempotent: bool = True,
+        **kwargs: Any,
+    ):
+        """Make a request, retrying transport errors and overload responses with backoff.
+
+        Args:
+            method (str): The HTTP method.
+            url (str): The url, relative to `syncUrl`.
+            retries (int | None): Overrides `options.max_retries`.
+            deadline_s (float | None): Overrides `options.deadline_s`.
+            idempotent (bool): Whether the request may be repeated; if not, only attempts which failed to connect are retried.
+            **kwargs (Any): Passed to `httpx.Client.request`.
+
+        Returns:
+            response (httpx.Response): The last response.
+        """
+        call = RetryingCall.Start(
+            method, url, self.options, retries, deadline_s, idempotent
+        )
+        while True:
+            try:
+                response = self.client.request(
+                    method, url, timeout=call.next_timeout(), **kwargs
+                )
+            except httpx.TransportError as e:
+                delay_s = call.failed(e)
+                if delay_s is None:
+                    raise
+            else:
+                delay_s = call.responded(response)
+                if delay_s is None:
+                    return response
+            time.sleep(delay_s)
+
+    @property
+    def async_client(self):
+        """Get an async client with the same settings.
+
+        Returns:
+            client (AsyncClient): The async client.
+        """
+        if self._async_client is None:
+            self._async_client = AsyncClient(
+                syncUrl=self.syncUrl,
+                password=self.password,
+                client=httpx.AsyncClient(
+                    base_url=str(self.syncUrl),
+                    params={"password": self.password.get_secret_value()},
+                    **self.options.client_kwargs(),
+                ),
+                options=self.options,
+                sync_client=self,
+            )
+        return self._async_client
+
+    def in_background(
+        self, call: "Callable[[AsyncClient], Coroutine[Any, Any, T]]"
+    ) -> "Future[T]":
+        """Run a call on the async client on a background event loop.
+
+        Args:
+            call (Callable[[AsyncClient], Coroutine]): Makes the coroutine to run from the async client.
+
+        Returns:
+            future (Future): Resolves to the result of the call.
+        """
+        if self._runner is None:
+            self._runner = AsyncRunner()
+        return self._runner.submit(call(self.async_client))
 
     def register_new(
         self, ip_address: IPvAnyAddress | str, mac_address: str, serial_number: str
@@ -48,8 +350,11 @@ class Client(BaseModel, arbitrary_types_allowed=True):
         from ak_rpi.ntp import NTP
         from ak_rpi.player import PlayerSettings
 
-        response = self.client.post(
+        # a repeated registration could create a second player
+        response = self.request(
+            "POST",
             "/api/mediaplayer/serialnumber",
+            idempotent=False,
             json={
                 "ipAddress": ip_address,
                 "macAddress": mac_address,
@@ -83,7 +388,7 @@ class Client(BaseModel, arbitrary_types_allowed=True):
         from ak_rpi.ntp import NTP
         from ak_rpi.player import PlayerSettings
 
-        response = self.client.get(f"/api/mediaplayer/{player_id}")
+        response = self.request("GET", f"/api/mediaplayer/{player_id}")
         if response.status_code != 200:
             msg = f"{response.status_code}: {response.text}"
             logger.error(f"Failed to get player: {msg}")
@@ -93,29 +398,153 @@ class Client(BaseModel, arbitrary_types_allowed=True):
         return player
 
     def get_sync(self, req_sent_at: int):
-        """Get the current timestamp from the server."""
+        """Get the current timestamp from the server.
+
+        Not retried, since a retry would be measured against the original send time.
+        """
         url = "/api/sync"
-        response = self.client.get(url, params={"reqSentAt": req_sent_at})
+        response = self.request(
+            "GET", url, retries=0, params={"reqSentAt": req_sent_at}
+        )
         return response
 
     def put_duration(self, player_id: int, duration: int):
         """Update the duration of the player's work (in ms)."""
         url = f"/api/mediaplayer/{player_id}/duration"
-        response = self.client.put(url, json={"duration": duration})
+        response = self.request("PUT", url, json={"duration": duration})
         return response
 
     def put_lastTimestamp(self, player_id: int, lastTimestamp: int):
         """Update the lastTimestamp of the player's work (in ms)."""
         url = f"/api/mediaplayer/{player_id}/timestamp"
-        response = self.client.put(url, json={"lastTimestamp": lastTimestamp})
+        response = self.request("PUT", url, json={"lastTimestamp": lastTimestamp})
         return response
 
 
+class AsyncClient(BaseModel, arbitrary_types_allowed=True):
+    """An async client for the player with the same method surface as `Client`."""
+
+    syncUrl: HttpUrl
+    password: SecretStr
+    client: httpx.AsyncClient
+    options: ClientOptions = Field(default_factory=ClientOptions)
+    sync_client: Client = Field(
+        ..., description="The sync client that player settings are bound to."
+    )
+
+    async def request(
+        self,
+        method: str,
+        url: str,
+        retries: int | None = None,
+        deadline_s: float | None = None,
+        idempotent: bool = True,
+        **kwargs: Any,
+    ):
+        """Make a request, retrying transport errors and overload responses with backoff.
+
+        Args:
+            method (str): The HTTP method.
+            url (str): The url, relative to `syncUrl`.
+            retries (int | None): Overrides `options.max_retries`.
+            deadline_s (float | None): Overrides `options.deadline_s`.
+            idempotent (bool): Whether the request may be repeated; if not, only attempts which failed to connect are retried.
+            **kwargs (Any): Passed to `httpx.AsyncClient.request`.
+
+        Returns:
+            response (httpx.Response): The last response.
+        """
+        call = RetryingCall.Start(
+            method, url, self.options, retries, deadline_s, idempotent
+        )
+        while True:
+            try:
+                response = await self.client.request(
+                    method, url, timeout=call.next_timeout(), **kwargs
+                )
+            except httpx.TransportError as e:
+                delay_s = call.failed(e)
+                if delay_s is None:
+                    raise
+            else:
+                delay_s = call.responded(response)
+                if delay_s is None:
+                    return response
+            await asyncio.sleep(delay_s)
+
+    async def get_mediaplayer(self, player_id: int):
+        """Get the player settings from the server.
+
+        Args:
+            player_id (int): The id of the player.
+
+        Returns:
+            player (PlayerSettings): The player settings, bound to `sync_client`.
+        """
+        from ak_rpi.ntp import NTP
+        from ak_rpi.player import PlayerSettings
+
+        response = await self.request("GET", f"/api/mediaplayer/{player_id}")
+        if response.status_code != 200:
+            msg = f"{response.status_code}: {response.text}"
+            logger.error(f"Failed to get player: {msg}")
+            raise CouldNotFindPlayerError(msg)
+        data = response.json()
+        client = self.sync_client
+        return PlayerSettings(**data, client=client, ntp=NTP(client=client))
+
+    async def get_sync(self, req_sent_at: int):
+        """Get the current timestamp from the server.
+
+        Not retried, since a retry would be measured against the original send time.
+        """
+        url = "/api/sync"
+        return await self.request(
+            "GET", url, retries=0, params={"reqSentAt": req_sent_at}
+        )
+
+    async def put_duration(self, player_id: int, duration: int):
+        """Update the duration of the player's work (in ms)."""
+        url = f"/api/mediaplayer/{player_id}/duration"
+        return await self.request("PUT", url, json={"duration": duration})
+
+    async def put_lastTimestamp(self, player_id: int, lastTimestamp: int):
+        """Update the lastTimestamp of the player's work (in ms)."""
+        url = f"/api/mediaplayer/{player_id}/timestamp"
+        return await self.request("PUT", url, json={"lastTimestamp": lastTimestamp})
+
+
+class AsyncRunner(BaseModel):
+    """An asyncio event loop running on a daemon thread."""
+
+    _loop: asyncio.AbstractEventLoop = PrivateAttr(
+        default_factory=asyncio.new_event_loop
+    )
+    _thread: threading.Thread | None = PrivateAttr(default=None)
+
+    def submit(self, coro: "Coroutine[Any, Any, T]") -> "Future[T]":
+        """Schedule a coroutine on the loop from any thread.
+
+        Args:
+            coro (Coroutine): The coroutine.
+
+        Returns:
+            future (Future): Resolves to the result of the coroutine.
+        """
+        if self._thread is None:
+            self._thread = threading.Thread(
+                target=self._loop.run_forever, name="http-client", daemon=True
+            )
+            self._thread.start()
+        return asyncio.run_coroutine_threadsafe(coro, self._loop)
+
+
 class ClientBase(BaseModel, extra="ignore"):
     """Base settings for the client."""
 
     syncUrl: HttpUrl
     password: SecretStr
+    options: ClientOptions = Field(default_factory=ClientOptions)
 
     def create_client(self) -> Client:
         """Create a new httpx client and store it.
@@ -126,8 +555,14 @@ class ClientBase(BaseModel, extra="ignore"):
         client = httpx.Client(
             base_url=str(self.syncUrl),
             params={"password": self.password.get_secret_value()},
+            **self.options.client_kwargs(),
+        )
+        return Client(
+            syncUrl=self.syncUrl,
+            password=self.password,
+            client=client,
+            options=self.options,
         )
-        return Client(syncUrl=self.syncUrl, password=self.password, client=client)
 
 
 class RegistrationData(BaseModel, extra="ignore"):
@@ -137,12 +572,16 @@ class RegistrationData(BaseModel, extra="ignore"):
     password: str
 
     @classmethod
-    def FromConfig(cls):
+    def FromConfig(cls, prefer_snapshot: bool = True):
         """Create a player from the config file.
 
         If the player is not registered, it will be registered.
 
-        Otherwise, the player will be fetched from the server.
+        Otherwise, the player will be restored from its snapshot if there is one, so that
+        it can start playing without waiting for the server, or else fetched from the server.
+
+        Args:
+            prefer_snapshot (bool): Whether to restore from a snapshot rather than fetch from the server.
 
         Returns:
             player (PlayerSettings): The player.
@@ -162,14 +601,42 @@ class RegistrationData(BaseModel, extra="ignore"):
             )
             client_base = ClientBase(**data)
             client = client_base.create_client()
-            return cls.Register(client)
+            player = cls.Register(client)
         else:
             logger.info("Attempting to load player from registration cache...")
             with open(REGISTRATION_PATH) as f:
                 reg = RegistrationData(**json.load(f))
             client_base = ClientBase(**data)
             client = client_base.create_client()
-            return cls.FromId(reg.id, client)
+            player = cls.FromSnapshot(reg.id, client) if prefer_snapshot else None
+            if player is None:
+                player = cls.FromId(reg.id, client)
+        player.apply_local_config(data)
+        return player
+
+    @classmethod
+    def FromSnapshot(cls, player_id: int, client: Client):
+        """Restore a player from its snapshot.
+
+        Args:
+            player_id (int): The id of the player.
+            client (Client): The client.
+
+        Returns:
+            player (PlayerSettings | None): The player, or None if there is no usable snapshot.
+        """
+        from ak_rpi.snapshot import PlayerSnapshot
+
+        snapshot = PlayerSnapshot.Load()
+        if snapshot is None:
+            return None
+        if snapshot.player_id != player_id:
+            logger.warning("Ignoring snapshot of a different player.")
+            return None
+        if snapshot.settings.get("serialNumber") != get_serial_number():
+            logger.warning("Ignoring snapshot with a different serial number.")
+            return None
+        return snapshot.restore(client)
 
     @classmethod
     def FromId(cls, player_id: int, client: Client):
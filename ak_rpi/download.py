@@ -0,0 +1,312 @@
+"""Resumable, verified media downloads into the media directory."""
+
+import hashlib
+import logging
+import os
+import threading
+import time
+from collections.abc import Callable
+from pathlib import Path
+from typing import Any
+from urllib.parse import quote
+
+import httpx
+from pydantic import BaseModel, Field, PrivateAttr
+
+from ak_rpi.client import Client
+from ak_rpi.errors import ChecksumMismatchError, DownloadError
+from ak_rpi.media_index import MediaRoot
+
+logger = logging.getLogger(__name__)
+
+PART_SUFFIX = ".part"
+ETAG_SUFFIX = ".etag"
+HASH_HEADER = "X-Content-SHA256"
+
+
+class DownloadResult(BaseModel):
+    """The outcome of a download."""
+
+    path: Path = Field(..., description="The downloaded file.")
+    size: int = Field(..., description="The size in bytes.")
+    content_hash: str = Field(..., description="The hex sha256 digest.")
+    downloaded_bytes: int = Field(
+        ..., description="The bytes transferred, excluding any resumed prefix."
+    )
+    resumed_from: int = Field(
+        default=0, description="The offset the download resumed from in bytes."
+    )
+    elapsed_s: float = Field(..., description="The time taken in s.")
+    verified: bool = Field(
+        ..., description="Whether the contents were checked against an expected hash."
+    )
+
+
+class MediaDownloader(BaseModel, arbitrary_types_allowed=True):
+    """Downloads media from the sync server without ever exposing a partial file.
+
+    Bytes are written to a `.part` file next to the destination, which is ignored by the
+    media index, and hashed as they arrive. An interrupted download resumes with an HTTP
+    range request, guarded by `If-Range` so that a file which changed on the server is
+    restarted rather than spliced. Once complete, the size and hash are checked against
+    those expected, the file is synced and atomically renamed into place, and the decode
+    path is pre-warmed so the first load is a cache hit.
+    """
+
+    client: Client
+    root: Path = Field(default=MediaRoot, description="The media directory.")
+    url_template: str = Field(
+        default="/api/media/{path}",
+        description="The url of a media file relative to the sync server.",
+    )
+    chunk_size: int = Field(
+        default=256 * 1024, gt=0, description="The size of each read in bytes."
+    )
+    max_bytes_per_s: float | None = Field(
+        default=None,
+        gt=0,
+        description="The bandwidth limit in bytes per second, or None for no limit.",
+    )
+    prewarm: bool = Field(
+        default=True,
+        description="Whether to decode into the PCM cache after downloading.",
+    )
+    _lock: threading.Lock = PrivateAttr(default_factory=threading.Lock)
+    _active: set[str] = PrivateAttr(default_factory=set)
+
+    def fetch(self, media_path: str, expected_sha256: str | None = None):
+        """Download a media file, resuming any earlier partial download.
+
+        Args:
+            media_path (str): The path relative to the media directory.
+            expected_sha256 (str | None): The expected hex sha256 digest; the server's `X-Content-SHA256` header is used if not given.
+
+        Returns:
+            result (DownloadResult): The result.
+        """
+        dest = self.root / media_path
+        root = self.root.resolve()
+        resolved = dest.resolve()
+        if resolved == root or not resolved.is_relative_to(root):
+            msg = f"Refusing to download {media_path} outside {root}."
+            raise DownloadError(msg)
+        part = dest.with_name(dest.name + PART_SUFFIX)
+        etag_path = dest.with_name(dest.name + PART_SUFFIX + ETAG_SUFFIX)
+        dest.parent.mkdir(parents=True, exist_ok=True)
+        url = self.url_template.format(path=quote(media_path))
+        started = time.perf_counter()
+        options = self.client.options
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                result = self._fetch_once(url, part, etag_path, expected_sha256)
+                break
+            except httpx.TransportError as e:
+                if attempt > options.max_retries:
+                    msg = f"Failed to download {media_path}: {e!r}"
+                    raise DownloadError(msg) from e
+                delay_s = options.backoff(attempt)
+                logger.warning(
+                    f"Download of {media_path} interrupted ({e!r}), resuming in {delay_s:.1f}s."
+                )
+                time.sleep(delay_s)
+        size, content_hash, downloaded, resumed_from, verified = result
+        with open(part, "rb+") as f:
+            os.fsync(f.fileno())
+        os.replace(part, dest)
+        etag_path.unlink(missing_ok=True)
+        elapsed_s = time.perf_counter() - started
+        logger.info(
+            f"Downloaded {media_path} ({size / 1e6:.1f}MB, {downloaded / 1e6:.1f}MB "
+            f"transferred) in {elapsed_s:.1f}s."
+        )
+        if self.prewarm:
+            self.prewarm_decode(dest)
+        return DownloadResult(
+            path=dest,
+            size=size,
+            content_hash=content_hash,
+            downloaded_bytes=downloaded,
+            resumed_from=resumed_from,
+            elapsed_s=elapsed_s,
+            verified=verified,
+        )
+
+    def _fetch_once(
+        self, url: str, part: Path, etag_path: Path, expected_sha256: str | None
+    ):
+        digest = hashlib.sha256()
+        offset = part.stat().st_size if part.exists() else 0
+        headers = {}
+        if offset > 0:
+            # hash what we already have so the digest covers the whole file
+            with open(part, "rb") as f:
+                while chunk := f.read(self.chunk_size):
+                    digest.update(chunk)
+            headers["Range"] = f"bytes={offset}-"
+            if etag_path.exists():
+                headers["If-Range"] = etag_path.read_text()
+        with self.client.client.stream("GET", url, headers=headers) as response:
+            if response.status_code == 416 and offset > 0:
+                # the part file already holds everything the server has
+                total = _content_range_total(response.headers.get("Content-Range"))
+                if total != offset:
+                    part.unlink()
+                    msg = f"Partial download of {url} does not match the server."
+                    raise DownloadError(msg)
+                return self._verify(
+                    part, offset, digest, 0, offset, expected_sha256, response
+                )
+            return self._receive(
+                response, url, part, etag_path, offset, digest, expected_sha256
+            )
+
+    def _receive(
+        self,
+        response: httpx.Response,
+        url: str,
+        part: Path,
+        etag_path: Path,
+        offset: int,
+        digest: "hashlib._Hash",
+        expected_sha256: str | None,
+    ):
+        if response.status_code not in (200, 206):
+            response.read()
+            msg = f"{response.status_code}: {response.text}"
+            raise DownloadError(msg)
+        resumed_from = offset if response.status_code == 206 else 0
+        if resumed_from == 0 and offset > 0:
+            logger.info(f"Server did not resume {url}, restarting.")
+            digest = hashlib.sha256()
+        if etag := response.headers.get("ETag"):
+            etag_path.write_text(etag)
+        total = (
+            _content_range_total(response.headers.get("Content-Range"))
+            if response.status_code == 206
+            else _int_or_none(response.headers.get("Content-Length"))
+        )
+        downloaded = self._write_body(response, part, digest, append=resumed_from > 0)
+        return self._verify(
+            part,
+            resumed_from + downloaded,
+            digest,
+            downloaded,
+            resumed_from,
+            expected_sha256,
+            response,
+            total,
+        )
+
+    def _write_body(
+        self,
+        response: httpx.Response,
+        part: Path,
+        digest: "hashlib._Hash",
+        append: bool,
+    ):
+        downloaded = 0
+        window_start = time.perf_counter()
+        with open(part, "ab" if append else "wb") as f:
+            for chunk in response.iter_bytes(self.chunk_size):
+                f.write(chunk)
+                digest.update(chunk)
+                downloaded += len(chunk)
+                if self.max_bytes_per_s is not None:
+                    # sleep off any lead over the bandwidth limit
+                    ahead_s = downloaded / self.max_bytes_per_s - (
+                        time.perf_counter() - window_start
+                    )
+                    if ahead_s > 0:
+                        time.sleep(ahead_s)
+        return downloaded
+
+    def _verify(
+        self,
+        part: Path,
+        size: int,
+        digest: "hashlib._Hash",
+        downloaded: int,
+        resumed_from: int,
+        expected_sha256: str | None,
+        response: httpx.Response,
+        total: int | None = None,
+    ):
+        if total is not None and size != total:
+            # a short read; keep the part file so the next attempt resumes
+            msg = f"Expected {total} bytes but have {size}."
+            raise httpx.RemoteProtocolError(msg)
+        content_hash = digest.hexdigest()
+        expected = expected_sha256 or response.headers.get(HASH_HEADER)
+        if expected is not None and content_hash != expected.lower():
+            part.unlink(missing_ok=True)
+            part.with_name(part.name + ETAG_SUFFIX).unlink(missing_ok=True)
+            msg = f"Expected sha256 {expected} but got {content_hash}."
+            raise ChecksumMismatchError(msg)
+        if expected is None:
+            logger.warning(
+                f"No expected hash for {part.name}; only its size was checked."
+            )
+        return size, content_hash, downloaded, resumed_from, expected is not None
+
+    def prewarm_decode(self, path: Path):
+        """Probe a file and decode it into the PCM cache so the first load is fast.
+
+        Args:
+            path (Path): The media file.
+        """
+        from ak_rpi.audio import init_mixer
+        from ak_rpi.pcm_cache import PCMCache
+        from ak_rpi.probe import probe
+
+        try:
+            probe(path)
+            init_mixer()
+            pcm, _ = PCMCache().open(path)
+            pcm.close()
+        except Exception as e:
+            logger.warning(f"Could not pre-warm {path}: {e!r}")
+
+    def fetch_in_background(
+        self,
+        media_path: str,
+        expected_sha256: str | None = None,
+        on_done: Callable[[DownloadResult], Any] | None = None,
+    ):
+        """Download a media file on a daemon thread, unless it is already being downloaded.
+
+        Args:
+            media_path (str): The path relative to the media directory.
+            expected_sha256 (str | None): The expected hex sha256 digest.
+            on_done (Callable | None): Called with the result once the file is in place.
+        """
+        with self._lock:
+            if media_path in self._active:
+                return
+            self._active.add(media_path)
+
+        def run():
+            try:
+                result = self.fetch(media_path, expected_sha256)
+            except Exception as e:
+                logger.exception(f"Failed to download {media_path}.", exc_info=e)
+                return
+            finally:
+                with self._lock:
+                    self._active.discard(media_path)
+            if on_done is not None:
+                on_done(result)
+
+        threading.Thread(target=run, name="download", daemon=True).start()
+
+
+def _int_or_none(value: str | None):
+    return int(value) if value is not None and value.isdigit() else None
+
+
+def _content_range_total(content_range: str | None):
+    """Get the total size from a `Content-Range: bytes a-b/total` header."""
+    if content_range is None or "/" not in content_range:
+        return None
+    return _int_or_none(content_range.rsplit("/", 1)[1])
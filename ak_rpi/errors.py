@@ -19,3 +19,15 @@ class CouldNotFindPlayerError(BaseRegistrationError):
 
 class MismatchedSerialNumberError(BaseRegistrationError):
     """The serial number does not match the one on the server."""
+
+
+class DownloadError(Exception):
+    """An error occurred while downloading media."""
+
+
+class ChecksumMismatchError(DownloadError):
+    """The downloaded media does not match its expected size or hash."""
+
+
+class StreamingError(Exception):
+    """A file cannot be streamed."""
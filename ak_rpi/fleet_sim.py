@@ -0,0 +1,381 @@
+"""A fleet-scale simulation of clock sync against a stand-in server, in virtual time.
+
+Every virtual player is a real `PlayerSettings` with a real `NTP`, syncing through the
+real client and `HTTPSyncTransport` against an `httpx.MockTransport` that plays the
+server. Only time is simulated: each player reads a drifting oscillator driven by a
+shared virtual clock, and the stand-in server advances that clock by the emulated
+network delay of each exchange, so an hour of fleet time runs in seconds and the true
+error of every estimate is known exactly.
+"""
+
+import heapq
+import logging
+import math
+import random
+import statistics
+import time
+from ipaddress import IPv4Address
+
+import httpx
+from pydantic import AnyHttpUrl, BaseModel, Field, HttpUrl, PrivateAttr, SecretStr
+
+from ak_rpi.client import Client
+from ak_rpi.ntp import NTP, Clock, SyncPolicy
+from ak_rpi.timebase import NS_PER_MS
+from ak_rpi.udp_sync import LinkProfile
+
+logger = logging.getLogger(__name__)
+
+SIM_URL = "http://sim"
+
+
+class VirtualTime(BaseModel):
+    """The true time shared by the simulated fleet and server."""
+
+    now_ms: float = 0.0
+
+    def advance(self, ms: float):
+        """Move time forward.
+
+        Args:
+            ms (float): How far to move in ms.
+        """
+        self.now_ms += max(ms, 0.0)
+
+
+class SimulatedClock(Clock):
+    """A player's oscillator, running fast or slow against the virtual true time."""
+
+    time_source: VirtualTime
+    skew: float = Field(default=0.0, description="The rate error of the oscillator.")
+    monotonic_origin_ms: float = Field(
+        default=0.0, description="The monotonic reading at true time zero in ms."
+    )
+    wall_error_ms: float = Field(
+        default=0.0, description="How far the wall clock is ahead of true time in ms."
+    )
+
+    def monotonic_ms(self):
+        """Get the monotonic time in fractional ms."""
+        return self.monotonic_origin_ms + self.time_source.now_ms * (1 + self.skew)
+
+    def monotonic_ns(self):
+        """Get the monotonic time in ns."""
+        return round(self.monotonic_ms() * NS_PER_MS)
+
+    def wall_ns(self):
+        """Get the wall-clock time in ns."""
+        wall_ms = self.time_source.now_ms * (1 + self.skew) + self.wall_error_ms
+        return round(wall_ms * NS_PER_MS)
+
+    def true_time(self, monotonic_ms: float):
+        """Get the true time at which the oscillator reads a monotonic time.
+
+        Args:
+            monotonic_ms (float): The monotonic time in ms.
+
+        Returns:
+            true_time (float): The true time in ms.
+        """
+        return (monotonic_ms - self.monotonic_origin_ms) / (1 + self.skew)
+
+
+class StandInServer(BaseModel):
+    """Answers `/api/sync` in virtual time, as the server would behind an emulated link.
+
+    Server time is the virtual true time, truncated to whole ms as the real endpoint does.
+    """
+
+    time_source: VirtualTime
+    link: LinkProfile = Field(default_factory=LinkProfile)
+    processing_ms: float = Field(
+        default=0.2, ge=0, description="The time the server spends on a request in ms."
+    )
+    request_times: list[float] = Field(
+        default_factory=list, description="The true time of every request in ms."
+    )
+    handler_s: float = Field(
+        default=0.0, description="The real time spent answering requests in s."
+    )
+    _rng: random.Random = PrivateAttr(default_factory=random.Random)
+
+    def seed(self, seed: int):
+        """Seed the emulated link.
+
+        Args:
+            seed (int): The seed.
+        """
+        self._rng.seed(seed)
+
+    def handle(self, request: httpx.Request):
+        """Answer a request.
+
+        Args:
+            request (httpx.Request): The request.
+
+        Returns:
+            response (httpx.Response): The response.
+        """
+        started = time.perf_counter()
+        clock = self.time_source
+        inbound_s, outbound_s = self.link.delays_s(self._rng)
+        clock.advance(inbound_s * 1000)
+        received = clock.now_ms
+        self.request_times.append(received)
+        clock.advance(self.processing_ms)
+        body = {
+            "reqSentAt": int(request.url.params["reqSentAt"]),
+            "reqReceivedAt": int(received),
+            "resSentAt": int(clock.now_ms),
+        }
+        clock.advance(outbound_s * 1000)
+        response = httpx.Response(200, json=body)
+        self.handler_s += time.perf_counter() - started
+        return response
+
+
+class FleetReport(BaseModel):
+    """The sync quality of a simulated fleet."""
+
+    n_players: int
+    duration_s: float = Field(..., description="The simulated time in s.")
+    error_p50_ms: float = Field(
+        ..., description="The median absolute server-time error after warm-up in ms."
+    )
+    error_p95_ms: float
+    error_p99_ms: float
+    error_max_ms: float
+    converge_p50_s: float | None = Field(
+        ...,
+        description="The median time until a player's error stays within the target in s.",
+    )
+    converge_max_s: float | None
+    n_unconverged: int = Field(
+        ..., description="The players whose error never settled within the target."
+    )
+    requests_per_player_hour: float
+    server_mean_rps: float = Field(
+        ..., description="The mean request rate at the server in requests per s."
+    )
+    server_peak_rps: float = Field(
+        ...,
+        description="The highest request rate at the server over any 1 s in requests per s.",
+    )
+    server_capacity_rps: float = Field(
+        ..., description="How many requests per s the stand-in answered in real time."
+    )
+    wall_s: float = Field(..., description="The real time the simulation took in s.")
+
+
+class FleetSimulation(BaseModel, arbitrary_types_allowed=True):
+    """A fleet of virtual players syncing with one stand-in server."""
+
+    n_players: int = Field(default=50, gt=0)
+    link: LinkProfile = Field(
+        default_factory=lambda: LinkProfile(latency_ms=20, jitter_ms=5),
+        description="The emulated network between each player and the server.",
+    )
+    skew_ppm_sd: float = Field(
+        default=20.0,
+        ge=0,
+        description="The standard deviation of the players' oscillator skew in ppm.",
+    )
+    wall_error_ms_sd: float = Field(
+        default=500.0,
+        ge=0,
+        description="The standard deviation of the players' wall-clock error in ms.",
+    )
+    stagger_s: float = Field(
+        default=10.0, ge=0, description="The spread of the players' start times in s."
+    )
+    measure_interval_s: float = Field(
+        default=5.0, gt=0, description="How often to measure each player's error in s."
+    )
+    warmup_s: float = Field(
+        default=60.0,
+        ge=0,
+        description="How long after start errors are left out of the percentiles in s.",
+    )
+    policy: SyncPolicy = Field(
+        default_factory=SyncPolicy,
+        description="The template sync policy, copied for each player.",
+    )
+    seed: int = 0
+
+    def run(self, duration_s: float = 3600.0):
+        """Run the simulation.
+
+        Args:
+            duration_s (float): How long to simulate in s.
+
+        Returns:
+            report (FleetReport): The report.
+        """
+        from ak_rpi.player import PlayerSettings
+
+        started = time.perf_counter()
+        # seeded so a run is reproducible; nothing here needs to be unpredictable
+        rng = random.Random(self.seed)  # noqa: S311
+        clock = VirtualTime()
+        server = StandInServer(time_source=clock, link=self.link)
+        server.seed(self.seed)
+        transport = httpx.MockTransport(server.handle)
+        players: list[PlayerSettings] = []
+        oscillators: list[SimulatedClock] = []
+        for i in range(self.n_players):
+            oscillator = SimulatedClock(
+                time_source=clock,
+                skew=rng.gauss(0, self.skew_ppm_sd) * 1e-6,
+                monotonic_origin_ms=rng.uniform(0, 1e6),
+                wall_error_ms=rng.gauss(0, self.wall_error_ms_sd),
+            )
+            client = Client(
+                syncUrl=HttpUrl(SIM_URL),
+                password=SecretStr(""),
+                client=httpx.Client(base_url=SIM_URL, transport=transport),
+            )
+            ntp = NTP(
+                client=client,
+                clock=oscillator,
+                startup_time_ns=oscillator.wall_ns(),
+                startup_time_monotonic_ns=oscillator.monotonic_ns(),
+                policy=self.policy.model_copy(deep=True),
+            )
+            ntp.policy.seed(rng.getrandbits(32))
+            oscillators.append(oscillator)
+            players.append(
+                PlayerSettings(
+                    id=i,
+                    nickname=f"sim-{i}",
+                    ipAddress=IPv4Address("127.0.0.1"),
+                    macAddress="00:00:00:00:00:00",
+                    syncUrl=AnyHttpUrl(SIM_URL),
+                    firmwareUrl=AnyHttpUrl(SIM_URL),
+                    volume=100,
+                    quietMode=0,
+                    serialNumber=f"sim-{i}",
+                    tenantId=0,
+                    client=client,
+                    ntp=ntp,
+                )
+            )
+        end_ms = duration_s * 1000
+        # (true time, tiebreak, player index or -1 to measure)
+        events: list[tuple[float, int, int]] = [(0.0, 0, -1)]
+        for i in range(self.n_players):
+            events.append((rng.uniform(0, self.stagger_s * 1000), i + 1, i))
+        heapq.heapify(events)
+        tiebreak = self.n_players + 1
+        started_at: dict[int, float] = {}
+        errors: list[list[tuple[float, float]]] = [[] for _ in players]
+        while events:
+            at, _, i = heapq.heappop(events)
+            if at > end_ms:
+                break
+            clock.now_ms = max(clock.now_ms, at)
+            if i < 0:
+                for j in started_at:
+                    ntp = players[j].ntp
+                    estimate = ntp.server_time_from_monotonic(
+                        oscillators[j].monotonic_ms()
+                    )
+                    errors[j].append((
+                        clock.now_ms - started_at[j],
+                        estimate - clock.now_ms,
+                    ))
+                next_at = at + self.measure_interval_s * 1000
+            else:
+                ntp = players[i].ntp
+                if i not in started_at:
+                    started_at[i] = clock.now_ms
+                    ntp.sync()
+                else:
+                    ntp.sync(ntp.policy.next_samples)
+                interval = ntp.policy.plan(
+                    ntp.clock_model, ntp.estimator, ntp.local_time
+                )
+                next_at = clock.now_ms + interval
+            tiebreak += 1
+            heapq.heappush(events, (next_at, tiebreak, i))
+        return self._report(
+            players, errors, server, duration_s, time.perf_counter() - started
+        )
+
+    def _report(
+        self,
+        players: list,
+        errors: list[list[tuple[float, float]]],
+        server: StandInServer,
+        duration_s: float,
+        wall_s: float,
+    ):
+        target = self.policy.target_error_ms
+        settled = sorted(
+            abs(error)
+            for series in errors
+            for since, error in series
+            if since >= self.warmup_s * 1000
+        ) or [math.nan]
+        converge_s = []
+        for series in errors:
+            converged_at = None
+            for since, error in series:
+                if abs(error) > target:
+                    converged_at = None
+                elif converged_at is None:
+                    converged_at = since / 1000
+            if converged_at is not None:
+                converge_s.append(converged_at)
+        buckets: dict[int, int] = {}
+        for at in server.request_times:
+            buckets[int(at // 1000)] = buckets.get(int(at // 1000), 0) + 1
+        n_requests = len(server.request_times)
+
+        def percentile(q: float):
+            return settled[min(int(len(settled) * q), len(settled) - 1)]
+
+        return FleetReport(
+            n_players=len(players),
+            duration_s=duration_s,
+            error_p50_ms=percentile(0.5),
+            error_p95_ms=percentile(0.95),
+            error_p99_ms=percentile(0.99),
+            error_max_ms=settled[-1],
+            converge_p50_s=statistics.median(converge_s) if converge_s else None,
+            converge_max_s=max(converge_s) if converge_s else None,
+            n_unconverged=len(players) - len(converge_s),
+            requests_per_player_hour=n_requests / len(players) / (duration_s / 3600),
+            server_mean_rps=n_requests / duration_s,
+            server_peak_rps=max(buckets.values(), default=0),
+            server_capacity_rps=n_requests / server.handler_s
+            if server.handler_s
+            else 0,
+            wall_s=wall_s,
+        )
+
+
+def benchmark(duration_s: float = 3600.0, n_players: int = 50):
+    """Simulate a fleet over a LAN, a WAN, an asymmetric WAN and a congested link.
+
+    Args:
+        duration_s (float): How long to simulate each scenario in s.
+        n_players (int): The number of players.
+
+    Returns:
+        reports (dict[str, FleetReport]): The reports by scenario.
+    """
+    scenarios = {
+        "lan": LinkProfile(latency_ms=1, jitter_ms=0.2),
+        "wan": LinkProfile(latency_ms=20, jitter_ms=5),
+        "wan-asymmetric": LinkProfile(latency_ms=20, jitter_ms=5, asymmetry_ms=4),
+        "congested": LinkProfile(latency_ms=40, jitter_ms=30),
+    }
+    return {
+        name: FleetSimulation(n_players=n_players, link=link).run(duration_s)
+        for name, link in scenarios.items()
+    }
+
+
+if __name__ == "__main__":
+    for name, report in benchmark().items():
+        print(f"{name}: {report.model_dump_json()}")
@@ -0,0 +1,666 @@
+"""Calibration of the delay between handing audio to the mixer and it being heard."""
+
+import abc
+import logging
+import math
+import os
+import random
+import statistics
+import struct
+import threading
+import time
+from pathlib import Path
+
+import pygame
+from pydantic import BaseModel, Field, PrivateAttr, ValidationError
+
+from ak_rpi.audio import MIXER_BUFFER_FRAMES, init_mixer, silence
+from ak_rpi.timebase import monotonic_ms
+
+logger = logging.getLogger(__name__)
+
+# what every player assumed before calibration, for outputs nothing is known about
+DEFAULT_OUTPUT_LATENCY_MS = 100.0
+LATENCY_PROFILES_PATH = Path("latency.json")
+ALSA_ROOT = Path("/proc/asound")
+# a sound handed to the mixer waits on average half a buffer for the next callback,
+# then a whole buffer while SDL blocks on writing the previous one to the device
+MIXER_BUFFERS_IN_FLIGHT = 1.5
+
+
+class AlsaStatus(BaseModel):
+    """The state of an open ALSA playback substream, from `/proc/asound`."""
+
+    card: int
+    card_id: str = Field(
+        ..., description="The card's id, e.g. `Headphones` or `vc4hdmi0`."
+    )
+    device: int
+    subdevice: int
+    state: str = Field(
+        ..., description="The stream state, e.g. `RUNNING` or `PREPARED`."
+    )
+    owner_pid: int | None = None
+    rate: int = Field(..., gt=0, description="The sample rate in Hz.")
+    period_size: int = Field(..., description="The period size in frames.")
+    buffer_size: int = Field(..., description="The ring buffer size in frames.")
+    delay_frames: int | None = Field(
+        default=None,
+        description="The frames queued ahead of the next write, reported while running.",
+    )
+
+    @property
+    def device_id(self):
+        """Get an id for the output that is stable across reboots."""
+        return f"alsa:{self.card_id}:{self.device}"
+
+    @property
+    def delay_ms(self):
+        """Get the device-reported delay in ms, or the full ring buffer if the stream is not running."""
+        frames = self.buffer_size if self.delay_frames is None else self.delay_frames
+        return frames * 1000 / self.rate
+
+
+def _parse_proc_fields(text: str):
+    fields: dict[str, str] = {}
+    for line in text.splitlines():
+        name, sep, value = line.partition(":")
+        if sep:
+            fields[name.strip()] = value.strip()
+    return fields
+
+
+def read_alsa_status(root: Path = ALSA_ROOT, pid: int | None = None):
+    """Find the ALSA playback substream this process is playing to.
+
+    Args:
+        root (Path): The procfs directory to read.
+        pid (int | None): The process that owns the stream; defaults to this one.
+
+    Returns:
+        status (AlsaStatus | None): The stream, or None if no single open stream is found,
+            e.g. when a sound server owns the device.
+    """
+    pid = os.getpid() if pid is None else pid
+    streams: list[AlsaStatus] = []
+    for status_path in sorted(root.glob("card*/pcm*p/sub*/status")):
+        try:
+            status = _parse_proc_fields(status_path.read_text())
+            hw_params = _parse_proc_fields(
+                (status_path.parent / "hw_params").read_text()
+            )
+            card_dir = status_path.parent.parent.parent
+            card_id = (card_dir / "id").read_text().strip()
+        except OSError:
+            continue
+        if "state" not in status or "rate" not in hw_params:
+            # closed
+            continue
+        owner_pid, delay = status.get("owner_pid"), status.get("delay")
+        try:
+            streams.append(
+                AlsaStatus(
+                    card=int(card_dir.name.removeprefix("card")),
+                    card_id=card_id,
+                    device=int(status_path.parent.parent.name[3:-1]),
+                    subdevice=int(status_path.parent.name.removeprefix("sub")),
+                    state=status["state"],
+                    owner_pid=None if owner_pid is None else int(owner_pid),
+                    rate=int(hw_params["rate"].split()[0]),
+                    period_size=int(hw_params["period_size"]),
+                    buffer_size=int(hw_params["buffer_size"]),
+                    delay_frames=None if delay is None else int(delay),
+                )
+            )
+        except (KeyError, ValueError, ValidationError) as e:
+            logger.warning(f"Ignoring unreadable ALSA status {status_path}: {e!r}")
+    owned = [s for s in streams if s.owner_pid == pid]
+    if len(owned) == 1:
+        return owned[0]
+    if len(streams) == 1:
+        return streams[0]
+    return None
+
+
+def impulse(duration_ms: float = 2.0):
+    """Create a full-scale click in the mixer's format.
+
+    Args:
+        duration_ms (float): The duration of the click in ms.
+
+    Returns:
+        sound (pygame.mixer.Sound): The click.
+    """
+    frequency, size, channels = init_mixer()
+    n_frames = max(round(duration_ms * frequency / 1000), 1)
+    sample_bytes = abs(size) // 8
+    if size == 32:
+        sample = struct.pack("<f", 1.0)
+    elif size < 0:
+        sample = ((1 << (abs(size) - 1)) - 1).to_bytes(
+            sample_bytes, "little", signed=True
+        )
+    else:
+        sample = ((1 << abs(size)) - 1).to_bytes(sample_bytes, "little")
+    return pygame.mixer.Sound(buffer=sample * (n_frames * channels))
+
+
+class OutputDevice(BaseModel, abc.ABC, arbitrary_types_allowed=True):
+    """An audio output whose latency can be calibrated."""
+
+    @property
+    @abc.abstractmethod
+    def device_id(self) -> str:
+        """Get an id for the output that is stable across reboots."""
+
+    @property
+    @abc.abstractmethod
+    def mixer_format(self) -> tuple[int, int]:
+        """Get the mixer's sample rate in Hz and buffer size in frames."""
+
+    @property
+    def can_measure(self) -> bool:
+        """Whether `measure_once` can detect the output."""
+        return False
+
+    def status(self) -> AlsaStatus | None:
+        """Get the state the output device reports, if it reports any."""
+        return None
+
+    def measure_once(self, lead_ms: float = 200.0) -> float | None:
+        """Play an impulse and measure how long after its scheduled start it is heard.
+
+        Args:
+            lead_ms (float): How far ahead to schedule the impulse in ms.
+
+        Returns:
+            latency_ms (float | None): The delay in ms, or None if the impulse was not detected.
+        """
+        return None
+
+
+class PygameOutputDevice(OutputDevice):
+    """The pygame mixer's output, optionally measured through a capture device.
+
+    Measuring needs the output fed back to an input: a loopback cable, an ALSA loopback
+    device, or a microphone at the speaker (which adds about 2.9ms per metre). The capture
+    side's own buffering is subtracted as `capture_latency_ms`.
+    """
+
+    capture_device: str | None = Field(
+        default=None, description="The SDL name of the capture device to listen on."
+    )
+    threshold: float = Field(
+        default=0.25,
+        gt=0,
+        le=1,
+        description="The level, relative to full scale, at which the impulse is detected.",
+    )
+    capture_chunk_frames: int = Field(default=256, gt=0)
+    capture_latency_ms: float | None = Field(
+        default=None,
+        description="The delay of the capture path in ms; one capture chunk if not provided.",
+    )
+    timeout_s: float = Field(default=2.0, gt=0)
+    alsa_root: Path = ALSA_ROOT
+
+    @property
+    def device_id(self):
+        """Get an id for the output that is stable across reboots."""
+        status = self.status()
+        if status is not None:
+            return status.device_id
+        return f"sdl:{os.environ.get('SDL_AUDIODRIVER', 'default')}"
+
+    @property
+    def mixer_format(self):
+        """Get the mixer's sample rate in Hz and buffer size in frames."""
+        frequency, _, _ = init_mixer()
+        return frequency, MIXER_BUFFER_FRAMES
+
+    @property
+    def can_measure(self):
+        """Whether a capture device is configured."""
+        return self.capture_device is not None
+
+    def status(self):
+        """Get the state of the ALSA stream the mixer plays to."""
+        init_mixer()
+        return read_alsa_status(self.alsa_root)
+
+    def measure_once(self, lead_ms: float = 200.0):
+        """Play an impulse and detect it on the capture device.
+
+        Args:
+            lead_ms (float): How far ahead to schedule the impulse in ms.
+
+        Returns:
+            latency_ms (float | None): The delay in ms, or None if the impulse was not detected.
+        """
+        if self.capture_device is None:
+            return None
+        from pygame._sdl2.audio import AUDIO_S16, AudioDevice
+
+        frequency, _, _ = init_mixer()
+        threshold = round(self.threshold * 32767)
+        chunk_ms = self.capture_chunk_frames * 1000 / frequency
+        capture_latency_ms = (
+            chunk_ms if self.capture_latency_ms is None else self.capture_latency_ms
+        )
+        scheduled = [math.inf]
+        detected: list[float] = []
+        heard = threading.Event()
+
+        def on_capture(_device, buffer):
+            received = monotonic_ms()
+            if heard.is_set():
+                return
+            samples = memoryview(buffer).cast("h")
+            n = len(samples)
+            for i, sample in enumerate(samples):
+                if abs(sample) >= threshold:
+                    at = received - (n - i) * 1000 / frequency - capture_latency_ms
+                    if at >= scheduled[0] - chunk_ms:
+                        detected.append(at)
+                        heard.set()
+                    return
+
+        capture = AudioDevice(
+            devicename=self.capture_device,
+            iscapture=True,
+            frequency=frequency,
+            audioformat=AUDIO_S16,
+            numchannels=1,
+            chunksize=self.capture_chunk_frames,
+            allowed_changes=0,
+            callback=on_capture,
+        )
+        channel = pygame.mixer.find_channel(True)
+        try:
+            capture.pause(0)
+            start = monotonic_ms() + lead_ms
+            scheduled[0] = start
+            channel.play(silence(start - monotonic_ms()))
+            channel.queue(impulse())
+            heard.wait(self.timeout_s + lead_ms / 1000)
+        finally:
+            capture.close()
+            channel.stop()
+        if not detected:
+            logger.warning("The calibration impulse was not detected.")
+            return None
+        return detected[0] - start
+
+
+class SimulatedOutputDevice(OutputDevice):
+    """An output with a known latency, for exercising calibration without hardware."""
+
+    name: str = "simulated"
+    frequency: int = Field(default=44100, gt=0)
+    buffer_frames: int = Field(default=MIXER_BUFFER_FRAMES, gt=0)
+    reported_delay_ms: float | None = Field(
+        default=20.0,
+        description="The delay the device reports in ms; None for a device that reports nothing.",
+    )
+    hidden_delay_ms: float = Field(
+        default=3.0,
+        description="Delay the device does not report, e.g. in a DAC or HDMI sink, in ms.",
+    )
+    jitter_ms: float = Field(
+        default=0.3,
+        ge=0,
+        description="The standard deviation of each measurement in ms.",
+    )
+    detect_rate: float = Field(
+        default=1.0, ge=0, le=1, description="The chance an impulse is detected."
+    )
+    seed: int = 0
+    _rng: random.Random = PrivateAttr(default_factory=random.Random)
+
+    def model_post_init(self, __context):
+        """Seed the measurement noise."""
+        self._rng.seed(self.seed)
+
+    @property
+    def device_id(self):
+        """Get the id of the simulated output."""
+        return f"sim:{self.name}"
+
+    @property
+    def mixer_format(self):
+        """Get the simulated mixer's sample rate in Hz and buffer size in frames."""
+        return self.frequency, self.buffer_frames
+
+    @property
+    def can_measure(self):
+        """Simulated outputs can always be measured."""
+        return True
+
+    @property
+    def true_latency_ms(self):
+        """Get the actual delay from scheduled start to first sample in ms."""
+        mixer_ms = self.buffer_frames * 1000 / self.frequency * MIXER_BUFFERS_IN_FLIGHT
+        return mixer_ms + (self.reported_delay_ms or 0.0) + self.hidden_delay_ms
+
+    def status(self):
+        """Get the simulated ALSA status, if the device reports a delay."""
+        if self.reported_delay_ms is None:
+            return None
+        delay_frames = round(self.reported_delay_ms * self.frequency / 1000)
+        return AlsaStatus(
+            card=0,
+            card_id=self.name,
+            device=0,
+            subdevice=0,
+            state="RUNNING",
+            rate=self.frequency,
+            period_size=self.buffer_frames,
+            buffer_size=delay_frames + self.buffer_frames,
+            delay_frames=delay_frames,
+        )
+
+    def measure_once(self, lead_ms: float = 200.0):
+        """Simulate measuring an impulse.
+
+        Args:
+            lead_ms (float): How far ahead to schedule the impulse in ms.
+
+        Returns:
+            latency_ms (float | None): The measured delay in ms, or None if it was missed.
+        """
+        if self._rng.random() >= self.detect_rate:
+            return None
+        return self.true_latency_ms + self._rng.gauss(0, self.jitter_ms)
+
+
+class OutputLatencyProfile(BaseModel):
+    """The calibrated output latency of one device at one mixer configuration."""
+
+    device_id: str
+    frequency: int = Field(..., description="The mixer sample rate in Hz.")
+    buffer_frames: int = Field(..., description="The mixer buffer size in frames.")
+    mixer_ms: float = Field(
+        ..., description="The delay added by the mixer's buffering in ms."
+    )
+    device_ms: float | None = Field(
+        ..., description="The delay the device reported in ms, if it reported one."
+    )
+    estimated_ms: float = Field(
+        ..., description="The latency derived from the mixer and device delays in ms."
+    )
+    measured_ms: float | None = Field(
+        default=None,
+        description="The median measured start-to-first-sample delay in ms.",
+    )
+    measured_sd_ms: float | None = None
+    n_measurements: int = 0
+    updated_at: float = Field(
+        default_factory=time.time,
+        description="The wall-clock time it was calibrated in s.",
+    )
+
+    @property
+    def latency_ms(self):
+        """Get the best known latency: measured if available, else estimated."""
+        return self.estimated_ms if self.measured_ms is None else self.measured_ms
+
+    def matches(self, frequency: int, buffer_frames: int):
+        """Whether the profile was calibrated at a mixer configuration.
+
+        Args:
+            frequency (int): The mixer sample rate in Hz.
+            buffer_frames (int): The mixer buffer size in frames.
+
+        Returns:
+            matches (bool): True if it was.
+        """
+        return self.frequency == frequency and self.buffer_frames == buffer_frames
+
+
+class LatencyStore(BaseModel):
+    """The calibrated profiles of every output this player has used, kept on disk."""
+
+    path: Path = LATENCY_PROFILES_PATH
+    profiles: dict[str, OutputLatencyProfile] = Field(default_factory=dict)
+
+    @classmethod
+    def Load(cls, path: Path = LATENCY_PROFILES_PATH):
+        """Read the profiles from disk.
+
+        Args:
+            path (Path): The file to read.
+
+        Returns:
+            store (LatencyStore): The store; empty if the file is missing or invalid.
+        """
+        try:
+            with open(path) as f:
+                store = cls.model_validate_json(f.read())
+        except FileNotFoundError:
+            return cls(path=path)
+        except ValidationError as e:
+            logger.exception(f"Ignoring invalid latency profiles {path}.", exc_info=e)
+            return cls(path=path)
+        store.path = path
+        return store
+
+    def get(self, device_id: str):
+        """Get the profile of a device.
+
+        Args:
+            device_id (str): The device id.
+
+        Returns:
+            profile (OutputLatencyProfile | None): The profile, or None if it was never calibrated.
+        """
+        return self.profiles.get(device_id)
+
+    def put(self, profile: OutputLatencyProfile):
+        """Store a profile and atomically write the store to disk.
+
+        Args:
+            profile (OutputLatencyProfile): The profile.
+        """
+        self.profiles[profile.device_id] = profile
+        tmp = self.path.with_suffix(".tmp")
+        with open(tmp, "w") as f:
+            f.write(self.model_dump_json(exclude={"path"}))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+
+
+class LatencyCalibrator(BaseModel):
+    """Works out, stores and recalls the output latency of a device.
+
+    The estimate adds the mixer's buffering to the delay the device reports. Devices that
+    report nothing fall back to `DEFAULT_OUTPUT_LATENCY_MS`. When the device can be
+    measured, the estimate is replaced by the median of a few start-to-first-sample
+    measurements, which also catches delay downstream of the driver, e.g. in an HDMI sink.
+    """
+
+    device: OutputDevice
+    store: LatencyStore = Field(default_factory=LatencyStore.Load)
+    n_impulses: int = Field(default=5, gt=0, description="The number of measurements.")
+    max_latency_ms: float = Field(
+        default=1000.0,
+        gt=0,
+        description="Measurements above this are discarded as spurious.",
+    )
+
+    def estimate(self):
+        """Estimate the latency from the mixer configuration and the device-reported delay.
+
+        Returns:
+            profile (OutputLatencyProfile): The unmeasured profile.
+        """
+        frequency, buffer_frames = self.device.mixer_format
+        mixer_ms = buffer_frames * 1000 / frequency * MIXER_BUFFERS_IN_FLIGHT
+        status = self.device.status()
+        device_ms = None if status is None else status.delay_ms
+        return OutputLatencyProfile(
+            device_id=self.device.device_id,
+            frequency=frequency,
+            buffer_frames=buffer_frames,
+            mixer_ms=mixer_ms,
+            device_ms=device_ms,
+            estimated_ms=DEFAULT_OUTPUT_LATENCY_MS
+            if device_ms is None
+            else mixer_ms + device_ms,
+        )
+
+    def measure(self, profile: OutputLatencyProfile):
+        """Refine a profile with start-to-first-sample measurements.
+
+        Args:
+            profile (OutputLatencyProfile): The profile to refine.
+
+        Returns:
+            profile (OutputLatencyProfile): The refined profile, unchanged if nothing was detected.
+        """
+        latencies = []
+        for _ in range(self.n_impulses):
+            latency = self.device.measure_once()
+            if latency is not None and 0 <= latency <= self.max_latency_ms:
+                latencies.append(latency)
+        if not latencies:
+            return profile
+        return profile.model_copy(
+            update={
+                "measured_ms": statistics.median(latencies),
+                "measured_sd_ms": statistics.pstdev(latencies),
+                "n_measurements": len(latencies),
+            }
+        )
+
+    def calibrate(self, measure: bool = True):
+        """Get the device's profile, calibrating and storing it if needed.
+
+        A stored profile is reused if it was made at the current mixer configuration,
+        unless it is unmeasured and a measurement is now possible.
+
+        Args:
+            measure (bool): Whether measuring is allowed, e.g. False while audio is playing.
+
+        Returns:
+            profile (OutputLatencyProfile): The profile.
+        """
+        measure = measure and self.device.can_measure
+        stored = self.store.get(self.device.device_id)
+        if (
+            stored is not None
+            and stored.matches(*self.device.mixer_format)
+            and (stored.measured_ms is not None or not measure)
+        ):
+            return stored
+        profile = self.estimate()
+        if measure:
+            profile = self.measure(profile)
+        logger.info(
+            f"Output latency of {profile.device_id}: {profile.latency_ms:.1f}ms "
+            f"(estimated {profile.estimated_ms:.1f}ms"
+            + (
+                f", measured over {profile.n_measurements} impulses"
+                if profile.measured_ms is not None
+                else ""
+            )
+            + ")."
+        )
+        try:
+            self.store.put(profile)
+        except OSError as e:
+            logger.exception("Failed to save the latency profile.", exc_info=e)
+        return profile
+
+
+class FleetLatencyReport(BaseModel):
+    """How far apart a mixed fleet is heard, before and after calibration."""
+
+    devices: dict[str, float] = Field(
+        ..., description="The true latency by device in ms."
+    )
+    constant_spread_ms: float = Field(
+        ..., description="The spread of audible starts with the fixed constant in ms."
+    )
+    estimated_spread_ms: float = Field(
+        ..., description="The spread with estimated latencies in ms."
+    )
+    measured_spread_ms: float = Field(
+        ..., description="The spread with measured latencies in ms."
+    )
+
+
+def benchmark(tmp_dir: Path = Path(".")):
+    """Calibrate a simulated mixed fleet and compare how far apart it is heard.
+
+    Args:
+        tmp_dir (Path): Where to keep the latency profiles.
+
+    Returns:
+        report (FleetLatencyReport): The report.
+    """
+    devices = [
+        SimulatedOutputDevice(
+            name="headphones", reported_delay_ms=46.4, hidden_delay_ms=1, seed=1
+        ),
+        SimulatedOutputDevice(
+            name="hdmi", reported_delay_ms=92.9, hidden_delay_ms=35, seed=2
+        ),
+        SimulatedOutputDevice(
+            name="usb-dac", reported_delay_ms=10.0, hidden_delay_ms=4, seed=3
+        ),
+        SimulatedOutputDevice(
+            name="bluetooth",
+            reported_delay_ms=None,
+            hidden_delay_ms=180,
+            buffer_frames=1024,
+            seed=4,
+        ),
+    ]
+    store = LatencyStore(path=tmp_dir / "latency-benchmark.json")
+
+    def spread(assumed: list[float]):
+        # each player schedules its start `assumed` early, so it is heard this far off
+        errors = [d.true_latency_ms - a for d, a in zip(devices, assumed, strict=True)]
+        return max(errors) - min(errors)
+
+    estimated = [
+        LatencyCalibrator(device=d, store=store).calibrate(measure=False).latency_ms
+        for d in devices
+    ]
+    measured = [
+        LatencyCalibrator(device=d, store=store).calibrate(measure=True).latency_ms
+        for d in devices
+    ]
+    store.path.unlink(missing_ok=True)
+    return FleetLatencyReport(
+        devices={d.device_id: d.true_latency_ms for d in devices},
+        constant_spread_ms=spread([DEFAULT_OUTPUT_LATENCY_MS] * len(devices)),
+        estimated_spread_ms=spread(estimated),
+        measured_spread_ms=spread(measured),
+    )
+
+
+def main():
+    """Calibrate this player's output, measuring through a capture device if one is given.
+
+    Usage: `python -m ak_rpi.latency [capture device]`; the capture devices are listed if
+    the name is `?`.
+    """
+    import sys
+
+    logging.basicConfig(level=logging.INFO)
+    capture = sys.argv[1] if len(sys.argv) > 1 else None
+    if capture == "?":
+        from pygame._sdl2.audio import get_audio_device_names
+
+        init_mixer()
+        print("\n".join(get_audio_device_names(True)))
+        return
+    device = PygameOutputDevice(capture_device=capture)
+    profile = LatencyCalibrator(device=device).calibrate()
+    print(profile.model_dump_json(indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,351 @@
+"""A persistent, incrementally updated index of the media directory."""
+
+import ctypes
+import ctypes.util
+import logging
+import os
+import select
+import threading
+from collections.abc import Callable, Iterator
+from pathlib import Path
+from typing import Any
+
+from pydantic import BaseModel, Field, PrivateAttr
+
+from ak_rpi.pcm_cache import hash_file
+from ak_rpi.probe import probe
+
+logger = logging.getLogger(__name__)
+
+MediaRoot = Path(__file__).parent.parent / "media"
+IndexPath = MediaRoot / ".index.json"
+
+# inotify event masks, see inotify(7)
+_IN_CLOSE_WRITE = 0x008
+_IN_MOVED_FROM = 0x040
+_IN_MOVED_TO = 0x080
+_IN_CREATE = 0x100
+_IN_DELETE = 0x200
+_IN_DELETE_SELF = 0x400
+_IN_MOVE_SELF = 0x800
+_WATCH_MASK = (
+    _IN_CLOSE_WRITE
+    | _IN_MOVED_FROM
+    | _IN_MOVED_TO
+    | _IN_CREATE
+    | _IN_DELETE
+    | _IN_DELETE_SELF
+    | _IN_MOVE_SELF
+)
+
+
+class MediaEntry(BaseModel):
+    """An indexed media file."""
+
+    path: str = Field(
+        ..., description="The path relative to the media root, in posix form."
+    )
+    size: int = Field(..., ge=0, description="The size in bytes.")
+    mtime_ns: int = Field(..., description="The modification time in ns.")
+    content_hash: str = Field(..., description="The hex sha256 digest of the contents.")
+    duration_ms: float | None = Field(
+        default=None, description="The probed duration in ms, if it could be probed."
+    )
+
+
+def _hash_lookup(entries: dict[str, MediaEntry]):
+    """Map content hashes to paths, preferring the first path for duplicate contents."""
+    return {
+        entry.content_hash: path
+        for path, entry in sorted(entries.items(), reverse=True)
+    }
+
+
+class _Inotify:
+    """A minimal inotify wrapper over libc; raises OSError where inotify is unavailable."""
+
+    def __init__(self):
+        libc_name = ctypes.util.find_library("c")
+        if libc_name is None:
+            msg = "libc not found"
+            raise OSError(msg)
+        self._libc = ctypes.CDLL(libc_name, use_errno=True)
+        self.fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self._watched: set[bytes] = set()
+
+    def watch(self, path: Path):
+        key = os.fsencode(path)
+        if key in self._watched:
+            return
+        if self._libc.inotify_add_watch(self.fd, key, _WATCH_MASK) >= 0:
+            self._watched.add(key)
+
+    def forget_missing(self):
+        self._watched = {key for key in self._watched if os.path.isdir(key)}
+
+    def wait(self, timeout_s: float):
+        """Wait for events, draining them; returns True if there were any."""
+        readable, _, _ = select.select([self.fd], [], [], timeout_s)
+        if not readable:
+            return False
+        try:
+            while os.read(self.fd, 65536):
+                pass
+        except BlockingIOError:
+            pass
+        return True
+
+    def close(self):
+        os.close(self.fd)
+
+
+class MediaIndex(BaseModel):
+    """An index of the media files under a root directory.
+
+    The directory is walked in a single pass with `os.scandir`. Files whose size and
+    mtime are unchanged since the last walk keep their recorded hash and duration, so
+    only new or modified files are hashed and probed. The index is persisted between
+    runs and kept current by `watch`, which uses inotify where available and polls
+    otherwise. Lookups by path or content hash are dictionary lookups, and selection is
+    deterministic, ordered by path. Hidden files and directories are skipped.
+    """
+
+    root: Path = Field(default=MediaRoot, description="The media directory.")
+    index_path: Path = Field(default=IndexPath, description="The persisted index.")
+    exts: tuple[str, ...] = Field(
+        default=("mp3", "wav"), description="The media file extensions to index."
+    )
+    poll_interval_s: float = Field(
+        default=5.0,
+        gt=0,
+        description="How often to rescan when inotify is unavailable in s.",
+    )
+    settle_s: float = Field(
+        default=0.25,
+        ge=0,
+        description="How long to wait for a burst of changes to finish before rescanning in s.",
+    )
+    entries: dict[str, MediaEntry] = Field(default_factory=dict)
+    _by_hash: dict[str, str] = PrivateAttr(default_factory=dict)
+    _lock: threading.Lock = PrivateAttr(default_factory=threading.Lock)
+    _stop_requested: threading.Event = PrivateAttr(default_factory=threading.Event)
+    _watcher: threading.Thread | None = PrivateAttr(default=None)
+
+    def model_post_init(self, __context):
+        """Index the entries by content hash."""
+        self._by_hash = _hash_lookup(self.entries)
+
+    @classmethod
+    def Load(cls, root: Path = MediaRoot, index_path: Path = IndexPath):
+        """Load the persisted index and bring it up to date with the directory.
+
+        Args:
+            root (Path): The media directory.
+            index_path (Path): The persisted index.
+
+        Returns:
+            index (MediaIndex): The index.
+        """
+        try:
+            with open(index_path) as f:
+                index = cls.model_validate_json(f.read())
+            index.root = root
+            index.index_path = index_path
+        except (FileNotFoundError, ValueError):
+            index = cls(root=root, index_path=index_path)
+        index.refresh()
+        return index
+
+    def _walk(self) -> Iterator[os.DirEntry]:
+        suffixes = {f".{ext.lower()}" for ext in self.exts}
+        stack = [self.root]
+        while stack:
+            try:
+                with os.scandir(stack.pop()) as it:
+                    for entry in it:
+                        if entry.name.startswith("."):
+                            continue
+                        if entry.is_dir(follow_symlinks=False):
+                            stack.append(Path(entry.path))
+                        elif (
+                            entry.is_file()
+                            and os.path.splitext(entry.name)[1].lower() in suffixes
+                        ):
+                            yield entry
+            except FileNotFoundError:
+                continue
+
+    def _directories(self):
+        dirs = [self.root]
+        for dirpath, dirnames, _ in os.walk(self.root):
+            dirnames[:] = [d for d in dirnames if not d.startswith(".")]
+            dirs.extend(Path(dirpath) / d for d in dirnames)
+        return dirs
+
+    def refresh(self):
+        """Rescan the directory, hashing and probing only new or changed files.
+
+        Returns:
+            changed (bool): Whether the index changed.
+        """
+        with self._lock:
+            old = self.entries
+        entries: dict[str, MediaEntry] = {}
+        changed = False
+        for dir_entry in self._walk():
+            path = Path(dir_entry.path)
+            rel = path.relative_to(self.root).as_posix()
+            try:
+                stat = dir_entry.stat()
+            except FileNotFoundError:
+                continue
+            previous = old.get(rel)
+            if (
+                previous is not None
+                and previous.size == stat.st_size
+                and previous.mtime_ns == stat.st_mtime_ns
+            ):
+                entries[rel] = previous
+                continue
+            try:
+                content_hash = hash_file(path)
+            except OSError as e:
+                logger.warning(f"Could not hash {path}: {e!r}")
+                continue
+            try:
+                duration_ms = probe(path).duration_ms
+            except Exception as e:
+                logger.warning(f"Could not probe {path}: {e!r}")
+                duration_ms = None
+            entries[rel] = MediaEntry(
+                path=rel,
+                size=stat.st_size,
+                mtime_ns=stat.st_mtime_ns,
+                content_hash=content_hash,
+                duration_ms=duration_ms,
+            )
+            changed = True
+            logger.info(f"Indexed {rel}.")
+        changed = changed or entries.keys() != old.keys()
+        if not changed:
+            return False
+        by_hash = _hash_lookup(entries)
+        with self._lock:
+            self.entries = entries
+            self._by_hash = by_hash
+        self.save()
+        return True
+
+    def save(self):
+        """Atomically write the index to disk."""
+        try:
+            self.index_path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = self.index_path.with_suffix(".tmp")
+            with open(tmp, "w") as f:
+                f.write(self.model_dump_json(include={"entries"}))
+            os.replace(tmp, self.index_path)
+        except OSError as e:
+            logger.warning(f"Could not save the media index: {e!r}")
+
+    def get(self, path: str):
+        """Look up a file by its path relative to the media root.
+
+        Args:
+            path (str): The relative path.
+
+        Returns:
+            entry (MediaEntry | None): The entry, or None if it is not indexed.
+        """
+        return self.entries.get(Path(path).as_posix())
+
+    def find_by_hash(self, content_hash: str):
+        """Look up a file by its content hash.
+
+        Args:
+            content_hash (str): The hex sha256 digest.
+
+        Returns:
+            entry (MediaEntry | None): The first entry by path with those contents, or None.
+        """
+        path = self._by_hash.get(content_hash)
+        return None if path is None else self.entries.get(path)
+
+    @property
+    def paths(self):
+        """Get the absolute paths of the indexed files, ordered by relative path."""
+        return [self.root / rel for rel in sorted(self.entries)]
+
+    def select(self, preferred: str | None = None):
+        """Select a media file deterministically.
+
+        Args:
+            preferred (str | None): A relative path to use if it is indexed.
+
+        Returns:
+            path (Path | None): The preferred file if indexed, else the first by path, else None.
+        """
+        if preferred is not None and self.get(preferred) is not None:
+            return self.root / preferred
+        entries = self.entries
+        if not entries:
+            return None
+        return self.root / min(entries)
+
+    def watch(self, on_change: Callable[[], Any] | None = None):
+        """Keep the index current on a daemon thread.
+
+        Args:
+            on_change (Callable | None): Called after the index changes.
+        """
+        if self._watcher is not None and self._watcher.is_alive():
+            return
+        self._stop_requested.clear()
+        self._watcher = threading.Thread(
+            target=self._watch, args=(on_change,), name="media-index", daemon=True
+        )
+        self._watcher.start()
+
+    def stop(self):
+        """Stop watching the directory."""
+        self._stop_requested.set()
+        if self._watcher is not None:
+            self._watcher.join()
+            self._watcher = None
+
+    def _watch(self, on_change: Callable[[], Any] | None):
+        inotify = self._open_inotify()
+        try:
+            while not self._stop_requested.is_set():
+                changed = self._wait_for_change(inotify) and self.refresh()
+                if changed and on_change is not None:
+                    on_change()
+        finally:
+            if inotify is not None:
+                inotify.close()
+
+    def _open_inotify(self):
+        try:
+            inotify = _Inotify()
+        except (OSError, AttributeError) as e:
+            logger.info(f"inotify unavailable ({e!r}), polling the media directory.")
+            return None
+        for directory in self._directories():
+            inotify.watch(directory)
+        return inotify
+
+    def _wait_for_change(self, inotify: _Inotify | None):
+        if inotify is None:
+            # without inotify every poll is a possible change, unless stopped meanwhile
+            return not self._stop_requested.wait(self.poll_interval_s)
+        if not inotify.wait(1.0):
+            return False
+        # let a burst of events, e.g. a copy, finish before rescanning
+        while inotify.wait(self.settle_s):
+            pass
+        # pick up new subdirectories and drop removed ones
+        inotify.forget_missing()
+        for directory in self._directories():
+            inotify.watch(directory)
+        return True
@@ -0,0 +1,503 @@
+"""A low-overhead metrics registry with a Prometheus text endpoint and textfile export."""
+
+import abc
+import bisect
+import logging
+import math
+import os
+import threading
+from collections.abc import Callable, Iterator
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Any, TypeVar, cast
+
+import psutil
+from pydantic import BaseModel, Field, PrivateAttr
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS_MS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000)
+ERROR_BUCKETS_MS = (-10, -5, -2.5, -1, -0.5, -0.1, 0.1, 0.5, 1, 2.5, 5, 10)
+
+M = TypeVar("M", bound="Metric")
+
+
+def _format_labels(names: tuple[str, ...], values: tuple[str, ...], extra: str = ""):
+    pairs = [f'{n}="{v}"' for n, v in zip(names, values, strict=True)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float):
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value))
+
+
+class Metric(BaseModel, abc.ABC, arbitrary_types_allowed=True):
+    """A named metric, optionally split by labels.
+
+    Recorded values live in lists that are updated in place, and the recording state is
+    held in excluded fields rather than private attributes, whose access goes through
+    pydantic's `__getattr__` and costs several times more than the update itself. Recording
+    is then a lock, a list update and, for histograms, a bisect.
+    """
+
+    name: str
+    help: str = ""
+    labelnames: tuple[str, ...] = ()
+    values: list[float] = Field(
+        default_factory=lambda: [0.0],
+        exclude=True,
+        repr=False,
+        description="The recorded value; the running sum for histograms.",
+    )
+    children: dict[tuple[str, ...], "Metric"] = Field(
+        default_factory=dict, exclude=True, repr=False
+    )
+    lock: Any = Field(
+        default_factory=threading.Lock,
+        exclude=True,
+        repr=False,
+        description="The `threading.Lock` guarding the values.",
+    )
+
+    @property
+    @abc.abstractmethod
+    def kind(self) -> str:
+        """Get the Prometheus metric type."""
+
+    def labels(self: M, *values: str) -> M:
+        """Get the child metric for a set of label values, creating it if needed.
+
+        Args:
+            *values (str): The label values, in the order of `labelnames`.
+
+        Returns:
+            metric (Metric): The child metric, of the same type as this one.
+        """
+        key = tuple(str(v) for v in values)
+        child = self.children.get(key)
+        if child is None:
+            with self.lock:
+                child = self.children.get(key)
+                if child is None:
+                    child = self.children[key] = type(self)(
+                        **self.model_dump(exclude={"labelnames"})
+                    )
+        return cast(M, child)
+
+    @abc.abstractmethod
+    def samples(self) -> Iterator[tuple[str, str, float]]:
+        """Get the exposed samples as (name suffix, labels, value)."""
+
+    def render(self):
+        """Render the metric in the Prometheus text exposition format.
+
+        Returns:
+            text (str): The metric's lines.
+        """
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        children = sorted(self.children.items()) if self.labelnames else [((), self)]
+        for values, child in children:
+            for suffix, extra, value in child.samples():
+                labels = _format_labels(self.labelnames, values, extra)
+                lines.append(f"{self.name}{suffix}{labels} {_format_value(value)}")
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    """A monotonically increasing count."""
+
+    @property
+    def kind(self):
+        """Get the Prometheus metric type."""
+        return "counter"
+
+    @property
+    def value(self):
+        """Get the count."""
+        return self.values[0]
+
+    def inc(self, amount: float = 1.0):
+        """Increase the count.
+
+        Args:
+            amount (float): How much to increase it by.
+        """
+        with self.lock:
+            self.values[0] += amount
+
+    def samples(self):
+        """Get the exposed samples."""
+        yield "_total", "", self.values[0]
+
+
+class Gauge(Metric):
+    """A value that can go up and down."""
+
+    @property
+    def kind(self):
+        """Get the Prometheus metric type."""
+        return "gauge"
+
+    @property
+    def value(self):
+        """Get the value."""
+        return self.values[0]
+
+    def set(self, value: float):
+        """Set the value.
+
+        Args:
+            value (float): The value.
+        """
+        self.values[0] = value
+
+    def samples(self):
+        """Get the exposed samples."""
+        yield "", "", self.values[0]
+
+
+class Histogram(Metric):
+    """Counts observations into cumulative buckets."""
+
+    buckets: tuple[float, ...] = Field(
+        default=LATENCY_BUCKETS_MS, description="The upper bounds of the buckets."
+    )
+    counts: list[int] = Field(
+        default_factory=list,
+        exclude=True,
+        repr=False,
+        description="The count per bucket, plus one for +Inf.",
+    )
+
+    def model_post_init(self, __context):
+        """Allocate the bucket counts."""
+        self.counts = [0] * (len(self.buckets) + 1)
+
+    @property
+    def kind(self):
+        """Get the Prometheus metric type."""
+        return "histogram"
+
+    @property
+    def count(self):
+        """Get the number of observations."""
+        return sum(self.counts)
+
+    @property
+    def sum(self):
+        """Get the sum of the observations."""
+        return self.values[0]
+
+    def observe(self, value: float):
+        """Record an observation.
+
+        Args:
+            value (float): The observed value.
+        """
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[i] += 1
+            self.values[0] += value
+
+    def quantile(self, q: float):
+        """Estimate a quantile by linear interpolation within its bucket.
+
+        Args:
+            q (float): The quantile, from 0 to 1.
+
+        Returns:
+            value (float): The estimate, or NaN if there are no observations.
+        """
+        counts = list(self.counts)
+        total = sum(counts)
+        if total == 0:
+            return math.nan
+        rank = q * total
+        cumulative = 0
+        for i, count in enumerate(counts):
+            if cumulative + count >= rank and count > 0:
+                if i == len(self.buckets):
+                    return self.buckets[-1]
+                lower = self.buckets[i - 1] if i > 0 else min(0.0, self.buckets[0])
+                return lower + (self.buckets[i] - lower) * (rank - cumulative) / count
+            cumulative += count
+        return self.buckets[-1]
+
+    def samples(self):
+        """Get the exposed samples."""
+        cumulative = 0
+        for bound, count in zip((*self.buckets, math.inf), self.counts, strict=True):
+            cumulative += count
+            yield "_bucket", f'le="{_format_value(bound)}"', cumulative
+        yield "_sum", "", self.values[0]
+        yield "_count", "", cumulative
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):  # noqa: A002
+        pass
+
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        data = cast(_MetricsServer, self.server).registry.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class _MetricsServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address: tuple[str, int], registry: "MetricsRegistry"):
+        super().__init__(address, _MetricsHandler)
+        self.registry = registry
+
+
+class MetricsRegistry(BaseModel):
+    """The metrics of the process.
+
+    Metrics are created once, typically at import time, and recorded on the hot path.
+    Collectors run only when the metrics are rendered, for values such as CPU and memory
+    use that are cheaper to read on demand than to keep current.
+    """
+
+    _metrics: dict[str, Metric] = PrivateAttr(default_factory=dict)
+    _collectors: list[Callable[[], None]] = PrivateAttr(default_factory=list)
+    _lock: threading.Lock = PrivateAttr(default_factory=threading.Lock)
+    _server: _MetricsServer | None = PrivateAttr(default=None)
+    _exporter: threading.Thread | None = PrivateAttr(default=None)
+    _stop_requested: threading.Event = PrivateAttr(default_factory=threading.Event)
+
+    def _register(self, cls: type[M], name: str, **kwargs) -> M:
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name=name, **kwargs)
+            elif not isinstance(metric, cls):
+                msg = f"{name} is already registered as a {metric.kind}."
+                raise ValueError(msg)
+        return metric
+
+    def counter(
+        self,
+        name: str,
+        help: str = "",  # noqa: A002
+        labelnames: tuple[str, ...] = (),
+    ):
+        """Get or create a counter.
+
+        Args:
+            name (str): The metric name, without the `_total` suffix.
+            help (str): The description.
+            labelnames (tuple[str, ...]): The label names.
+
+        Returns:
+            counter (Counter): The counter.
+        """
+        return self._register(Counter, name, help=help, labelnames=labelnames)
+
+    def gauge(
+        self,
+        name: str,
+        help: str = "",  # noqa: A002
+        labelnames: tuple[str, ...] = (),
+    ):
+        """Get or create a gauge.
+
+        Args:
+            name (str): The metric name.
+            help (str): The description.
+            labelnames (tuple[str, ...]): The label names.
+
+        Returns:
+            gauge (Gauge): The gauge.
+        """
+        return self._register(Gauge, name, help=help, labelnames=labelnames)
+
+    def histogram(
+        self,
+        name: str,
+        help: str = "",  # noqa: A002
+        labelnames: tuple[str, ...] = (),
+        buckets: tuple[float, ...] = LATENCY_BUCKETS_MS,
+    ):
+        """Get or create a histogram.
+
+        Args:
+            name (str): The metric name.
+            help (str): The description.
+            labelnames (tuple[str, ...]): The label names.
+            buckets (tuple[float, ...]): The upper bounds of the buckets, ascending.
+
+        Returns:
+            histogram (Histogram): The histogram.
+        """
+        return self._register(
+            Histogram, name, help=help, labelnames=labelnames, buckets=buckets
+        )
+
+    def add_collector(self, collector: Callable[[], None]):
+        """Run a callable before every render, e.g. to refresh gauges.
+
+        Args:
+            collector (Callable[[], None]): The collector.
+        """
+        self._collectors.append(collector)
+
+    def get(self, name: str):
+        """Look up a metric by name.
+
+        Args:
+            name (str): The metric name.
+
+        Returns:
+            metric (Metric | None): The metric, or None if it is not registered.
+        """
+        return self._metrics.get(name)
+
+    def render(self):
+        """Render all metrics in the Prometheus text exposition format.
+
+        Returns:
+            text (str): The exposition.
+        """
+        for collector in self._collectors:
+            try:
+                collector()
+            except Exception as e:
+                logger.warning(f"Metrics collector failed: {e!r}")
+        with self._lock:
+            metrics = sorted(self._metrics.values(), key=lambda m: m.name)
+        return "\n".join(metric.render() for metric in metrics) + "\n"
+
+    def write_textfile(self, path: Path):
+        """Atomically write the metrics for node_exporter's textfile collector.
+
+        Args:
+            path (Path): The `.prom` file to write.
+        """
+        tmp = path.with_suffix(".tmp")
+        with open(tmp, "w") as f:
+            f.write(self.render())
+        os.replace(tmp, path)
+
+    def serve(self, port: int, host: str = "127.0.0.1"):
+        """Serve the metrics over HTTP on a daemon thread, if not already serving.
+
+        Args:
+            port (int): The port; 0 picks a free one.
+            host (str): The address to bind.
+
+        Returns:
+            address (tuple[str, int]): The bound address.
+        """
+        if self._server is None:
+            self._server = _MetricsServer((host, port), self)
+            threading.Thread(
+                target=self._server.serve_forever, name="metrics", daemon=True
+            ).start()
+            logger.info(f"Serving metrics on {self._server.server_address}.")
+        return self._server.server_address
+
+    def export_textfile(self, path: Path, interval_s: float = 15.0):
+        """Write the textfile periodically on a daemon thread, if not already exporting.
+
+        Args:
+            path (Path): The `.prom` file to write.
+            interval_s (float): How often to write it in s.
+        """
+        if self._exporter is not None and self._exporter.is_alive():
+            return
+
+        def run():
+            while not self._stop_requested.wait(interval_s):
+                try:
+                    self.write_textfile(path)
+                except OSError as e:
+                    logger.warning(f"Failed to write metrics to {path}: {e!r}")
+
+        self._stop_requested.clear()
+        self._exporter = threading.Thread(
+            target=run, name="metrics-export", daemon=True
+        )
+        self._exporter.start()
+
+    def stop(self):
+        """Stop serving and exporting."""
+        self._stop_requested.set()
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+        if self._exporter is not None:
+            self._exporter.join()
+            self._exporter = None
+
+
+REGISTRY = MetricsRegistry()
+
+SYNC_RTT_MS = REGISTRY.histogram(
+    "ak_sync_rtt_ms", "Round trip time of sync exchanges in ms.", ("transport",)
+)
+SYNC_RESIDUAL_MS = REGISTRY.histogram(
+    "ak_sync_offset_residual_ms",
+    "Offset of each sync sample from the fitted clock model in ms.",
+    buckets=ERROR_BUCKETS_MS,
+)
+SYNC_FAILURES = REGISTRY.counter(
+    "ak_sync_failures", "Sync exchanges that failed.", ("transport",)
+)
+CLOCK_OFFSET_MS = REGISTRY.gauge(
+    "ak_clock_offset_ms", "The estimated offset of the server clock in ms."
+)
+CLOCK_SKEW_PPM = REGISTRY.gauge(
+    "ak_clock_skew_ppm", "The estimated drift of the server clock in ppm."
+)
+CLOCK_ERROR_MS = REGISTRY.gauge(
+    "ak_clock_error_ms", "The 95% error of the clock estimate when last fitted in ms."
+)
+STEP_LATENCY_MS = REGISTRY.histogram(
+    "ak_player_step_latency_ms",
+    "How late the audio state machine ran after its deadline in ms.",
+    ("state",),
+)
+STEP_DURATION_MS = REGISTRY.histogram(
+    "ak_player_step_duration_ms",
+    "How long an audio state machine step took in ms.",
+    ("state",),
+)
+LOOP_START_ERROR_MS = REGISTRY.histogram(
+    "ak_loop_start_error_ms",
+    "How far each loop start was from its target in ms.",
+    ("gapless",),
+    buckets=ERROR_BUCKETS_MS,
+)
+HTTP_FAILURES = REGISTRY.counter(
+    "ak_http_failures",
+    "Requests to the server that failed, by status code or 'transport'.",
+    ("status",),
+)
+PROCESS_CPU_SECONDS = REGISTRY.counter(
+    "process_cpu_seconds", "User and system CPU time of the process in s."
+)
+PROCESS_RSS_BYTES = REGISTRY.gauge(
+    "process_resident_memory_bytes", "Resident memory of the process in bytes."
+)
+
+
+def _collect_process():
+    process = psutil.Process()
+    cpu = process.cpu_times()
+    PROCESS_CPU_SECONDS.values[0] = cpu.user + cpu.system
+    PROCESS_RSS_BYTES.set(process.memory_info().rss)
+
+
+REGISTRY.add_collector(_collect_process)
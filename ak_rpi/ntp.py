@@ -1,102 +1,442 @@
 """A module for performing NTP sync."""
 
+import abc
 import logging
-import time
+import math
+import random
+import threading
+from collections import deque
+from collections.abc import Callable
 
-from pydantic import BaseModel, Field, ValidationError
+import httpx
+from pydantic import BaseModel, Field, PrivateAttr, ValidationError
 
 from ak_rpi.client import Client
+from ak_rpi.metrics import (
+    CLOCK_ERROR_MS,
+    CLOCK_OFFSET_MS,
+    CLOCK_SKEW_PPM,
+    SYNC_FAILURES,
+    SYNC_RESIDUAL_MS,
+    SYNC_RTT_MS,
+)
+from ak_rpi.timebase import NS_PER_MS, monotonic_ns, wall_ns
 
 logger = logging.getLogger(__name__)
 
 
-def monotonic_time_ms():
-    """Get the monotonic time."""
-    # return int(time.monotonic() * 1000)
-    return int(time.perf_counter() * 1000)
+class Clock(BaseModel):
+    """The local clocks NTP reads; replaced with a simulated oscillator in tests."""
 
+    def monotonic_ns(self) -> int:
+        """Get the monotonic time in ns, see `ak_rpi.timebase.monotonic_ns`."""
+        return monotonic_ns()
 
-class NTP(BaseModel):
-    """A class for performing NTP sync."""
+    def wall_ns(self) -> int:
+        """Get the wall-clock time in ns, see `ak_rpi.timebase.wall_ns`."""
+        return wall_ns()
+
+
+class ServerClock(BaseModel):
+    """Converts between the local monotonic clock and server time.
+
+    Local time is the wall clock read once at startup, advanced by the monotonic clock,
+    so it does not step when the system clock is set. Server time is local time plus the
+    offset predicted by `clock_model`, or `server_time_offset` without one.
+    """
 
     server_time_offset: int = Field(
         default=0, description="The offset between the server and the player in ms."
     )
+    startup_time_ns: int = Field(
+        default_factory=wall_ns,
+        description="The time the player started up in ns.",
+    )
+    startup_time_monotonic_ns: int = Field(
+        default_factory=monotonic_ns,
+        description="The time the player started up in monotonic ns.",
+    )
+    clock: Clock = Field(
+        default_factory=Clock,
+        description="The local clocks; `startup_time_ns` and `startup_time_monotonic_ns` must be read from it too if it is replaced.",
+    )
+
+    @property
+    def clock_model(self) -> "ClockModel | None":
+        """Get the clock model server time is predicted from.
+
+        Returns:
+            model (ClockModel | None): The clock model, or None to use `server_time_offset`.
+        """
+        return None
+
+    @property
+    def local_time(self):
+        """Get the local time in whole ms."""
+        return math.floor(self.precise_local_time)
+
+    @property
+    def precise_local_time(self):
+        """Get the local time with sub-millisecond precision.
+
+        Returns:
+            local_time (float): The local time in ms, on the same scale as `local_time`.
+        """
+        monotonic_time_ns = self.clock.monotonic_ns()
+        return (
+            monotonic_time_ns - self.startup_time_monotonic_ns + self.startup_time_ns
+        ) / NS_PER_MS
+
+    @property
+    def startup_offset_ms(self):
+        """Get how far local time is ahead of the monotonic clock in ms."""
+        return (self.startup_time_ns - self.startup_time_monotonic_ns) / NS_PER_MS
+
+    def local_from_monotonic(self, monotonic_time: float):
+        """Convert a local monotonic time to local time.
+
+        Args:
+            monotonic_time (float): The monotonic time in ms.
+
+        Returns:
+            local_time (float): The local time in ms.
+        """
+        return monotonic_time + self.startup_offset_ms
+
+    def monotonic_from_server_time(self, server_time: float):
+        """Convert a server time to the local monotonic clock.
+
+        Args:
+            server_time (float): The server time in ms.
+
+        Returns:
+            monotonic_time (float): The equivalent monotonic time in ms.
+        """
+        model = self.clock_model
+        if model is None:
+            local_time = server_time - self.server_time_offset
+        else:
+            local_time = model.local_time_at(server_time)
+        return local_time - self.startup_offset_ms
+
+    def server_time_from_monotonic(self, monotonic_time: float):
+        """Convert a local monotonic time to server time.
+
+        Args:
+            monotonic_time (float): The monotonic time in ms.
+
+        Returns:
+            server_time (float): The equivalent server time in ms.
+        """
+        local_time = self.local_from_monotonic(monotonic_time)
+        model = self.clock_model
+        if model is None:
+            return local_time + self.server_time_offset
+        return model.server_time_at(local_time)
+
+    @property
+    def server_time(self):
+        """Get the server time.
+
+        Extrapolates the offset using the fitted skew when a clock model is available.
+        """
+        local_time = self.local_time
+        model = self.clock_model
+        if model is None:
+            return local_time + self.server_time_offset
+        return local_time + round(model.offset_at(local_time))
+
+
+class NTP(ServerClock):
+    """A class for performing NTP sync."""
+
     n_cyles: int = Field(default=20, description="The number of cycles to perform.")
-    startup_time: int = Field(
-        default_factory=lambda: int(time.time() * 1000),
-        description="The time the player started up in ms.",
+    policy: "SyncPolicy" = Field(
+        default_factory=lambda: SyncPolicy(),
+        description="The policy deciding when to sync and how many samples to take.",
     )
-    startup_time_monotonic: int = Field(
-        default_factory=monotonic_time_ms,
-        description="The time the player started up in monotonic ms.",
+    estimator: "ClockEstimator" = Field(
+        default_factory=lambda: ClockEstimator(),
+        description="The estimator fitting offset and skew from sync samples.",
     )
     client: Client
+    transport: "SyncTransport | None" = Field(
+        default=None,
+        description="How sync exchanges reach the server; HTTP through `client` if not provided.",
+    )
+    _model: "ClockModel | None" = PrivateAttr(default=None)
+    _sync_lock: threading.Lock = PrivateAttr(default_factory=threading.Lock)
+    _sync_requested: threading.Event = PrivateAttr(default_factory=threading.Event)
+    _stop_requested: threading.Event = PrivateAttr(default_factory=threading.Event)
+    _worker: threading.Thread | None = PrivateAttr(default=None)
 
     @property
-    def local_time(self):
-        """Get the local time."""
-        return self.startup_time + (monotonic_time_ms() - self.startup_time_monotonic)
-
-    def sync(self):
-        """Perform an NTP sync algorithm which will determine the offset between the server and the player."""
-        res = [self.sync_cycle() for _ in range(self.n_cyles)]
-        offsets: list[float] = [offset for offset in res if offset is not None]
-        if len(offsets) == 0:
+    def sync_transport(self):
+        """Get the transport sync exchanges are made over, defaulting to HTTP.
+
+        Returns:
+            transport (SyncTransport): The transport.
+        """
+        if self.transport is None:
+            self.transport = HTTPSyncTransport(client=self.client)
+        return self.transport
+
+    def sync(self, n_cycles: int | None = None):
+        """Perform an NTP sync algorithm which will determine the offset between the server and the player.
+
+        The new offset is published with a single assignment, so readers of `server_time`
+        never observe a partially updated estimate.
+
+        Args:
+            n_cycles (int | None): The number of exchanges to perform; defaults to `n_cyles`.
+        """
+        with self._sync_lock:
+            return self._sync(n_cycles or self.n_cyles)
+
+    def _sync(self, n_cycles: int):
+        self.policy.record_requests(n_cycles, self.local_time)
+        res = [self.sample() for _ in range(n_cycles)]
+        samples = [sample for sample in res if sample is not None]
+        if len(samples) == 0:
             logger.error("Failed to get any offsets.")
             return self.server_time_offset
-        average_offset = sum(offsets) / len(offsets)
-        std_offset = sum((offset - average_offset) ** 2 for offset in offsets) / len(
-            offsets
-        )
-        non_outliers = [
-            offset for offset in offsets if abs(offset - average_offset) < std_offset
-        ]
-        if len(non_outliers) == 0:
-            logger.error("Failed to get any non-outliers.")
+        model = self.estimator.update(samples)
+        if model is None:
+            logger.error("Failed to fit a clock model.")
             return self.server_time_offset
-        average_offset_no_outliers = sum(non_outliers) / len(non_outliers)
-        self.server_time_offset = int(average_offset_no_outliers)
-        return int(average_offset_no_outliers)
+        self._model = model
+        self.server_time_offset = int(model.offset)
+        for sample in samples:
+            SYNC_RESIDUAL_MS.observe(sample.offset - model.offset_at(sample.local_time))
+        CLOCK_OFFSET_MS.set(model.offset)
+        CLOCK_SKEW_PPM.set(model.skew * 1e6)
+        CLOCK_ERROR_MS.set(model.ci)
+        logger.info(
+            f"Clock model: offset={model.offset:.2f}ms "
+            f"skew={model.skew * 1e6:.2f}ppm ci=+/-{model.ci:.2f}ms "
+            f"(n={model.n_samples}, min_rtt={model.min_rtt:.1f}ms)"
+        )
+        return self.server_time_offset
+
+    def sample(self):
+        """Perform a single NTP exchange over the sync transport.
+
+        Returns:
+            sample (ClockSample | None): The sample, or None if the exchange failed.
+        """
+        transport = self.sync_transport
+        sample = transport.exchange(lambda: self.precise_local_time)
+        if sample is None:
+            SYNC_FAILURES.labels(type(transport).__name__).inc()
+        else:
+            SYNC_RTT_MS.labels(type(transport).__name__).observe(sample.rtt)
+        return sample
 
     def sync_cycle(self):
         """Perform a single NTP sync cycle."""
-        local_time_at_req = self.local_time
-        response = self.client.get_sync(local_time_at_req)
-        local_time_at_res = self.local_time
+        sample = self.sample()
+        return None if sample is None else sample.offset
+
+    def restore(self, model: "ClockModel", samples: "list[ClockSample]"):
+        """Restore a previously fitted clock estimate, e.g. from a snapshot.
+
+        The estimate is used immediately but a sync is requested, since the system
+        clock may have stepped while the player was off.
+
+        Args:
+            model (ClockModel): The clock model.
+            samples (list[ClockSample]): The estimator's window of samples.
+        """
+        with self._sync_lock:
+            self.estimator.samples.clear()
+            self.estimator.samples.extend(samples)
+            self._model = model
+            self.server_time_offset = int(model.offset_at(self.local_time))
+        self.request_sync()
+
+    def set_transport(self, transport: "SyncTransport | None"):
+        """Sync over another transport from now on, e.g. a peer's rather than the server's.
+
+        Samples against a different reference would bias the fit, so the estimator starts
+        afresh; the current model stays in use until the first sync over the new
+        transport, which is requested straight away. A sync in progress is finished first.
+
+        Args:
+            transport (SyncTransport | None): The transport; HTTP through `client` if None.
+        """
+        with self._sync_lock:
+            self.transport = transport
+            self.estimator.samples.clear()
+        self.request_sync()
+
+    @property
+    def clock_model(self):
+        """Get the most recently published clock model.
+
+        Returns:
+            model (ClockModel | None): The clock model, or None if no sync has succeeded yet.
+        """
+        return self._model
+
+    @property
+    def needs_sync(self):
+        """Whether the predicted error of the current estimate exceeds the policy's target.
+
+        Returns:
+            needs_sync (bool): True if a sync is due.
+        """
+        model = self._model
+        if model is None:
+            return True
+        return model.ci_at(self.local_time) > self.policy.target_error_ms
+
+    def start_background_sync(self):
+        """Start a daemon thread which keeps the offset estimate fresh.
+
+        The worker syncs whenever the `policy` says the estimate is about to become too
+        uncertain, or sooner if `request_sync` is called.
+        """
+        if self._worker is not None and self._worker.is_alive():
+            return
+        self._stop_requested.clear()
+        self._worker = threading.Thread(
+            target=self._background_sync, name="ntp-sync", daemon=True
+        )
+        self._worker.start()
+
+    def stop_background_sync(self):
+        """Stop the background sync thread."""
+        self._stop_requested.set()
+        self._sync_requested.set()
+        if self._worker is not None:
+            self._worker.join()
+            self._worker = None
+
+    def request_sync(self):
+        """Ask the background worker to sync as soon as the request budget allows.
+
+        Does not wait for the sync. A requested sync takes no more samples than the
+        policy's hourly budget has left, and none at all while it is exhausted.
+        """
+        self._sync_requested.set()
+
+    def _background_sync(self):
+        while not self._stop_requested.is_set():
+            self.policy.plan(self._model, self.estimator, self.local_time)
+            self._sync_requested.wait(self.policy.next_interval_ms / 1000)
+            self._sync_requested.clear()
+            if self._stop_requested.is_set():
+                break
+            # a requested sync skips the planned wait, so the budget is checked again
+            n_samples = self.policy.samples_within_budget(self.local_time)
+            if n_samples == 0:
+                self.policy.plan(self._model, self.estimator, self.local_time)
+                logger.warning(
+                    "Sync requested but the request budget is exhausted, next sync in "
+                    f"{self.policy.next_interval_ms / 1000:.1f}s."
+                )
+                self._stop_requested.wait(self.policy.next_interval_ms / 1000)
+                continue
+            try:
+                self.sync(n_samples)
+            except Exception as e:
+                logger.exception("Background sync failed.", exc_info=e)
+
+
+class SyncTransport(BaseModel, abc.ABC, arbitrary_types_allowed=True):
+    """A way of exchanging timestamps with the server."""
+
+    @abc.abstractmethod
+    def exchange(self, clock: Callable[[], float]) -> "ClockSample | None":
+        """Perform a single exchange.
+
+        Args:
+            clock (Callable[[], float]): Reads the local time in ms.
+
+        Returns:
+            sample (ClockSample | None): The sample, or None if the exchange failed.
+        """
+
+    def close(self):
+        """Release any resources held by the transport."""
+
+
+class HTTPSyncTransport(SyncTransport):
+    """Exchanges timestamps with the server's `/api/sync` endpoint.
+
+    The endpoint works in whole milliseconds, and request handling on both ends adds
+    jitter to every sample.
+    """
+
+    client: Client
+    server_truncation_ms: float = Field(
+        default=0.5,
+        ge=0,
+        description=(
+            "How early the server's timestamps are on average in ms; 0.5 for a server "
+            "truncating to whole ms as `Date.now()` does."
+        ),
+    )
+
+    def exchange(self, clock: Callable[[], float]):
+        """Perform a single exchange.
+
+        Args:
+            clock (Callable[[], float]): Reads the local time in ms.
+
+        Returns:
+            sample (ClockSample | None): The sample, or None if the exchange failed.
+        """
+        # the endpoint takes and echoes whole ms, but the local ends of the exchange
+        # need not be truncated; the server's own timestamps are truncated, which
+        # `server_truncation_ms` compensates for on average
+        local_time_at_req = clock()
+        try:
+            response = self.client.get_sync(int(local_time_at_req))
+        except httpx.HTTPError as e:
+            logger.warning(f"Sync exchange failed: {e!r}")
+            return None
+        local_time_at_res = clock()
         if response.status_code != 200:
             logger.error(
                 f"Failed to get sync response: {response.status_code}, {response.text}"
             )
             return None
         try:
-            sync_res = SyncResponse(**response.json(), resReceivedAt=local_time_at_res)
+            sync_res = SyncResponse(**{
+                **response.json(),
+                "reqSentAt": local_time_at_req,
+                "resReceivedAt": local_time_at_res,
+            })
         except ValidationError as e:
             logger.exception("Failed to parse sync response", exc_info=e)
             return None
-        return sync_res.offset
-
-    @property
-    def server_time(self):
-        """Get the server time."""
-        return self.local_time + self.server_time_offset
+        return ClockSample(
+            local_time=(sync_res.reqSentAt + sync_res.resReceivedAt) / 2,
+            offset=sync_res.offset + self.server_truncation_ms,
+            rtt=sync_res.round_trip,
+        )
 
 
 class SyncResponse(BaseModel):
     """A response from the server."""
 
-    reqSentAt: int
+    reqSentAt: float
     reqReceivedAt: int
     resSentAt: int
-    resReceivedAt: int
+    resReceivedAt: float
 
     @property
-    def oneway_latency(self):
-        """Get the offset between the server and the player."""
-        round_trip = (self.resReceivedAt - self.reqSentAt) - (
+    def round_trip(self):
+        """Get the network round trip time, excluding server processing time."""
+        return (self.resReceivedAt - self.reqSentAt) - (
             self.resSentAt - self.reqReceivedAt
         )
-        return round_trip / 2
+
+    @property
+    def oneway_latency(self):
+        """Get the offset between the server and the player."""
+        return self.round_trip / 2
 
     @property
     def offset(self):
@@ -104,3 +444,345 @@ class SyncResponse(BaseModel):
         expected_server_receipt_time = self.reqSentAt + self.oneway_latency
         server_leads_by = self.reqReceivedAt - expected_server_receipt_time
         return server_leads_by
+
+
+class ClockSample(BaseModel):
+    """A single offset measurement."""
+
+    local_time: float = Field(
+        ..., description="The local time at the midpoint of the exchange in ms."
+    )
+    offset: float = Field(..., description="The measured server offset in ms.")
+    rtt: float = Field(..., description="The network round trip time in ms.")
+
+
+class ClockModel(BaseModel, frozen=True):
+    """A fitted linear model of the server offset as a function of local time."""
+
+    offset: float = Field(..., description="The offset at the reference time in ms.")
+    skew: float = Field(..., description="The drift of the offset in ms per local ms.")
+    reference_time: float = Field(
+        ..., description="The local time the model is centered on in ms."
+    )
+    sigma: float = Field(
+        ..., description="The weighted residual standard deviation in ms."
+    )
+    offset_se: float = Field(
+        ..., description="The standard error of the offset at the reference time in ms."
+    )
+    skew_se: float = Field(..., description="The standard error of the skew.")
+    n_samples: int
+    min_rtt: float = Field(
+        ..., description="The lowest round trip time in the window in ms."
+    )
+
+    def offset_at(self, local_time: float):
+        """Extrapolate the offset to a local time.
+
+        Args:
+            local_time (float): The local time in ms.
+
+        Returns:
+            offset (float): The predicted offset in ms.
+        """
+        return self.offset + self.skew * (local_time - self.reference_time)
+
+    def server_time_at(self, local_time: float):
+        """Convert a local time to server time.
+
+        Args:
+            local_time (float): The local time in ms.
+
+        Returns:
+            server_time (float): The predicted server time in ms.
+        """
+        return local_time + self.offset_at(local_time)
+
+    def local_time_at(self, server_time: float):
+        """Convert a server time to local time.
+
+        Args:
+            server_time (float): The server time in ms.
+
+        Returns:
+            local_time (float): The local time in ms.
+        """
+        # inverts server = local + offset + skew * (local - reference) exactly
+        return (server_time - self.offset + self.skew * self.reference_time) / (
+            1 + self.skew
+        )
+
+    def ci_at(self, local_time: float, z: float = 1.96):
+        """Get the confidence interval half-width of the offset at a local time.
+
+        Args:
+            local_time (float): The local time in ms.
+            z (float): The normal quantile of the interval; 1.96 gives a 95% interval.
+
+        Returns:
+            ci (float): The half-width of the interval in ms.
+        """
+        dt = local_time - self.reference_time
+        return z * math.sqrt(self.offset_se**2 + (self.skew_se * dt) ** 2)
+
+    @property
+    def ci(self):
+        """Get the 95% confidence interval half-width at the reference time in ms."""
+        return self.ci_at(self.reference_time)
+
+
+class ClockEstimator(BaseModel):
+    """Fits offset and skew to a sliding window of low-latency samples.
+
+    Each burst is filtered down to its lowest-RTT samples, since queueing delay only ever
+    adds latency and asymmetric delay is what corrupts an offset measurement.
+    The retained samples are weighted by the inverse square of their RTT and fitted with
+    weighted least squares; the skew is only estimated once the window spans enough time
+    for it to be identifiable.
+    """
+
+    window_size: int = Field(
+        default=64, gt=1, description="The number of samples to retain."
+    )
+    keep_fraction: float = Field(
+        default=0.5,
+        gt=0,
+        le=1,
+        description="The fraction of each burst, by lowest RTT, to retain.",
+    )
+    min_rtt_floor: float = Field(
+        default=1.0,
+        gt=0,
+        description="The lowest RTT used when weighting samples in ms.",
+    )
+    min_skew_span_ms: float = Field(
+        default=30000,
+        ge=0,
+        description="The time span the window must cover before skew is estimated in ms.",
+    )
+    max_abs_skew: float = Field(
+        default=500e-6,
+        ge=0,
+        description="The largest plausible skew; fits beyond this are clamped.",
+    )
+    samples: deque[ClockSample] = Field(default_factory=deque)
+
+    def update(self, burst: list[ClockSample]):
+        """Add a burst of samples to the window and refit the model.
+
+        Args:
+            burst (list[ClockSample]): The samples from a sync burst.
+
+        Returns:
+            model (ClockModel | None): The fitted model, or None if there are no samples.
+        """
+        n_keep = max(1, math.ceil(len(burst) * self.keep_fraction))
+        best = sorted(burst, key=lambda sample: sample.rtt)[:n_keep]
+        self.samples.extend(sorted(best, key=lambda sample: sample.local_time))
+        while len(self.samples) > self.window_size:
+            self.samples.popleft()
+        return self.fit()
+
+    def fit(self):
+        """Fit the model to the current window.
+
+        Returns:
+            model (ClockModel | None): The fitted model, or None if there are no samples.
+        """
+        samples = list(self.samples)
+        n = len(samples)
+        if n == 0:
+            return None
+        ts = [sample.local_time for sample in samples]
+        ys = [sample.offset for sample in samples]
+        ws = [1 / max(sample.rtt, self.min_rtt_floor) ** 2 for sample in samples]
+        w_sum = sum(ws)
+        t_mean = sum(w * t for w, t in zip(ws, ts, strict=True)) / w_sum
+        y_mean = sum(w * y for w, y in zip(ws, ys, strict=True)) / w_sum
+        dts = [t - t_mean for t in ts]
+        sxx = sum(w * dt * dt for w, dt in zip(ws, dts, strict=True))
+        fit_skew = n > 2 and max(ts) - min(ts) >= self.min_skew_span_ms and sxx > 0
+        skew = 0.0
+        if fit_skew:
+            sxy = sum(
+                w * dt * (y - y_mean) for w, dt, y in zip(ws, dts, ys, strict=True)
+            )
+            skew = min(max(sxy / sxx, -self.max_abs_skew), self.max_abs_skew)
+        n_params = 2 if fit_skew else 1
+        ssr = sum(
+            w * (y - y_mean - skew * dt) ** 2
+            for w, dt, y in zip(ws, dts, ys, strict=True)
+        )
+        # without residual degrees of freedom, bound the error by half the round trip
+        sigma2 = (
+            ssr / (n - n_params) * n / w_sum
+            if n > n_params
+            else max(samples[0].rtt, self.min_rtt_floor) ** 2 / 4
+        )
+        offset_se = math.sqrt(sigma2 / n)
+        skew_se = math.sqrt(sigma2 * w_sum / n / sxx) if fit_skew else 0.0
+        return ClockModel(
+            offset=y_mean,
+            skew=skew,
+            reference_time=t_mean,
+            sigma=math.sqrt(sigma2),
+            offset_se=offset_se,
+            skew_se=skew_se,
+            n_samples=n,
+            min_rtt=min(sample.rtt for sample in samples),
+        )
+
+
+class SyncPolicy(BaseModel):
+    """Decides when to sync and how many samples to take from the observed clock behaviour.
+
+    The interval is the time until the model's confidence interval is predicted to grow
+    past `target_error_ms`, and the burst size is chosen so the burst alone can meet the
+    target given the measured jitter. Both are clamped, held within a per-player request
+    budget, and randomly jittered so that a fleet of players does not sync in lockstep.
+    The most recent plan is kept on the model for inspection.
+    """
+
+    target_error_ms: float = Field(
+        default=5.0, gt=0, description="The largest acceptable 95% error in ms."
+    )
+    min_interval_ms: int = Field(
+        default=10000, gt=0, description="The shortest interval between syncs in ms."
+    )
+    max_interval_ms: int = Field(
+        default=900000, gt=0, description="The longest interval between syncs in ms."
+    )
+    min_samples: int = Field(
+        default=4, gt=0, description="The smallest number of samples per sync."
+    )
+    max_samples: int = Field(
+        default=20, gt=0, description="The largest number of samples per sync."
+    )
+    prior_skew: float = Field(
+        default=50e-6,
+        ge=0,
+        description="The skew assumed before it has been estimated.",
+    )
+    budget_per_hour: int = Field(
+        default=600, gt=0, description="The most sync requests allowed per hour."
+    )
+    jitter_fraction: float = Field(
+        default=0.2,
+        ge=0,
+        lt=1,
+        description="The relative random jitter applied to each interval.",
+    )
+    next_interval_ms: float = Field(
+        default=0, description="The planned delay until the next sync in ms."
+    )
+    next_samples: int = Field(
+        default=20, description="The planned number of samples for the next sync."
+    )
+    reason: str = Field(default="initial", description="Why the plan was chosen.")
+    request_times: deque[int] = Field(
+        default_factory=deque,
+        description="The local times of requests made in the last hour in ms.",
+    )
+    _rng: random.Random = PrivateAttr(default_factory=random.Random)
+
+    def seed(self, seed: int):
+        """Seed the interval jitter, e.g. for a reproducible simulation.
+
+        Args:
+            seed (int): The seed.
+        """
+        self._rng.seed(seed)
+
+    def record_requests(self, n_requests: int, now: int):
+        """Record requests against the budget.
+
+        Args:
+            n_requests (int): The number of requests made.
+            now (int): The local time in ms.
+        """
+        self.request_times.extend([now] * n_requests)
+        self._prune(now)
+
+    def _prune(self, now: int):
+        while self.request_times and now - self.request_times[0] > 3600000:
+            self.request_times.popleft()
+
+    @property
+    def requests_last_hour(self):
+        """Get the number of requests recorded in the last hour."""
+        return len(self.request_times)
+
+    def remaining_budget(self, now: int):
+        """Get the number of requests the budget allows right now.
+
+        Args:
+            now (int): The local time in ms.
+
+        Returns:
+            remaining (int): The number of requests left in the budget.
+        """
+        self._prune(now)
+        return max(self.budget_per_hour - self.requests_last_hour, 0)
+
+    def samples_within_budget(self, now: int):
+        """Get the planned number of samples, capped at what the budget has left.
+
+        Args:
+            now (int): The local time in ms.
+
+        Returns:
+            n_samples (int): The number of samples to take; 0 if the budget is exhausted.
+        """
+        return min(self.next_samples, self.remaining_budget(now))
+
+    def plan(self, model: ClockModel | None, estimator: ClockEstimator, now: int):
+        """Plan the next sync.
+
+        Args:
+            model (ClockModel | None): The current clock model.
+            estimator (ClockEstimator): The estimator, used for its filtering parameters.
+            now (int): The local time in ms.
+
+        Returns:
+            interval_ms (float): The delay until the next sync in ms.
+        """
+        self._prune(now)
+        z = 1.96
+        if model is None:
+            interval = self.min_interval_ms
+            n_samples = self.max_samples
+            self.reason = "no clock model"
+        else:
+            kept = (z * model.sigma / self.target_error_ms) ** 2
+            n_samples = math.ceil(kept / estimator.keep_fraction)
+            headroom = (self.target_error_ms / z) ** 2 - model.offset_se**2
+            skew_uncertainty = model.skew_se if model.skew_se > 0 else self.prior_skew
+            if headroom <= 0:
+                interval = self.min_interval_ms
+                self.reason = "offset uncertainty exceeds target"
+            elif skew_uncertainty == 0:
+                interval = self.max_interval_ms
+                self.reason = "no drift uncertainty"
+            else:
+                horizon = model.reference_time + math.sqrt(headroom) / skew_uncertainty
+                interval = horizon - now
+                self.reason = "predicted drift uncertainty"
+        n_samples = min(
+            max(n_samples, self.min_samples), self.max_samples, self.budget_per_hour
+        )
+        interval = min(max(interval, self.min_interval_ms), self.max_interval_ms)
+        remaining_budget = self.remaining_budget(now)
+        if remaining_budget < n_samples:
+            # wait until enough of the last hour's requests have aged out
+            n_expire = n_samples - remaining_budget
+            budget_interval = self.request_times[n_expire - 1] + 3600000 - now
+            if budget_interval > interval:
+                interval = budget_interval
+                self.reason = "request budget exhausted"
+        interval *= 1 + self._rng.uniform(-self.jitter_fraction, self.jitter_fraction)
+        self.next_interval_ms = interval
+        self.next_samples = n_samples
+        logger.debug(
+            f"Next sync in {interval / 1000:.1f}s with {n_samples} samples ({self.reason})."
+        )
+        return interval
@@ -0,0 +1,219 @@
+"""Clock-aligned looping without the server, from the last known clock model."""
+
+import logging
+import math
+from collections import deque
+
+from pydantic import BaseModel, Field, PrivateAttr
+
+from ak_rpi.audio import AudioPlayer
+from ak_rpi.ntp import ClockModel, ServerClock
+from ak_rpi.scheduler import ScheduledCallback, Scheduler
+from ak_rpi.snapshot import PlayerSnapshot
+
+logger = logging.getLogger(__name__)
+
+
+class OfflineClock(ServerClock):
+    """Server time extrapolated from a persisted clock model and the system clock.
+
+    Local time is anchored to the wall clock at startup exactly as in `NTP`, so a model
+    fitted before a restart stays valid for as long as the system clock is right.
+    """
+
+    model: ClockModel
+    prior_skew: float = Field(
+        default=50e-6,
+        ge=0,
+        description="The skew uncertainty assumed when the model did not estimate it.",
+    )
+
+    @property
+    def clock_model(self):
+        """Get the persisted clock model.
+
+        Returns:
+            model (ClockModel): The clock model.
+        """
+        return self.model
+
+    def error_ms(self, monotonic_time: float, z: float = 1.96):
+        """Get the predicted error bound of the extrapolated server time.
+
+        Args:
+            monotonic_time (float): The monotonic time in ms.
+            z (float): The normal quantile of the bound; 1.96 gives a 95% bound.
+
+        Returns:
+            error (float): The half-width of the interval in ms.
+        """
+        model = self.model
+        local_time = self.local_from_monotonic(monotonic_time)
+        if model.skew_se > 0:
+            return model.ci_at(local_time, z)
+        dt = local_time - model.reference_time
+        # treat the prior skew as a 95% bound on the skew
+        return z * math.sqrt(model.offset_se**2 + (self.prior_skew * dt / z) ** 2)
+
+
+class OfflineLoopReport(BaseModel):
+    """The predicted error of a loop start made offline."""
+
+    loop_start_server_time: float = Field(
+        ..., description="The scheduled server time of the loop start in ms."
+    )
+    model_age_s: float = Field(
+        ..., description="The time since the clock model's reference time in s."
+    )
+    error_ms: float = Field(
+        ..., description="The predicted 95% error of the start in ms."
+    )
+    gapless: bool = Field(..., description="Whether the loop was queued gaplessly.")
+
+
+class OfflineLooper(BaseModel, arbitrary_types_allowed=True):
+    """Loops audio on the fleet's schedule using a persisted clock model.
+
+    Loop starts fall on `anchor_server_time + k * duration` in extrapolated server
+    time, the same schedule the synced players follow, so co-located players stay
+    aligned while the server is unreachable. Each start is re-aligned to the schedule
+    if the audio has drifted more than `AudioPlayer.max_gapless_error_ms` from it,
+    and the predicted error of every start is kept in `reports`.
+    """
+
+    audio: AudioPlayer
+    clock: OfflineClock
+    anchor_server_time: float = Field(
+        ...,
+        description="The server time of any loop start on the fleet's schedule in ms.",
+    )
+    duration: float = Field(..., gt=0, description="The loop period in ms.")
+    preroll_ms: int = Field(
+        default=50,
+        ge=0,
+        description="How long before a loop starts to hand it to the mixer in ms.",
+    )
+    reports: deque[OfflineLoopReport] = Field(
+        default_factory=lambda: deque(maxlen=1000),
+        description="The predicted error of recent loop starts.",
+    )
+    _next: ScheduledCallback | None = PrivateAttr(default=None)
+
+    @classmethod
+    def FromSnapshot(cls, snapshot: PlayerSnapshot, audio: AudioPlayer):
+        """Create a looper from a snapshot of a synced player.
+
+        Args:
+            snapshot (PlayerSnapshot): The snapshot.
+            audio (AudioPlayer): The loaded audio.
+
+        Returns:
+            looper (OfflineLooper | None): The looper, or None if the snapshot has no clock model or schedule.
+        """
+        from ak_rpi.latency import DEFAULT_OUTPUT_LATENCY_MS
+
+        last_timestamp = snapshot.settings.get("lastTimestamp")
+        if snapshot.clock is None or last_timestamp is None:
+            return None
+        latency = snapshot.output_latency_ms
+        if latency is None:
+            latency = DEFAULT_OUTPUT_LATENCY_MS
+        return cls(
+            audio=audio,
+            clock=OfflineClock(model=snapshot.clock.model),
+            anchor_server_time=last_timestamp - latency,
+            duration=audio.sound_ms,
+        )
+
+    @property
+    def next_loop_start_server_time(self):
+        """Get the first scheduled loop start at least half a pre-roll from now.
+
+        Returns:
+            server_time (float): The server time in ms.
+        """
+        earliest = self.clock.server_time + self.preroll_ms / 2
+        k = math.ceil((earliest - self.anchor_server_time) / self.duration)
+        return self.anchor_server_time + k * self.duration
+
+    def start_next(self, scheduler: Scheduler):
+        """Start the next loop on schedule and schedule the one after.
+
+        Args:
+            scheduler (Scheduler): The scheduler driving the loop.
+        """
+        st = self.next_loop_start_server_time
+        start_time = self.clock.monotonic_from_server_time(st)
+        gapless = self.audio.can_queue_at(start_time)
+        if gapless:
+            start_time = self.audio.queue_next()
+        else:
+            self.audio.play_at(start_time)
+        self.audio.watch_boundary(scheduler)
+        report = OfflineLoopReport(
+            loop_start_server_time=st,
+            model_age_s=(self.clock.local_time - self.clock.model.reference_time)
+            / 1000,
+            error_ms=self.clock.error_ms(start_time),
+            gapless=gapless,
+        )
+        self.reports.append(report)
+        logger.info(
+            f"Offline loop start: predicted error +/-{report.error_ms:.1f}ms "
+            f"with a clock model {report.model_age_s / 3600:.2f}h old."
+        )
+        self._next = scheduler.call_at(
+            self.audio.end_time - self.preroll_ms, self.start_next, scheduler
+        )
+
+    def loop(self, scheduler: Scheduler):
+        """Start looping on a scheduler.
+
+        Args:
+            scheduler (Scheduler): The scheduler driving the loop.
+        """
+        scheduler.call_soon(self.start_next, scheduler)
+
+    def stop(self):
+        """Stop scheduling loop starts; a loop already handed to the mixer still plays."""
+        if self._next is not None:
+            self._next.cancel()
+            self._next = None
+
+
+def start_offline(scheduler: Scheduler):
+    """Start looping without the server.
+
+    Plays the media from the last snapshot, or else the first available audio file in the
+    media dir. If the snapshot has a clock model, loops start on the fleet's schedule as
+    extrapolated from that model; otherwise the audio loops without a time reference.
+
+    Args:
+        scheduler (Scheduler): The scheduler to loop on.
+
+    Returns:
+        audio (AudioPlayer | None): The playing audio, or None if there is no media.
+        looper (OfflineLooper | None): The looper, or None if looping without a time reference.
+    """
+    from ak_rpi.media_index import MediaIndex
+    from ak_rpi.player import MediaDir
+
+    snapshot = PlayerSnapshot.Load()
+    media_path = snapshot.settings.get("videoPath") if snapshot else None
+    logger.info(f"Starting offline mode, searching for audio files in {MediaDir}...")
+    index = MediaIndex.Load(root=MediaDir)
+    logger.info(f"Found {len(index.entries)} audio files.")
+    path = index.select(preferred=media_path)
+    if path is None:
+        logger.error("No audio files found.")
+        return None, None
+    fpath = path.as_posix()
+    logger.info(f"Found audio file: {fpath}")
+    audio = AudioPlayer.Load(fpath)
+    looper = OfflineLooper.FromSnapshot(snapshot, audio) if snapshot else None
+    if looper is None:
+        logger.warning("No clock model available, looping without a time reference.")
+        audio.loop(scheduler)
+    else:
+        looper.loop(scheduler)
+    return audio, looper
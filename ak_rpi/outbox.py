@@ -0,0 +1,256 @@
+"""A coalescing, persistent outbox for reports to the server."""
+
+import asyncio
+import logging
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Literal
+
+import httpx
+from pydantic import BaseModel, Field, PrivateAttr
+
+from ak_rpi.client import AsyncClient, Client
+
+logger = logging.getLogger(__name__)
+
+OUTBOX_PATH = Path("outbox.jsonl")
+
+OutboxField = Literal["lastTimestamp", "duration"]
+
+
+class OutboxEntry(BaseModel):
+    """A report of a single field of a player, as recorded in the journal."""
+
+    player_id: int
+    field: OutboxField
+    value: int
+    queued_at: float = Field(
+        default_factory=time.time, description="The wall-clock time it was queued in s."
+    )
+    sent: bool = Field(
+        default=False, description="Whether the server has acknowledged this value."
+    )
+
+    @property
+    def key(self):
+        """Get the key that entries are coalesced by."""
+        return (self.player_id, self.field)
+
+
+class Outbox(BaseModel, arbitrary_types_allowed=True):
+    """An outbox which reports player fields to the server without blocking the caller.
+
+    Only the latest value of each (player, field) is kept, so a backlog built up
+    during an outage is flushed as one request per field rather than one per loop.
+    Flushes run on a daemon thread, are sent concurrently through the async client and
+    back off exponentially while the server is failing. Every queued value and
+    acknowledgement is appended to a journal so pending reports survive a restart; the
+    journal is compacted once it grows past `max_journal_entries`.
+    """
+
+    client: Client
+    journal_path: Path = Field(
+        default=OUTBOX_PATH, description="The append-only journal of reports."
+    )
+    flush_delay_ms: int = Field(
+        default=200,
+        ge=0,
+        description="How long to wait for further reports before flushing in ms.",
+    )
+    backoff_base_ms: int = Field(
+        default=1000, gt=0, description="The delay after the first failed flush in ms."
+    )
+    backoff_max_ms: int = Field(
+        default=60000,
+        gt=0,
+        description="The longest delay between failed flushes in ms.",
+    )
+    max_journal_entries: int = Field(
+        default=256,
+        gt=0,
+        description="How many lines the journal may reach before compaction.",
+    )
+    _pending: dict[tuple[int, str], OutboxEntry] = PrivateAttr(default_factory=dict)
+    _lock: threading.Lock = PrivateAttr(default_factory=threading.Lock)
+    _wakeup: threading.Event = PrivateAttr(default_factory=threading.Event)
+    _stop_requested: threading.Event = PrivateAttr(default_factory=threading.Event)
+    _worker: threading.Thread | None = PrivateAttr(default=None)
+    _failures: int = PrivateAttr(default=0)
+    _journal_entries: int = PrivateAttr(default=0)
+
+    def model_post_init(self, __context):
+        """Restore pending reports from the journal."""
+        self.load()
+
+    @property
+    def pending(self):
+        """Get a snapshot of the reports which have not been acknowledged."""
+        with self._lock:
+            return list(self._pending.values())
+
+    def put(self, player_id: int, field: OutboxField, value: int):
+        """Queue a report, replacing any pending value of the same field.
+
+        Args:
+            player_id (int): The id of the player.
+            field (OutboxField): The field to report.
+            value (int): The value.
+        """
+        entry = OutboxEntry(player_id=player_id, field=field, value=value)
+        with self._lock:
+            self._pending[entry.key] = entry
+            self._append(entry)
+        self._wakeup.set()
+
+    def put_duration(self, player_id: int, duration: int):
+        """Queue an update of the duration of the player's work (in ms)."""
+        self.put(player_id, "duration", duration)
+
+    def put_lastTimestamp(self, player_id: int, lastTimestamp: int):
+        """Queue an update of the lastTimestamp of the player's work (in ms)."""
+        self.put(player_id, "lastTimestamp", lastTimestamp)
+
+    def load(self):
+        """Replay the journal, keeping the latest unacknowledged value of each field."""
+        pending: dict[tuple[int, str], OutboxEntry] = {}
+        n_entries = 0
+        try:
+            with open(self.journal_path) as f:
+                for line in f:
+                    try:
+                        entry = OutboxEntry.model_validate_json(line)
+                    except ValueError:
+                        # a torn write from a power cut; skip it
+                        continue
+                    n_entries += 1
+                    if entry.sent:
+                        if (
+                            entry.key in pending
+                            and pending[entry.key].value == entry.value
+                        ):
+                            del pending[entry.key]
+                    else:
+                        pending[entry.key] = entry
+        except FileNotFoundError:
+            pass
+        with self._lock:
+            self._pending = pending
+            self._journal_entries = n_entries
+        if pending:
+            logger.info(
+                f"Restored {len(pending)} pending reports from {self.journal_path}."
+            )
+
+    def _append(self, entry: OutboxEntry):
+        """Append an entry to the journal; must be called with the lock held."""
+        if self._journal_entries >= self.max_journal_entries:
+            self._compact()
+        with open(self.journal_path, "a") as f:
+            f.write(entry.model_dump_json() + "\n")
+        self._journal_entries += 1
+
+    def _compact(self):
+        """Rewrite the journal with only the pending entries; must be called with the lock held."""
+        tmp = self.journal_path.with_suffix(".tmp")
+        with open(tmp, "w") as f:
+            for entry in self._pending.values():
+                f.write(entry.model_dump_json() + "\n")
+        os.replace(tmp, self.journal_path)
+        self._journal_entries = len(self._pending)
+
+    async def _send(self, client: AsyncClient, entries: list[OutboxEntry]):
+        async def send_one(entry: OutboxEntry):
+            if entry.field == "duration":
+                return await client.put_duration(entry.player_id, entry.value)
+            return await client.put_lastTimestamp(entry.player_id, entry.value)
+
+        return await asyncio.gather(
+            *(send_one(entry) for entry in entries), return_exceptions=True
+        )
+
+    def flush(self):
+        """Send all pending reports.
+
+        Returns:
+            ok (bool): False if any report failed and should be retried.
+        """
+        entries = self.pending
+        if not entries:
+            return True
+        results = self.client.in_background(lambda c: self._send(c, entries)).result()
+        ok = True
+        with self._lock:
+            for entry, result in zip(entries, results, strict=True):
+                if isinstance(result, BaseException):
+                    logger.warning(f"Failed to report {entry.field}: {result!r}")
+                    ok = False
+                    continue
+                response: httpx.Response = result
+                if response.is_server_error or response.status_code == 429:
+                    logger.warning(
+                        f"Failed to report {entry.field}: {response.status_code}"
+                    )
+                    ok = False
+                    continue
+                if not response.is_success:
+                    # retrying will not help, so drop it rather than block the outbox
+                    logger.error(
+                        f"Server rejected {entry.field}={entry.value}: "
+                        f"{response.status_code}: {response.text}"
+                    )
+                current = self._pending.get(entry.key)
+                if current is not None and current.value == entry.value:
+                    del self._pending[entry.key]
+                self._append(entry.model_copy(update={"sent": True}))
+        return ok
+
+    @property
+    def backoff_ms(self):
+        """Get the delay before the next flush after consecutive failures in ms."""
+        if self._failures == 0:
+            return self.flush_delay_ms
+        return min(
+            self.backoff_base_ms * 2 ** (self._failures - 1), self.backoff_max_ms
+        )
+
+    def start(self):
+        """Start flushing reports on a daemon thread."""
+        if self._worker is not None and self._worker.is_alive():
+            return
+        self._stop_requested.clear()
+        self._wakeup.set()
+        self._worker = threading.Thread(target=self._run, name="outbox", daemon=True)
+        self._worker.start()
+
+    def stop(self, timeout_s: float | None = 5.0):
+        """Stop the flushing thread, making a final attempt to flush.
+
+        Args:
+            timeout_s (float | None): How long to wait for the thread to finish.
+        """
+        self._stop_requested.set()
+        self._wakeup.set()
+        if self._worker is not None:
+            self._worker.join(timeout_s)
+            self._worker = None
+
+    def _run(self):
+        while True:
+            self._wakeup.wait()
+            # let reports queued in quick succession coalesce
+            self._stop_requested.wait(self.backoff_ms / 1000)
+            self._wakeup.clear()
+            try:
+                ok = self.flush()
+            except Exception as e:
+                logger.exception("Outbox flush failed.", exc_info=e)
+                ok = False
+            if self._stop_requested.is_set():
+                return
+            if ok:
+                self._failures = 0
+            else:
+                self._failures += 1
+                self._wakeup.set()
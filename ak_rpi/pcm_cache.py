@@ -0,0 +1,195 @@
+"""An on-disk cache of decoded PCM."""
+
+import hashlib
+import json
+import logging
+import mmap
+import os
+import tempfile
+import threading
+from pathlib import Path
+from typing import cast
+
+import pygame
+from pydantic import BaseModel, Field
+
+logger = logging.getLogger(__name__)
+
+CacheDir = Path(__file__).parent.parent / "media" / ".pcm-cache"
+
+# serializes updates of the hash memo between loader threads
+_hashes_lock = threading.Lock()
+
+
+def hash_file(path: Path | str, chunk_size: int = 1 << 20):
+    """Hash the contents of a file.
+
+    Args:
+        path (Path | str): The file to hash.
+        chunk_size (int): The number of bytes to read at a time.
+
+    Returns:
+        digest (str): The hex sha256 digest.
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(chunk_size):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _memo_key(path: Path):
+    stat = path.stat()
+    return f"{path.resolve()}:{stat.st_size}:{stat.st_mtime_ns}"
+
+
+def _is_current(memo_key: str):
+    path = Path(memo_key.rsplit(":", 2)[0])
+    try:
+        return _memo_key(path) == memo_key
+    except OSError:
+        return False
+
+
+class PCMCache(BaseModel):
+    """A size-bounded LRU cache of decoded PCM, keyed by file content and mixer format.
+
+    Decoded audio is stored as raw PCM in the mixer's format and memory-mapped on load,
+    so a warm load only pages in the file rather than decoding it again. Recency is
+    tracked with the cache files' mtimes, and the least recently used files are evicted
+    once the cache exceeds `max_bytes`. Content hashes are memoized by path, size and
+    mtime so that unchanged media is not re-hashed on every load.
+    """
+
+    cache_dir: Path = Field(
+        default=CacheDir, description="The directory holding cached PCM."
+    )
+    max_bytes: int = Field(
+        default=2 * 1024**3, gt=0, description="The largest total size of the cache."
+    )
+
+    @property
+    def hashes_path(self):
+        """Get the path of the memoized content hashes."""
+        return self.cache_dir / "hashes.json"
+
+    def content_hash(self, path: Path):
+        """Get the content hash of a file, memoized by path, size and mtime.
+
+        Memos of files which have since changed or been deleted are dropped whenever a
+        new one is added, so the memo only holds the media currently on disk.
+
+        Args:
+            path (Path): The file.
+
+        Returns:
+            digest (str): The hex sha256 digest.
+        """
+        memo_key = _memo_key(path)
+        hashes = self._read_hashes()
+        if memo_key in hashes:
+            return hashes[memo_key]
+        digest = hash_file(path)
+        with _hashes_lock:
+            hashes = self._read_hashes()
+            hashes = {key: value for key, value in hashes.items() if _is_current(key)}
+            hashes[memo_key] = digest
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+            # a unique name, so another process updating the memo cannot interleave
+            with tempfile.NamedTemporaryFile(
+                "w", dir=self.cache_dir, suffix=".tmp", delete=False
+            ) as f:
+                json.dump(hashes, f)
+            os.replace(f.name, self.hashes_path)
+        return digest
+
+    def _read_hashes(self) -> dict[str, str]:
+        try:
+            with open(self.hashes_path) as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+
+    def cache_path(self, path: Path):
+        """Get the cache file for a media file in the current mixer format.
+
+        Args:
+            path (Path): The media file.
+
+        Returns:
+            cache_path (Path): The cache file.
+        """
+        init = pygame.mixer.get_init()
+        if not init:
+            msg = "The mixer must be initialized to determine the PCM format."
+            raise RuntimeError(msg)
+        frequency, size, channels = init
+        digest = self.content_hash(path)
+        return self.cache_dir / f"{digest}-{frequency}-{size}-{channels}.pcm"
+
+    def get(self, audio_file: Path | str):
+        """Get the decoded PCM of a media file if it is cached.
+
+        Args:
+            audio_file (Path | str): The media file.
+
+        Returns:
+            pcm (mmap.mmap | None): The memory-mapped PCM in the mixer's format, or None on a miss.
+        """
+        cache_path = self.cache_path(Path(audio_file))
+        if not cache_path.exists() or cache_path.stat().st_size == 0:
+            return None
+        os.utime(cache_path)
+        with open(cache_path, "rb") as f:
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def open(self, audio_file: Path | str):
+        """Get the decoded PCM of a media file, decoding and caching it on a miss.
+
+        Args:
+            audio_file (Path | str): The media file.
+
+        Returns:
+            pcm (mmap.mmap): The memory-mapped PCM in the mixer's format.
+            hit (bool): Whether the PCM was already cached.
+        """
+        path = Path(audio_file)
+        pcm = self.get(path)
+        if pcm is not None:
+            return pcm, True
+        logger.info(f"Decoding {path} into the PCM cache...")
+        cache_path = self.cache_path(path)
+        sound = pygame.mixer.Sound(path.as_posix())
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        tmp = cache_path.with_suffix(".tmp")
+        with open(tmp, "wb") as f:
+            # straight from the sound's buffer; `get_raw` would hold a second copy
+            f.write(memoryview(cast(bytes, sound)).cast("B"))
+        os.replace(tmp, cache_path)
+        del sound
+        self.evict(keep=cache_path)
+        with open(cache_path, "rb") as f:
+            pcm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return pcm, False
+
+    def evict(self, keep: Path | None = None):
+        """Evict the least recently used cache files until the cache fits in `max_bytes`.
+
+        Args:
+            keep (Path | None): A cache file which must not be evicted.
+        """
+        entries = sorted(
+            (entry.stat().st_mtime_ns, entry)
+            for entry in self.cache_dir.glob("*.pcm")
+            if entry != keep
+        )
+        total = sum(entry.stat().st_size for _, entry in entries)
+        if keep is not None and keep.exists():
+            total += keep.stat().st_size
+        for _, entry in entries:
+            if total <= self.max_bytes:
+                break
+            size = entry.stat().st_size
+            logger.info(f"Evicting {entry.name} from the PCM cache.")
+            entry.unlink(missing_ok=True)
+            total -= size
@@ -0,0 +1,514 @@
+"""Incremental PCM sources and a ring buffer for streaming playback."""
+
+import abc
+import logging
+import mmap
+import shutil
+import subprocess
+import threading
+import warnings
+import wave
+from pathlib import Path
+
+from pydantic import BaseModel, Field, PrivateAttr
+
+with warnings.catch_warnings():
+    warnings.simplefilter("ignore", DeprecationWarning)
+    import audioop
+
+logger = logging.getLogger(__name__)
+
+
+class PCMSource(BaseModel, abc.ABC, arbitrary_types_allowed=True):
+    """A seekable, sequentially read source of PCM in the mixer's format."""
+
+    frequency: int = Field(..., description="The mixer frequency in Hz.")
+    size: int = Field(..., description="The mixer's signed sample size in bits.")
+    channels: int = Field(..., description="The mixer's channel count.")
+
+    @property
+    def frame_bytes(self):
+        """Get the number of bytes per frame."""
+        return abs(self.size) // 8 * self.channels
+
+    @property
+    @abc.abstractmethod
+    def n_frames(self) -> int:
+        """Get the number of frames in the source."""
+
+    @abc.abstractmethod
+    def seek(self, frame: int):
+        """Move the read position.
+
+        Args:
+            frame (int): The frame to read from next.
+        """
+
+    @abc.abstractmethod
+    def read(self, n_frames: int) -> bytes:
+        """Read frames from the current position.
+
+        Args:
+            n_frames (int): The largest number of frames to read.
+
+        Returns:
+            pcm (bytes): The PCM read; empty at the end of the source.
+        """
+
+    def close(self):
+        """Release any resources held by the source."""
+
+
+class MemorySource(PCMSource):
+    """Reads PCM which is already in memory."""
+
+    pcm: memoryview
+    _position: int = PrivateAttr(default=0)
+
+    @property
+    def n_frames(self):
+        """Get the number of frames in the source."""
+        return len(self.pcm) // self.frame_bytes
+
+    def seek(self, frame: int):
+        """Move the read position.
+
+        Args:
+            frame (int): The frame to read from next.
+        """
+        self._position = min(max(frame, 0), self.n_frames) * self.frame_bytes
+
+    def read(self, n_frames: int):
+        """Read frames from the current position.
+
+        Args:
+            n_frames (int): The largest number of frames to read.
+
+        Returns:
+            pcm (bytes): The PCM read; empty at the end of the source.
+        """
+        end = min(self._position + n_frames * self.frame_bytes, len(self.pcm))
+        data = bytes(self.pcm[self._position : end])
+        self._position = end
+        return data
+
+
+class MappedSource(PCMSource):
+    """Reads PCM from a memory map, such as a PCM cache file.
+
+    Pages behind the read position are released as the stream advances, so resident
+    memory stays bounded by the read-ahead rather than growing with the track.
+    """
+
+    pcm: mmap.mmap
+    _position: int = PrivateAttr(default=0)
+    _released: int = PrivateAttr(default=0)
+
+    @property
+    def n_frames(self):
+        """Get the number of frames in the source."""
+        return len(self.pcm) // self.frame_bytes
+
+    def seek(self, frame: int):
+        """Move the read position.
+
+        Args:
+            frame (int): The frame to read from next.
+        """
+        self._position = min(max(frame, 0), self.n_frames) * self.frame_bytes
+        self._released = 0
+
+    def read(self, n_frames: int):
+        """Read frames from the current position.
+
+        Args:
+            n_frames (int): The largest number of frames to read.
+
+        Returns:
+            pcm (bytes): The PCM read; empty at the end of the source.
+        """
+        end = min(self._position + n_frames * self.frame_bytes, len(self.pcm))
+        data = self.pcm[self._position : end]
+        self._position = end
+        release_to = end - end % mmap.PAGESIZE
+        if hasattr(mmap, "MADV_DONTNEED") and release_to > self._released:
+            self.pcm.madvise(
+                mmap.MADV_DONTNEED, self._released, release_to - self._released
+            )
+            self._released = release_to
+        return data
+
+    def close(self):
+        """Release the memory map."""
+        self.pcm.close()
+
+
+class WavSource(PCMSource):
+    """Reads a WAV file incrementally, converting it to the mixer's format."""
+
+    path: Path
+    _wav: wave.Wave_read | None = PrivateAttr(default=None)
+    _state: tuple | None = PrivateAttr(default=None)
+
+    @property
+    def wav(self):
+        """Get the open wave reader."""
+        if self._wav is None:
+            # kept open across reads and closed by `close`
+            self._wav = wave.Wave_read(self.path.as_posix())
+        return self._wav
+
+    @property
+    def n_frames(self):
+        """Get the number of frames in the source, at the mixer's frequency."""
+        return self.wav.getnframes() * self.frequency // self.wav.getframerate()
+
+    def seek(self, frame: int):
+        """Move the read position.
+
+        Args:
+            frame (int): The frame, at the mixer's frequency, to read from next.
+        """
+        source_frame = frame * self.wav.getframerate() // self.frequency
+        self.wav.setpos(min(max(source_frame, 0), self.wav.getnframes()))
+        self._state = None
+
+    def read(self, n_frames: int):
+        """Read frames from the current position, converted to the mixer's format.
+
+        Args:
+            n_frames (int): The largest number of frames to read, at the mixer's frequency.
+
+        Returns:
+            pcm (bytes): The PCM read; empty at the end of the source.
+        """
+        wav = self.wav
+        rate = wav.getframerate()
+        data = wav.readframes(max(n_frames * rate // self.frequency, 1))
+        if not data:
+            return b""
+        width = wav.getsampwidth()
+        out_width = abs(self.size) // 8
+        if width == 1:
+            # 8-bit wavs are unsigned
+            data = audioop.bias(data, 1, -128)
+        if width != out_width:
+            data = audioop.lin2lin(data, width, out_width)
+        n_channels = wav.getnchannels()
+        if n_channels == 1 and self.channels == 2:
+            data = audioop.tostereo(data, out_width, 1, 1)
+        elif n_channels == 2 and self.channels == 1:
+            data = audioop.tomono(data, out_width, 0.5, 0.5)
+        if rate != self.frequency:
+            data, self._state = audioop.ratecv(
+                data, out_width, self.channels, rate, self.frequency, self._state
+            )
+        return data
+
+    def close(self):
+        """Close the file."""
+        if self._wav is not None:
+            self._wav.close()
+            self._wav = None
+
+
+class FFmpegSource(PCMSource):
+    """Decodes any format ffmpeg understands through a pipe, restarting it to seek."""
+
+    path: Path
+    duration_ms: float = Field(..., description="The probed duration in ms.")
+    _process: subprocess.Popen | None = PrivateAttr(default=None)
+    _position: int = PrivateAttr(default=0)
+
+    @staticmethod
+    def available():
+        """Whether ffmpeg is installed."""
+        return shutil.which("ffmpeg") is not None
+
+    @property
+    def n_frames(self):
+        """Get the number of frames in the source."""
+        return round(self.duration_ms * self.frequency / 1000)
+
+    def seek(self, frame: int):
+        """Move the read position by restarting the decoder.
+
+        Args:
+            frame (int): The frame to read from next.
+        """
+        self.close()
+        self._position = min(max(frame, 0), self.n_frames)
+
+    def read(self, n_frames: int):
+        """Read frames from the current position.
+
+        Args:
+            n_frames (int): The largest number of frames to read.
+
+        Returns:
+            pcm (bytes): The PCM read; empty at the end of the source.
+        """
+        if self._process is None:
+            self._process = self._spawn()
+        stdout = self._process.stdout
+        if stdout is None:
+            return b""
+        data = stdout.read(n_frames * self.frame_bytes)
+        data = data[: len(data) - len(data) % self.frame_bytes]
+        self._position += len(data) // self.frame_bytes
+        return data
+
+    def _spawn(self):
+        sample_format = f"s{abs(self.size)}le"
+        return subprocess.Popen(  # noqa: S603
+            [  # noqa: S607
+                "ffmpeg",
+                "-v",
+                "error",
+                "-ss",
+                f"{self._position / self.frequency:.6f}",
+                "-i",
+                self.path.as_posix(),
+                "-f",
+                sample_format,
+                "-ar",
+                str(self.frequency),
+                "-ac",
+                str(self.channels),
+                "-",
+            ],
+            stdout=subprocess.PIPE,
+            stdin=subprocess.DEVNULL,
+        )
+
+    def close(self):
+        """Stop the decoder."""
+        if self._process is not None:
+            self._process.kill()
+            self._process.wait()
+            self._process = None
+
+
+class RingBuffer(BaseModel):
+    """A fixed-capacity byte ring buffer shared between a producer and a consumer thread."""
+
+    capacity: int = Field(..., gt=0, description="The capacity in bytes.")
+    _buffer: bytearray = PrivateAttr()
+    _start: int = PrivateAttr(default=0)
+    _size: int = PrivateAttr(default=0)
+    _cond: threading.Condition = PrivateAttr(default_factory=threading.Condition)
+
+    def model_post_init(self, __context):
+        """Allocate the buffer."""
+        self._buffer = bytearray(self.capacity)
+
+    @property
+    def size(self):
+        """Get the number of bytes buffered."""
+        return self._size
+
+    def write(self, data: bytes | memoryview, timeout: float | None = None):
+        """Write data, waiting for space as needed.
+
+        Args:
+            data (bytes | memoryview): The data to write.
+            timeout (float | None): How long to wait for space in seconds.
+
+        Returns:
+            written (int): The number of bytes written.
+        """
+        written = 0
+        view = memoryview(data)
+        with self._cond:
+            while written < len(view):
+                if self._size == self.capacity and not self._cond.wait_for(
+                    lambda: self._size < self.capacity, timeout
+                ):
+                    break
+                end = (self._start + self._size) % self.capacity
+                n = min(
+                    len(view) - written,
+                    self.capacity - self._size,
+                    self.capacity - end,
+                )
+                self._buffer[end : end + n] = view[written : written + n]
+                self._size += n
+                written += n
+                self._cond.notify_all()
+        return written
+
+    def wait_for_space(self, timeout: float | None = None):
+        """Wait until there is space to write.
+
+        Args:
+            timeout (float | None): How long to wait in seconds.
+
+        Returns:
+            has_space (bool): True if there is space.
+        """
+        with self._cond:
+            return self._cond.wait_for(lambda: self._size < self.capacity, timeout)
+
+    def read(self, n_bytes: int, timeout: float | None = None):
+        """Read up to `n_bytes`, waiting up to `timeout` for them to be available.
+
+        Args:
+            n_bytes (int): The number of bytes wanted.
+            timeout (float | None): How long to wait for enough data in seconds.
+
+        Returns:
+            data (bytes): The data read; shorter than requested if the wait timed out.
+        """
+        with self._cond:
+            self._cond.wait_for(lambda: self._size >= n_bytes, timeout)
+            n = min(n_bytes, self._size)
+            first = min(n, self.capacity - self._start)
+            data = bytes(self._buffer[self._start : self._start + first]) + bytes(
+                self._buffer[: n - first]
+            )
+            self._start = (self._start + n) % self.capacity
+            self._size -= n
+            self._cond.notify_all()
+        return data
+
+    def clear(self):
+        """Discard all buffered data."""
+        with self._cond:
+            self._start = 0
+            self._size = 0
+            self._cond.notify_all()
+
+
+class BufferedSource(BaseModel, arbitrary_types_allowed=True):
+    """Decodes a source ahead of playback on a background thread into a ring buffer.
+
+    Only the decoder thread touches the source, and it does so without holding the lock,
+    so a slow read (e.g. waiting on ffmpeg) never blocks a reader or a seek.
+    """
+
+    source: PCMSource
+    capacity_ms: int = Field(
+        default=2000, gt=0, description="How much audio to decode ahead in ms."
+    )
+    chunk_ms: int = Field(
+        default=50, gt=0, description="How much audio to decode at a time in ms."
+    )
+    _ring: RingBuffer = PrivateAttr()
+    _generation: int = PrivateAttr(default=0)
+    _eof: bool = PrivateAttr(default=False)
+    _seek_to: int | None = PrivateAttr(default=None)
+    _lock: threading.Lock = PrivateAttr(default_factory=threading.Lock)
+    _stop_requested: threading.Event = PrivateAttr(default_factory=threading.Event)
+    _wakeup: threading.Event = PrivateAttr(default_factory=threading.Event)
+    _decoder: threading.Thread | None = PrivateAttr(default=None)
+
+    def model_post_init(self, __context):
+        """Allocate the ring buffer."""
+        capacity = self.capacity_ms * self.source.frequency // 1000
+        self._ring = RingBuffer(capacity=capacity * self.source.frame_bytes)
+
+    @property
+    def buffered_ms(self):
+        """Get how much audio is decoded and waiting in ms."""
+        frames = self._ring.size // self.source.frame_bytes
+        return frames * 1000 / self.source.frequency
+
+    def start(self, frame: int = 0):
+        """Start decoding from a frame.
+
+        Args:
+            frame (int): The frame to start from.
+        """
+        self.seek(frame)
+        if self._decoder is None or not self._decoder.is_alive():
+            self._stop_requested.clear()
+            self._decoder = threading.Thread(
+                target=self._decode, name="audio-decode", daemon=True
+            )
+            self._decoder.start()
+
+    def seek(self, frame: int):
+        """Discard buffered audio and continue decoding from a frame.
+
+        The decoder thread moves the source before its next read.
+
+        Args:
+            frame (int): The frame to continue from.
+        """
+        with self._lock:
+            self._generation += 1
+            self._seek_to = frame
+            self._ring.clear()
+            self._eof = False
+        # the decoder may be idling at the end of the source
+        self._wakeup.set()
+
+    def read(self, n_frames: int, timeout: float | None = None):
+        """Read decoded frames.
+
+        Args:
+            n_frames (int): The number of frames wanted.
+            timeout (float | None): How long to wait for the decoder in seconds.
+
+        Returns:
+            pcm (bytes): The PCM read; shorter than requested at the end of the source or if the decoder fell behind.
+        """
+        fb = self.source.frame_bytes
+        with self._lock:
+            eof = self._eof
+        if eof:
+            timeout = 0
+        data = self._ring.read(n_frames * fb, timeout)
+        return data[: len(data) - len(data) % fb]
+
+    @property
+    def exhausted(self):
+        """Whether the source has been fully decoded and read."""
+        return self._eof and self._ring.size == 0
+
+    def stop(self):
+        """Stop the decoder thread."""
+        self._stop_requested.set()
+        self._wakeup.set()
+        with self._lock:
+            self._generation += 1
+        self._ring.clear()
+        if (
+            self._decoder is not None
+            and self._decoder is not threading.current_thread()
+        ):
+            self._decoder.join()
+        self._decoder = None
+
+    def close(self):
+        """Stop the decoder thread and close the source."""
+        self.stop()
+        self.source.close()
+
+    def _decode(self):
+        chunk_frames = self.chunk_ms * self.source.frequency // 1000
+        while not self._stop_requested.is_set():
+            self._wakeup.clear()
+            with self._lock:
+                generation = self._generation
+                seek_to, self._seek_to = self._seek_to, None
+                eof = self._eof
+            if seek_to is not None:
+                self.source.seek(seek_to)
+            data = b"" if eof else self.source.read(chunk_frames)
+            if not data:
+                with self._lock:
+                    if generation == self._generation:
+                        self._eof = True
+                self._wakeup.wait(self.chunk_ms / 1000)
+                continue
+            view = memoryview(data)
+            while view and not self._stop_requested.is_set():
+                with self._lock:
+                    if generation != self._generation:
+                        # a seek happened; this chunk is stale
+                        break
+                    written = self._ring.write(view, timeout=0)
+                view = view[written:]
+                if view:
+                    self._ring.wait_for_space(self.chunk_ms / 1000)
@@ -0,0 +1,425 @@
+"""Clock and loop-boundary sync between players on the same network."""
+
+import json
+import logging
+import socket
+import struct
+import threading
+import time
+from collections.abc import Callable
+from typing import Any, Literal
+
+from pydantic import BaseModel, Field, HttpUrl, PrivateAttr, SecretStr
+
+from ak_rpi.ntp import NTP, SyncTransport
+from ak_rpi.timebase import monotonic_ms, wall_ms
+from ak_rpi.udp_sync import SyncServer, UDPSyncTransport
+
+logger = logging.getLogger(__name__)
+
+PEER_GROUP = "239.255.77.77"
+PEER_PORT = 12322
+PROTOCOL_VERSION = 1
+
+ClockSource = Literal["server", "peer"]
+
+
+class PeerInfo(BaseModel):
+    """What a player last announced about itself."""
+
+    id: int
+    tenant_id: int
+    work_id: int | None = None
+    address: str = Field(..., description="The address the announcement came from.")
+    sync_port: int | None = Field(
+        default=None, description="The port of its sync server, if it is serving one."
+    )
+    source: ClockSource = Field(
+        ..., description="Whether its clock estimate comes from the server or a peer."
+    )
+    error_ms: float | None = Field(
+        default=None,
+        description="The 95% error of its clock estimate in ms, if it has one.",
+    )
+    can_lead: bool = True
+    leader: bool = Field(
+        default=False, description="Whether it claims to be the leader."
+    )
+    seen_at: float = Field(
+        default_factory=time.monotonic, description="When it was last heard from in s."
+    )
+
+    @property
+    def rank(self):
+        """Get the election key; the lowest wins, preferring clocks taken from the server."""
+        return (self.source != "server", self.id)
+
+
+class PeerSync(BaseModel, arbitrary_types_allowed=True):
+    """Shares one player's server clock estimate with the others on its subnet.
+
+    Players announce themselves to a multicast group every `announce_interval_s`.
+    Among those in the same tenant and work that can lead and have a clock estimate
+    within `max_leader_error_ms`, a leader is chosen: a player already claiming the
+    role keeps it, and otherwise the lowest (source, id) wins, preferring players whose
+    estimate came from the server. Conflicting claims resolve the same way.
+
+    The leader keeps syncing with the server and serves its estimate of server time
+    with a `SyncServer`. Followers swap their `NTP` transport for a `UDPSyncTransport`
+    to the leader, so only one player per site talks to the server and co-located
+    players share a single estimate. A follower falls back to its own transport when
+    the leader goes quiet for `peer_timeout_s`. The leader also announces every loop
+    start, which followers pass to `on_boundary`.
+    """
+
+    ntp: NTP
+    player_id: int
+    tenant_id: int
+    work_id: int | None = None
+    can_lead: bool = Field(default=True, description="Whether this player may lead.")
+    group: str = Field(default=PEER_GROUP, description="The multicast group.")
+    port: int = Field(default=PEER_PORT, gt=0, lt=65536)
+    interface: str = Field(
+        default="0.0.0.0",  # noqa: S104
+        description="The address of the interface to join the group on.",
+    )
+    announce_interval_s: float = Field(
+        default=1.0, gt=0, description="How often to announce this player in s."
+    )
+    peer_timeout_s: float = Field(
+        default=3.5,
+        gt=0,
+        description="How long a silent peer is considered alive in s.",
+    )
+    max_leader_error_ms: float = Field(
+        default=10.0,
+        gt=0,
+        description="The largest clock error a player may have and still lead in ms.",
+    )
+    on_boundary: Callable[[float, float], Any] | None = Field(
+        default=None,
+        description="Called with the leader's loop start server time and period in ms.",
+    )
+    peers: dict[int, PeerInfo] = Field(
+        default_factory=dict, description="The live peers, by player id."
+    )
+    leader_id: int | None = Field(default=None, description="The current leader.")
+    _sock: socket.socket | None = PrivateAttr(default=None)
+    _server: SyncServer | None = PrivateAttr(default=None)
+    _own_transport: SyncTransport | None = PrivateAttr(default=None)
+    _peer_transport: UDPSyncTransport | None = PrivateAttr(default=None)
+    _lock: threading.Lock = PrivateAttr(default_factory=threading.Lock)
+    _stop_requested: threading.Event = PrivateAttr(default_factory=threading.Event)
+    _threads: list[threading.Thread] = PrivateAttr(default_factory=list)
+
+    @property
+    def is_leader(self):
+        """Whether this player is the leader."""
+        return self.leader_id == self.player_id
+
+    @property
+    def following(self):
+        """Whether this player takes its clock from a leader."""
+        return self._peer_transport is not None
+
+    @property
+    def source(self) -> ClockSource:
+        """Get where this player's clock estimate comes from."""
+        return "peer" if self.following else "server"
+
+    @property
+    def error_ms(self):
+        """Get the 95% error of this player's clock estimate in ms, if it has one."""
+        model = self.ntp.clock_model
+        return None if model is None else model.ci_at(self.ntp.local_time)
+
+    def _open(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if hasattr(socket, "SO_REUSEPORT"):
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind(("", self.port))
+        membership = struct.pack(
+            "4s4s", socket.inet_aton(self.group), socket.inet_aton(self.interface)
+        )
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, membership)
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 1)
+        # deliver to other players on this host too
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1)
+        if self.interface != "0.0.0.0":  # noqa: S104
+            sock.setsockopt(
+                socket.IPPROTO_IP,
+                socket.IP_MULTICAST_IF,
+                socket.inet_aton(self.interface),
+            )
+        sock.settimeout(0.5)
+        return sock
+
+    def start(self):
+        """Join the group and start announcing, electing and listening."""
+        if self._threads:
+            return
+        self._sock = sock = self._open()
+        self._stop_requested.clear()
+        self._threads = [
+            threading.Thread(
+                target=self._listen, args=(sock,), name="peer-listen", daemon=True
+            ),
+            threading.Thread(target=self._announce, name="peer-announce", daemon=True),
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self):
+        """Leave the group, handing the clock back to this player's own transport."""
+        self._stop_requested.set()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+        self._stop_serving()
+        self._unfollow()
+        self.leader_id = None
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+
+    def _send(self, message: dict):
+        sock = self._sock
+        if sock is None:
+            return
+        message = {"v": PROTOCOL_VERSION, "id": self.player_id, **message}
+        try:
+            sock.sendto(
+                json.dumps(message, separators=(",", ":")).encode(),
+                (self.group, self.port),
+            )
+        except OSError as e:
+            logger.warning(f"Failed to send to peers: {e!r}")
+
+    def announce_boundary(self, loop_start_server_time: float, period: float):
+        """Announce a loop start to the followers; does nothing unless leading.
+
+        Args:
+            loop_start_server_time (float): The server time the loop start is heard in ms.
+            period (float): The loop period in ms.
+        """
+        if not self.is_leader or self._sock is None:
+            return
+        self._send({
+            "type": "boundary",
+            "tenant": self.tenant_id,
+            "work": self.work_id,
+            "start": loop_start_server_time,
+            "period": period,
+        })
+
+    def _announce(self):
+        while not self._stop_requested.is_set():
+            self._send({
+                "type": "peer",
+                "tenant": self.tenant_id,
+                "work": self.work_id,
+                "sync_port": None if self._server is None else self._server.bind()[1],
+                "source": self.source,
+                "error_ms": self.error_ms,
+                "can_lead": self.can_lead,
+                "leader": self.is_leader,
+            })
+            try:
+                self.elect()
+            except Exception as e:
+                logger.exception("Peer election failed.", exc_info=e)
+            self._stop_requested.wait(self.announce_interval_s)
+
+    def _listen(self, sock: socket.socket):
+        while not self._stop_requested.is_set():
+            try:
+                data, (address, _) = sock.recvfrom(2048)
+            except TimeoutError:
+                continue
+            except OSError:
+                if self._stop_requested.is_set():
+                    return
+                raise
+            try:
+                message = json.loads(data)
+                if (
+                    message.get("v") != PROTOCOL_VERSION
+                    or message["id"] == self.player_id
+                ):
+                    continue
+                self.handle_message(message, address)
+            except (ValueError, KeyError, TypeError) as e:
+                logger.debug(f"Ignoring malformed peer message from {address}: {e!r}")
+
+    def handle_message(self, message: dict, address: str):
+        """Handle a message from a peer.
+
+        Args:
+            message (dict): The decoded message.
+            address (str): The address it came from.
+        """
+        if message.get("tenant") != self.tenant_id:
+            return
+        if message["type"] == "peer":
+            info = PeerInfo(
+                id=message["id"],
+                tenant_id=message["tenant"],
+                work_id=message.get("work"),
+                address=address,
+                sync_port=message.get("sync_port"),
+                source=message["source"],
+                error_ms=message.get("error_ms"),
+                can_lead=message.get("can_lead", True),
+                leader=message.get("leader", False),
+            )
+            with self._lock:
+                self.peers[info.id] = info
+        elif message["type"] == "boundary":
+            if (
+                message["id"] == self.leader_id
+                and message.get("work") == self.work_id
+                and self.on_boundary is not None
+            ):
+                self.on_boundary(float(message["start"]), float(message["period"]))
+
+    def _eligible(self, info: PeerInfo):
+        return (
+            info.can_lead
+            and info.work_id == self.work_id
+            and info.error_ms is not None
+            and info.error_ms <= self.max_leader_error_ms
+        )
+
+    def elect(self):
+        """Prune silent peers, choose the leader and take up this player's role.
+
+        Returns:
+            leader_id (int | None): The leader, or None if no player is eligible.
+        """
+        now = time.monotonic()
+        with self._lock:
+            self.peers = {
+                i: p
+                for i, p in self.peers.items()
+                if now - p.seen_at < self.peer_timeout_s
+            }
+            candidates = [p for p in self.peers.values() if self._eligible(p)]
+        me = PeerInfo(
+            id=self.player_id,
+            tenant_id=self.tenant_id,
+            work_id=self.work_id,
+            address="",
+            source=self.source,
+            error_ms=self.error_ms,
+            can_lead=self.can_lead,
+            leader=self.is_leader,
+        )
+        if self._eligible(me):
+            candidates.append(me)
+        claimants = [p for p in candidates if p.leader]
+        pool = claimants or candidates
+        leader = min(pool, key=lambda p: p.rank) if pool else None
+        leader_id = None if leader is None else leader.id
+        if leader_id != self.leader_id:
+            logger.info(f"Peer leader is now {leader_id} (was {self.leader_id}).")
+        self.leader_id = leader_id
+        if leader is None or leader.id == self.player_id:
+            self._unfollow()
+            if leader is not None:
+                self._serve()
+        else:
+            self._stop_serving()
+            self._follow(leader)
+        return leader_id
+
+    def _serve(self):
+        if self._server is not None:
+            return
+        ntp = self.ntp
+        self._server = SyncServer(
+            port=0,
+            clock=lambda: ntp.server_time_from_monotonic(monotonic_ms()),
+        )
+        self._server.start()
+        logger.info(f"Serving the clock to peers on port {self._server.bind()[1]}.")
+
+    def _stop_serving(self):
+        if self._server is not None:
+            self._server.stop()
+            self._server = None
+
+    def _follow(self, leader: PeerInfo):
+        port = leader.sync_port
+        if port is None:
+            return
+        current = self._peer_transport
+        if (
+            current is not None
+            and current.host == leader.address
+            and current.port == port
+        ):
+            return
+        if current is None:
+            self._own_transport = self.ntp.transport
+        else:
+            current.close()
+        self._peer_transport = UDPSyncTransport(
+            host=leader.address, port=port, timeout_s=0.2
+        )
+        self.ntp.set_transport(self._peer_transport)
+        logger.info(f"Following peer {leader.id} at {leader.address}:{port}.")
+
+    def _unfollow(self):
+        if self._peer_transport is None:
+            return
+        self._peer_transport.close()
+        self._peer_transport = None
+        self.ntp.set_transport(self._own_transport)
+        logger.info("Syncing with the server again.")
+
+
+def main():
+    """Run a standalone peer against a UDP sync server, logging its clock estimate.
+
+    Several of these on one host exercise discovery, election, failover and the
+    inter-device error: with a shared wall clock, the differences between the logged
+    estimates are the error between players.
+
+    Usage: `python -m ak_rpi.peer <player id> [sync server port]`
+    """
+    import sys
+
+    import httpx
+
+    from ak_rpi.client import Client
+    from ak_rpi.udp_sync import DEFAULT_PORT
+
+    logging.basicConfig(level=logging.INFO, format="[%(process)d] %(message)s")
+    player_id = int(sys.argv[1])
+    port = int(sys.argv[2]) if len(sys.argv) > 2 else DEFAULT_PORT
+    client = Client(
+        syncUrl=HttpUrl("http://127.0.0.1"),
+        password=SecretStr(""),
+        client=httpx.Client(),
+    )
+    ntp = NTP(client=client, transport=UDPSyncTransport(host="127.0.0.1", port=port))
+    ntp.sync()
+    ntp.start_background_sync()
+    peers = PeerSync(ntp=ntp, player_id=player_id, tenant_id=0)
+    peers.start()
+    try:
+        while True:
+            time.sleep(1)
+            estimate = ntp.server_time_from_monotonic(monotonic_ms()) - wall_ms()
+            print(
+                f"peer={player_id} leader={peers.leader_id} source={peers.source} "
+                f"estimate={estimate:.3f}",
+                flush=True,
+            )
+    except KeyboardInterrupt:
+        peers.stop()
+
+
+if __name__ == "__main__":
+    main()
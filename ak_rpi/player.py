@@ -1,15 +1,40 @@
 """Player module."""
 
 import logging
+import math
+import threading
+import time
 from pathlib import Path
 from typing import Literal
 
-from pydantic import AnyHttpUrl, BaseModel, Field, IPvAnyAddress
+from pydantic import AnyHttpUrl, BaseModel, Field, IPvAnyAddress, PrivateAttr
 
 from ak_rpi.audio import AudioPlayer
-from ak_rpi.client import Client
-from ak_rpi.ntp import NTP
-from ak_rpi.utils import scan_for_exts
+from ak_rpi.client import Client, RegistrationData
+from ak_rpi.download import DownloadResult, MediaDownloader
+from ak_rpi.errors import MismatchedSerialNumberError
+from ak_rpi.latency import (
+    DEFAULT_OUTPUT_LATENCY_MS,
+    LatencyCalibrator,
+    PygameOutputDevice,
+)
+from ak_rpi.media_index import MediaIndex, MediaRoot
+from ak_rpi.metrics import (
+    LOOP_START_ERROR_MS,
+    REGISTRY,
+    STEP_DURATION_MS,
+    STEP_LATENCY_MS,
+)
+from ak_rpi.ntp import NTP, HTTPSyncTransport
+from ak_rpi.outbox import Outbox
+from ak_rpi.peer import PeerSync
+from ak_rpi.push import SettingsPush
+from ak_rpi.scheduler import Scheduler
+from ak_rpi.snapshot import PlayerSnapshot, SnapshotWriter
+from ak_rpi.stream import StreamingAudioPlayer
+from ak_rpi.timebase import monotonic_ms
+from ak_rpi.udp_sync import DEFAULT_PORT, UDPSyncTransport
+from ak_rpi.utils import boot_time_ms, process_uptime_ms
 
 logger = logging.getLogger(__name__)
 
@@ -17,7 +42,54 @@ MediaState = Literal[
     "waiting_to_sync", "syncing", "waiting_to_loop", "starting", "idle"
 ]
 
-MediaDir = Path(__file__).parent.parent / "media"
+MediaDir = MediaRoot
+
+
+class LocalConfig(BaseModel, extra="ignore"):
+    """Per-device settings read from `config.json` rather than the server."""
+
+    leader: bool = Field(
+        default=False,
+        description="Whether this player advances the shared lastTimestamp for the fleet.",
+    )
+    join: bool = Field(
+        default=True,
+        description="Whether to join the fleet's loop mid-way on startup rather than start from the beginning.",
+    )
+    sync_transport: Literal["http", "udp"] = Field(
+        default="http",
+        description="How to exchange sync timestamps; udp requires the server to run a `SyncServer`.",
+    )
+    sync_port: int = Field(
+        default=DEFAULT_PORT, gt=0, lt=65536, description="The UDP sync server's port."
+    )
+    peer_sync: bool = Field(
+        default=False,
+        description="Whether to share one clock estimate with the players on the same subnet.",
+    )
+    peer_can_lead: bool = Field(
+        default=True,
+        description="Whether this player may serve its clock to its peers.",
+    )
+    metrics_port: int | None = Field(
+        default=None,
+        ge=0,
+        lt=65536,
+        description="The localhost port to serve Prometheus metrics on, if any.",
+    )
+    metrics_textfile: str | None = Field(
+        default=None,
+        description="A `.prom` file to export metrics to for node_exporter, if any.",
+    )
+    output_latency_ms: float | None = Field(
+        default=None,
+        ge=0,
+        description="The output latency in ms, overriding calibration.",
+    )
+    latency_capture_device: str | None = Field(
+        default=None,
+        description="The capture device hearing the output, to measure its latency through.",
+    )
 
 
 class PlayerSettings(BaseModel, extra="ignore"):
@@ -40,25 +112,161 @@ class PlayerSettings(BaseModel, extra="ignore"):
     ntp: NTP = Field(..., exclude=True)
     mediaPath: str | None = Field(default=None, alias="videoPath")
     audio: AudioPlayer | None = Field(default=None, exclude=True)
+    outbox: Outbox | None = Field(
+        default=None,
+        exclude=True,
+        description="Queues reports to the server; created on first use if not provided.",
+    )
+    snapshots: SnapshotWriter | None = Field(
+        default=None,
+        exclude=True,
+        description="Writes snapshots in the background; created on first use if not provided.",
+    )
     media_state: MediaState = Field(default="idle", exclude=True)
+    preroll_ms: int = Field(
+        default=50,
+        ge=0,
+        exclude=True,
+        description="How long before a loop starts to hand it to the mixer in ms.",
+    )
+    drift_correction: bool = Field(
+        default=False,
+        exclude=True,
+        description="Whether to stream the audio and slew it towards the synced schedule.",
+    )
+    loop_start_server_time: float | None = Field(
+        default=None,
+        exclude=True,
+        description="The server time at which the current loop started in ms.",
+    )
+    restored_from_snapshot: bool = Field(
+        default=False,
+        exclude=True,
+        description="Whether the settings came from a snapshot and still need reconciling.",
+    )
+    boot_to_first_sample_ms: float | None = Field(
+        default=None,
+        exclude=True,
+        description="The time from power-on to the first audible sample in ms.",
+    )
+    leader: bool = Field(
+        default=False,
+        exclude=True,
+        description="Whether this player advances the shared lastTimestamp for the fleet.",
+    )
+    join: bool = Field(
+        default=True,
+        exclude=True,
+        description="Whether to join the fleet's loop mid-way on startup.",
+    )
+    output_latency_ms: float = Field(
+        default=DEFAULT_OUTPUT_LATENCY_MS,
+        ge=0,
+        exclude=True,
+        description="The delay from handing audio to the mixer to it being heard in ms.",
+    )
+    _reload_media: bool = PrivateAttr(default=False)
+    _peers: PeerSync | None = PrivateAttr(default=None)
+    _peer_boundary: tuple[float, float] | None = PrivateAttr(default=None)
+    _media_index: MediaIndex | None = PrivateAttr(default=None)
+    _downloader: MediaDownloader | None = PrivateAttr(default=None)
+    _push: SettingsPush | None = PrivateAttr(default=None)
+    _step_deadline: float | None = PrivateAttr(default=None)
+    _latency_calibrator: LatencyCalibrator | None = PrivateAttr(default=None)
+    _latency_pinned: bool = PrivateAttr(default=False)
+
+    def apply_local_config(self, data: dict):
+        """Apply the per-device settings from the config file.
+
+        Args:
+            data (dict): The contents of `config.json`.
+        """
+        config = LocalConfig(**data)
+        self.leader = config.leader
+        self.join = config.join
+        if config.sync_transport == "udp" and self.syncUrl.host is not None:
+            self.ntp.transport = UDPSyncTransport(
+                host=self.syncUrl.host,
+                port=config.sync_port,
+                fallback=HTTPSyncTransport(client=self.client),
+            )
+        if config.peer_sync:
+            self._peers = PeerSync(
+                ntp=self.ntp,
+                player_id=self.id,
+                tenant_id=self.tenantId,
+                work_id=self.workId,
+                can_lead=config.peer_can_lead,
+                on_boundary=self.handle_peer_boundary,
+            )
+        if config.output_latency_ms is not None:
+            self.output_latency_ms = config.output_latency_ms
+            self._latency_pinned = True
+        if config.latency_capture_device is not None:
+            self._latency_calibrator = LatencyCalibrator(
+                device=PygameOutputDevice(capture_device=config.latency_capture_device)
+            )
+        if config.metrics_port is not None:
+            REGISTRY.serve(config.metrics_port)
+        if config.metrics_textfile is not None:
+            REGISTRY.export_textfile(Path(config.metrics_textfile))
 
     def load_audio_default(self):
         """Find and load the first available audio file in the media dir.
 
-        Searches for .mp3 and .wav files in the media dir and loads the first one found.
+        Selects the first indexed .mp3 or .wav file by path, so the choice is the same
+        on every player with the same media.
 
         Mutates self to set the audio attribute.
         """
         logger.info("Attempting to load first available audio file...")
-        paths = scan_for_exts(MediaDir, ["mp3", "wav"], recursive=True)
-        if len(paths) == 0:
+        path = self.media_index.select()
+        if path is None:
             logger.error("No audio files found.")
             return
-        fpath = paths[0].as_posix()
+        fpath = path.as_posix()
         logger.info(f"Found audio file: {fpath}")
-        self.audio = AudioPlayer.Load(fpath)
+        self.audio = self.audio_player_cls.Load(fpath)
+        self.apply_gain()
         logger.info(f"Loaded audio file: {fpath}")
 
+    @property
+    def media_index(self):
+        """Get the index of the media dir, loading it and starting to watch it if needed.
+
+        Returns:
+            media_index (MediaIndex): The media index.
+        """
+        if self._media_index is None:
+            self._media_index = MediaIndex.Load(root=MediaDir)
+            self._media_index.watch(on_change=self.handle_media_index_changed)
+        return self._media_index
+
+    def handle_media_index_changed(self):
+        """Reload the media at the next loop start if a different file should now play.
+
+        Called on the index's watcher thread after files in the media dir change, e.g.
+        when the scoped file arrives or the one playing is removed. If nothing can be
+        selected any more, the loaded audio keeps playing.
+        """
+        if self.audio is None:
+            return
+        path = self.scoped_media_path
+        if path is None or not path.is_file():
+            path = self.media_index.select()
+        if path is not None and path.resolve() != self.audio.audio_file.resolve():
+            logger.info(f"Media dir changed, switching to {path} at the next loop.")
+            self.schedule_media_reload()
+
+    @property
+    def audio_player_cls(self):
+        """Get the audio player class to load media with.
+
+        Returns:
+            audio_player_cls (type[AudioPlayer]): The audio player class.
+        """
+        return StreamingAudioPlayer if self.drift_correction else AudioPlayer
+
     @property
     def scoped_media_path(self):
         """Get the scoped media path.
@@ -75,59 +283,490 @@ class PlayerSettings(BaseModel, extra="ignore"):
 
         This will attempt to load the audio file from the scoped media path (i.e. the `media/` dir).
         If no file is provided or the file does not exist it will attempt to load the first available audio file.
+        A missing file is downloaded in the background and loaded at a loop start once it is in place.
 
         Mutates self to set the audio attribute.
         """
-        if self.scoped_media_path is None:
+        media_path = self.mediaPath
+        if media_path is None:
             self.load_audio_default()
             return
-        if self.scoped_media_path.exists() and self.scoped_media_path.is_file():
-            logger.info(f"Attempting to load audio file: {self.scoped_media_path}")
-            self.audio = AudioPlayer.Load(self.scoped_media_path.as_posix())
+        scoped_media_path = MediaDir / media_path
+        if scoped_media_path.exists() and scoped_media_path.is_file():
+            logger.info(f"Attempting to load audio file: {scoped_media_path}")
+            self.audio = self.audio_player_cls.Load(scoped_media_path.as_posix())
+            self.apply_gain()
             return
+        logger.warning(
+            f"{scoped_media_path} not found, downloading it in the background."
+        )
+        self.downloader.fetch_in_background(
+            media_path, on_done=self.handle_media_downloaded
+        )
         self.load_audio_default()
         if self.audio is None:
             logger.error("Failed to load audio.")
             return
         dur = self.audio.duration
-        self.client.put_duration(self.id, dur)
+        self.reporter.put_duration(self.id, dur)
+
+    @property
+    def latency_calibrator(self):
+        """Get the calibrator of the output latency.
+
+        Returns:
+            calibrator (LatencyCalibrator): The calibrator of the mixer's output.
+        """
+        if self._latency_calibrator is None:
+            self._latency_calibrator = LatencyCalibrator(device=PygameOutputDevice())
+        return self._latency_calibrator
+
+    def calibrate_output_latency(self, measure: bool = True):
+        """Apply the output device's stored latency profile, calibrating it first if needed.
+
+        Does nothing if the latency is set in the config file.
+
+        Args:
+            measure (bool): Whether a measurement may play impulses, i.e. nothing is playing.
+        """
+        if self._latency_pinned:
+            return
+        try:
+            profile = self.latency_calibrator.calibrate(measure=measure)
+        except Exception as e:
+            logger.exception("Failed to calibrate the output latency.", exc_info=e)
+            return
+        self.output_latency_ms = profile.latency_ms
+
+    @property
+    def downloader(self):
+        """Get the media downloader.
+
+        Returns:
+            downloader (MediaDownloader): The media downloader.
+        """
+        if self._downloader is None:
+            self._downloader = MediaDownloader(client=self.client, root=MediaDir)
+        return self._downloader
+
+    def handle_media_downloaded(self, result: DownloadResult):
+        """Switch to downloaded media at the next loop start if it is still wanted.
+
+        Args:
+            result (DownloadResult): The download.
+        """
+        if self.scoped_media_path is None or self.scoped_media_path != result.path:
+            return
+        self.media_index.refresh()
+        self.schedule_media_reload()
+
+    @property
+    def reporter(self):
+        """Get the outbox that reports to the server, starting it if needed.
+
+        Returns:
+            outbox (Outbox): The outbox.
+        """
+        if self.outbox is None:
+            self.outbox = Outbox(client=self.client)
+            self.outbox.start()
+        return self.outbox
 
     def setup(self):
-        """Setup the player's media."""
-        self.ntp.sync()
+        """Setup the player's media.
+
+        A player restored from a snapshot starts playing straight away on its restored
+        clock estimate, and fetches fresh settings and syncs in the background.
+        """
+        if not self.restored_from_snapshot:
+            self.ntp.sync()
         # TODO: load file, update audio duration etc
         self.load_audio()
         if self.audio:
+            self.calibrate_output_latency()
             self.media_state = "starting"
-        self.ntp.sync()
+        self.ntp.start_background_sync()
+        # flush anything left over from before a restart
+        self.reporter.start()
+        self.push.start()
+        if self.peers is not None:
+            self.peers.start()
+        if self.restored_from_snapshot:
+            threading.Thread(
+                target=self.reconcile_in_background, name="reconcile", daemon=True
+            ).start()
+        else:
+            self.save_snapshot()
         return
 
+    @property
+    def snapshot_writer(self):
+        """Get the writer of snapshots, creating it if needed.
+
+        Returns:
+            writer (SnapshotWriter): The writer.
+        """
+        if self.snapshots is None:
+            self.snapshots = SnapshotWriter()
+        return self.snapshots
+
+    def save_snapshot(self):
+        """Save the settings and clock estimate so the next boot can start without the server.
+
+        The snapshot is taken straight away and written on the writer's thread, so this
+        is safe to call from the audio state machine.
+        """
+        self.snapshot_writer.put(PlayerSnapshot.Capture(self))
+
+    def close(self):
+        """Stop the player's background work, for a player that is being replaced.
+
+        The clock sync, the push and peer channels, the audio, the outbox, the media
+        index watcher and the snapshot writer are stopped. Reports and a snapshot
+        already queued still get a last attempt, without the caller waiting for them.
+        """
+        self.ntp.stop_background_sync()
+        if self._push is not None:
+            self._push.stop(timeout_s=0)
+        if self.peers is not None:
+            self.peers.stop()
+        if self.audio is not None:
+            self.audio.stop()
+        if self.outbox is not None:
+            self.outbox.stop(timeout_s=0)
+        if self._media_index is not None:
+            self._media_index.stop()
+            self._media_index = None
+        if self.snapshots is not None:
+            self.snapshots.stop(timeout_s=0)
+
+    def reconcile(self, fresh: "PlayerSettings"):
+        """Apply settings fetched from the server.
+
+        Gain changes take effect immediately; a change of media or work is loaded at
+        the next loop start.
+
+        Args:
+            fresh (PlayerSettings): The settings from the server.
+        """
+        media_changed = (fresh.mediaPath, fresh.workId) != (self.mediaPath, self.workId)
+        gain_changed = (fresh.volume, fresh.quietMode) != (self.volume, self.quietMode)
+        for name in fresh.model_fields_set - {"client", "ntp"}:
+            setattr(self, name, getattr(fresh, name))
+        self.restored_from_snapshot = False
+        if self._push is not None:
+            self._push.player_id = self.id
+        if self.peers is not None:
+            self.peers.player_id = self.id
+            self.peers.work_id = self.workId
+        if gain_changed:
+            logger.info(f"Gain changed to {self.gain:.2f}.")
+            self.apply_gain()
+        if media_changed:
+            logger.warning("Media changed, reloading at the next loop.")
+            self.schedule_media_reload()
+        self.save_snapshot()
+
+    def apply_update(self, update: dict):
+        """Apply changed fields pushed by the server.
+
+        Args:
+            update (dict): The changed fields, as serialized by the server.
+        """
+        current = self.model_dump(mode="json", by_alias=True)
+        fresh = PlayerSettings(
+            **{**current, **update}, client=self.client, ntp=self.ntp
+        )
+        self.reconcile(fresh)
+
+    @property
+    def push(self):
+        """Get the channel that pushes settings updates from the server.
+
+        Returns:
+            push (SettingsPush): The push channel.
+        """
+        if self._push is None:
+            self._push = SettingsPush(
+                client=self.client, player_id=self.id, on_update=self.apply_update
+            )
+        return self._push
+
+    @property
+    def peers(self):
+        """Get the clock sharing with players on the same subnet, if enabled.
+
+        Returns:
+            peers (PeerSync | None): The peer sync, or None if it is disabled.
+        """
+        return self._peers
+
+    def handle_peer_boundary(self, loop_start_server_time: float, period: float):
+        """Adopt the peer leader's loop schedule at the next loop start.
+
+        Args:
+            loop_start_server_time (float): The server time the leader's loop start is heard in ms.
+            period (float): The leader's loop period in ms.
+        """
+        self._peer_boundary = (loop_start_server_time, period)
+
+    def align_to_peer_boundary(self):
+        """Move the loop schedule onto the peer leader's if it has drifted from it."""
+        boundary, self._peer_boundary = self._peer_boundary, None
+        if (
+            boundary is None
+            or self.loop_start_server_time is None
+            or self.audio is None
+        ):
+            return
+        leader_heard, period = boundary
+        # the same file decoded at another mixer rate may differ by a fraction of a ms
+        if abs(period - self.audio.sound_ms) > 1:
+            return
+        # the leader's output may be slower or faster than ours
+        leader_start = leader_heard - self.output_latency_ms
+        k = round((self.loop_start_server_time - leader_start) / period)
+        aligned = leader_start + k * period
+        error_ms = self.loop_start_server_time - aligned
+        self.lastTimestamp = round(leader_heard)
+        if abs(error_ms) > self.audio.max_gapless_error_ms:
+            logger.info(
+                f"Moving the loop {-error_ms:.1f}ms onto the peer leader's schedule."
+            )
+            self.loop_start_server_time = aligned
+
+    @property
+    def gain(self):
+        """Get the output gain.
+
+        `quietMode` attenuates the volume, from 0 (no attenuation) to 1 (silent).
+
+        Returns:
+            gain (float): The gain, from 0 to 1.
+        """
+        return self.volume / 100 * (1 - self.quietMode)
+
+    def apply_gain(self):
+        """Apply the volume and quiet mode to the loaded audio."""
+        if self.audio is not None:
+            self.audio.set_gain(self.gain)
+
+    def fetch_fresh_settings(self):
+        """Fetch this player's settings from the server, checking they are still its own.
+
+        A snapshot's id may have been reassigned to another device since it was
+        written, in which case the player registers again rather than take over the
+        other device's settings.
+
+        Returns:
+            fresh (PlayerSettings): The settings from the server.
+        """
+        try:
+            return RegistrationData.FromId(self.id, self.client)
+        except MismatchedSerialNumberError:
+            logger.warning(
+                f"Player {self.id} belongs to another device, registering again."
+            )
+            return RegistrationData.Register(self.client)
+
+    def reconcile_in_background(self):
+        """Fetch fresh settings from the server and reconcile them, retrying until it succeeds."""
+        delay_s = 1.0
+        while self.restored_from_snapshot:
+            try:
+                fresh = self.fetch_fresh_settings()
+            except Exception as e:
+                logger.warning(
+                    f"Failed to fetch settings ({e!r}), retrying in {delay_s:.0f}s."
+                )
+                time.sleep(delay_s)
+                delay_s = min(delay_s * 2, 300.0)
+                continue
+            self.reconcile(fresh)
+            logger.info("Reconciled settings with the server.")
+
+    def record_first_sample(self, start_time: float):
+        """Record how long after power-on the first sample is heard.
+
+        Args:
+            start_time (float): The monotonic time playback starts in ms.
+        """
+        if self.boot_to_first_sample_ms is not None:
+            return
+        until_start = start_time + self.output_latency_ms - monotonic_ms()
+        self.boot_to_first_sample_ms = boot_time_ms() + until_start
+        process_ms = process_uptime_ms() + until_start
+        logger.info(
+            f"First audible sample {self.boot_to_first_sample_ms:.0f}ms after power-on "
+            f"({process_ms:.0f}ms after process start"
+            f"{', from snapshot' if self.restored_from_snapshot else ''})."
+        )
+
     def handle_audio_starting(self):
         """Handle the audio `starting` state and transitions to the `waiting_to_sync` state."""
         if self.audio is None:
             return
-        self.audio.stop()
-        self.audio.play()
-
-        st = self.ntp.server_time
-        # currently a magic number to account for audio driver latency
-        # and pygame overhead
-        # can also be tuned at the Work level using dilation.
-        latency = 100
-        self.lastTimestamp = st + latency
-        self.client.put_lastTimestamp(self.id, self.lastTimestamp)
+        if self._reload_media:
+            self._reload_media = False
+            self.audio.stop()
+            self.load_audio()
+            self.loop_start_server_time = None
+            if self.audio is None:
+                self.media_state = "idle"
+                return
+        self.align_to_peer_boundary()
+        st, offset_ms = self.plan_loop_start()
+        self.loop_start_server_time = st - offset_ms
+        start_time = self.ntp.monotonic_from_server_time(st)
+        if self.audio.can_queue_at(start_time):
+            # already on schedule, so continue gaplessly and report the exact boundary
+            boundary = self.audio.queue_next()
+            LOOP_START_ERROR_MS.labels("true").observe(boundary - start_time)
+            st = self.ntp.server_time_from_monotonic(boundary)
+            self.loop_start_server_time = st
+        else:
+            if isinstance(self.audio, StreamingAudioPlayer):
+                self.audio.reference = self.expected_position_ms
+            self.audio.play_at(start_time, offset_ms=offset_ms)
+            if not isinstance(self.audio, StreamingAudioPlayer):
+                LOOP_START_ERROR_MS.labels("false").observe(
+                    self.audio.boundary_time - (start_time - offset_ms)
+                )
+            self.record_first_sample(start_time)
+
+        # followers keep to the leader's schedule; any player may seed an empty one
+        should_report = self.leader or self.lastTimestamp is None
+        self.lastTimestamp = round(self.loop_start_server_time + self.output_latency_ms)
+        if should_report:
+            self.reporter.put_lastTimestamp(self.id, self.lastTimestamp)
+        if self.peers is not None:
+            self.peers.announce_boundary(
+                self.loop_start_server_time + self.output_latency_ms,
+                self.audio.sound_ms,
+            )
         self.media_state = "waiting_to_sync"
 
+    def plan_loop_start(self):
+        """Plan when the next loop starts, and how far into the audio.
+
+        A player joining a running fleet starts part-way through the audio, where the
+        fleet's loop will be by then, rather than restarting it.
+
+        Returns:
+            server_time (float): The server time playback starts at in ms.
+            offset_ms (float): How far into the audio playback starts in ms.
+        """
+        st = self.next_loop_start_server_time
+        if not self.join or self.loop_start_server_time is not None:
+            return st, 0.0
+        offset_ms = st - self.scheduled_loop_start(st, round_down=True)
+        if offset_ms > 0:
+            logger.info(f"Joining the loop {offset_ms:.0f}ms in.")
+        return st, offset_ms
+
+    def schedule_media_reload(self):
+        """Reload the media from `mediaPath` at the next loop start rather than interrupting the current loop."""
+        self._reload_media = True
+
+    @property
+    def loop_period_ms(self):
+        """Get the period of the fleet's loop in ms.
+
+        Returns:
+            period (float | None): The exact length of the loaded audio, or else the reported duration.
+        """
+        if self.audio is not None:
+            return self.audio.sound_ms
+        return self.duration
+
+    def scheduled_loop_start(self, server_time: float, round_down: bool = False):
+        """Get the loop start on the fleet's schedule nearest to a server time.
+
+        The schedule is every `loop_period_ms` from the last reported `lastTimestamp`.
+
+        Args:
+            server_time (float): The server time in ms.
+            round_down (bool): Whether to get the latest loop start at or before `server_time` rather than the nearest.
+
+        Returns:
+            loop_start_server_time (float): The scheduled loop start, or `server_time` if the schedule is unknown.
+        """
+        period = self.loop_period_ms
+        if self.lastTimestamp is None or not period:
+            return server_time
+        anchor = self.lastTimestamp - self.output_latency_ms
+        cycles = (server_time - anchor) / period
+        k = math.floor(cycles) if round_down else round(cycles)
+        return anchor + k * period
+
     def handle_audio_waiting_to_sync(self):
         """Handle the audio `waiting_to_sync` state and transitions to the `syncing` state."""
         if self.audio is None:
             return
         remaining_time = self.audio.remaining_ms
-        sync_time = min(20000, self.audio.duration)
         self.media_state = (
-            "waiting_to_sync" if remaining_time > sync_time else "syncing"
+            "waiting_to_sync" if remaining_time > self.sync_window_ms else "syncing"
         )
 
+    def expected_position_ms(self, monotonic_time: float):
+        """Get where in the current loop playback should be at a monotonic time.
+
+        Args:
+            monotonic_time (float): The monotonic time in ms.
+
+        Returns:
+            position (float): The expected position in ms.
+        """
+        if self.loop_start_server_time is None:
+            return 0.0
+        server_time = self.ntp.server_time_from_monotonic(monotonic_time)
+        return server_time - self.loop_start_server_time
+
+    @property
+    def next_loop_start_server_time(self):
+        """Get the server time at which the next loop should start.
+
+        This is the end of the current loop if it is still at least half a pre-roll
+        ahead, or else the first later boundary on the same schedule, so a late start
+        skips whole loops rather than leaving the schedule. Without a schedule it is one
+        pre-roll from now.
+
+        Returns:
+            next_loop_start_server_time (float): The server time in ms.
+        """
+        earliest = self.ntp.server_time + self.preroll_ms // 2
+        period = self.audio.sound_ms if self.audio is not None else 0
+        if self.loop_start_server_time is None or period <= 0:
+            return earliest + self.preroll_ms // 2
+        n_loops = max(math.ceil((earliest - self.loop_start_server_time) / period), 1)
+        return self.loop_start_server_time + n_loops * period
+
+    @property
+    def sync_window_ms(self):
+        """Get how long before the end of the loop syncing should begin in ms.
+
+        Returns:
+            sync_window_ms (float): The sync window in ms.
+        """
+        if self.audio is None:
+            return 0
+        return min(20000, self.audio.sound_ms)
+
+    @property
+    def next_transition_ms(self):
+        """Get the monotonic time at which the audio state machine next needs to run.
+
+        Returns:
+            next_transition_ms (float | None): The deadline in ms, or None if there is nothing to do.
+        """
+        if self.audio is None or self.media_state == "idle":
+            return None
+        if self.media_state == "waiting_to_sync":
+            return self.audio.end_time - self.sync_window_ms
+        if self.media_state == "waiting_to_loop":
+            return self.audio.end_time - self.preroll_ms
+        return monotonic_ms()
+
     def audio_machine(self):
         """The audio state machine for cooperative multi-tasking."""
         if self.audio is None:
@@ -137,14 +776,49 @@ class PlayerSettings(BaseModel, extra="ignore"):
         if self.media_state == "waiting_to_sync":
             self.handle_audio_waiting_to_sync()
         if self.media_state == "syncing":
-            self.ntp.sync()
+            if self.ntp.needs_sync:
+                self.ntp.request_sync()
+            self.save_snapshot()
             self.media_state = "waiting_to_loop"
         if self.media_state == "waiting_to_loop":
-            # TODO: should we do a blocking await here?
             remaining_time = self.audio.remaining_ms
-            self.media_state = "waiting_to_loop" if remaining_time > 0 else "starting"
+            self.media_state = (
+                "waiting_to_loop" if remaining_time > self.preroll_ms else "starting"
+            )
 
-    def run(self):
-        """Run the player."""
-        while True:
-            self.audio_machine()
+    def step(self, scheduler: Scheduler):
+        """Advance the audio state machine and schedule the next step at its deadline.
+
+        Args:
+            scheduler (Scheduler): The scheduler driving the player.
+        """
+        state = self.media_state
+        was_starting = state == "starting"
+        started = monotonic_ms()
+        if self._step_deadline is not None:
+            STEP_LATENCY_MS.labels(state).observe(started - self._step_deadline)
+        self.audio_machine()
+        STEP_DURATION_MS.labels(state).observe(monotonic_ms() - started)
+        if (
+            was_starting
+            and self.audio is not None
+            and not isinstance(self.audio, StreamingAudioPlayer)
+        ):
+            self.audio.watch_boundary(scheduler)
+        deadline = self.next_transition_ms
+        if deadline is None:
+            logger.error("Audio state machine has no further transitions.")
+            self._step_deadline = None
+            return
+        self._step_deadline = deadline
+        scheduler.call_at(deadline, self.step, scheduler)
+
+    def run(self, scheduler: Scheduler | None = None):
+        """Run the player.
+
+        Args:
+            scheduler (Scheduler | None): The scheduler to run on; a new one is created if not provided.
+        """
+        scheduler = scheduler or Scheduler()
+        scheduler.call_soon(self.step, scheduler)
+        scheduler.run()
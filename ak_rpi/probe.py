@@ -0,0 +1,362 @@
+"""In-process media duration and format probing."""
+
+import functools
+import logging
+import mmap
+import struct
+from pathlib import Path
+from typing import Literal, NamedTuple
+
+from pydantic import BaseModel, Field
+
+logger = logging.getLogger(__name__)
+
+ProbeMethod = Literal["wav-header", "mp3-xing", "mp3-vbri", "mp3-frames", "decoded"]
+
+# bitrates in kbps indexed by [version is MPEG1][layer][bitrate index]
+_MP3_BITRATES = {
+    (True, 1): [0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448],
+    (True, 2): [0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384],
+    (True, 3): [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320],
+    (False, 1): [0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256],
+    (False, 2): [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+    (False, 3): [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+}
+# sample rates indexed by version bits (0: MPEG2.5, 2: MPEG2, 3: MPEG1)
+_MP3_SAMPLE_RATES = {
+    0: [11025, 12000, 8000],
+    2: [22050, 24000, 16000],
+    3: [44100, 48000, 32000],
+}
+
+# the optional Xing/Info fields as (flag, size): frames, bytes, table of contents, quality
+_XING_FIELDS = ((0x1, 4), (0x2, 4), (0x4, 100), (0x8, 4))
+
+
+class MediaInfo(BaseModel):
+    """The duration and format of a media file."""
+
+    duration_ms: float = Field(
+        ...,
+        description="The playable duration in ms, without any encoder delay and padding.",
+    )
+    sample_rate: int | None = Field(default=None, description="The sample rate in Hz.")
+    channels: int | None = Field(default=None, description="The number of channels.")
+    codec: str = Field(..., description="The codec, e.g. `pcm` or `mp3`.")
+    method: ProbeMethod = Field(..., description="How the duration was determined.")
+    padding_ms: float = Field(
+        default=0,
+        description="The encoder delay and padding which decoders trim from the frames in "
+        "ms. Durations read from the container, such as ffprobe's, include it.",
+    )
+
+
+class _MP3Frame(NamedTuple):
+    mpeg1: bool
+    layer: int
+    sample_rate: int
+    channels: int
+    length: int
+    samples: int
+
+
+def _parse_mp3_header(header: bytes):
+    """Parse a 4-byte MPEG audio frame header, returning None if it is not valid."""
+    if len(header) < 4 or header[0] != 0xFF or header[1] & 0xE0 != 0xE0:
+        return None
+    version_bits = (header[1] >> 3) & 0x3
+    layer_bits = (header[1] >> 1) & 0x3
+    bitrate_ix = header[2] >> 4
+    rate_ix = (header[2] >> 2) & 0x3
+    if version_bits == 1 or layer_bits == 0 or bitrate_ix in (0, 15) or rate_ix == 3:
+        return None
+    mpeg1 = version_bits == 3
+    layer = 4 - layer_bits
+    bitrate = _MP3_BITRATES[(mpeg1, layer)][bitrate_ix] * 1000
+    sample_rate = _MP3_SAMPLE_RATES[version_bits][rate_ix]
+    padding = (header[2] >> 1) & 0x1
+    channels = 1 if header[3] >> 6 == 3 else 2
+    if layer == 1:
+        length = (12 * bitrate // sample_rate + padding) * 4
+        samples = 384
+    elif layer == 2 or mpeg1:
+        length = 144 * bitrate // sample_rate + padding
+        samples = 1152
+    else:
+        length = 72 * bitrate // sample_rate + padding
+        samples = 576
+    return _MP3Frame(
+        mpeg1=mpeg1,
+        layer=layer,
+        sample_rate=sample_rate,
+        channels=channels,
+        length=length,
+        samples=samples,
+    )
+
+
+class _MP3Tag(NamedTuple):
+    n_frames: int | None
+    delay: int
+    padding: int
+    method: ProbeMethod
+
+
+def _mp3_info(
+    first: _MP3Frame, n_frames: int, delay: int, padding: int, method: ProbeMethod
+):
+    total = n_frames * first.samples
+    playable = max(total - delay - padding, 0)
+    return MediaInfo(
+        duration_ms=playable * 1000 / first.sample_rate,
+        sample_rate=first.sample_rate,
+        channels=first.channels,
+        codec="mp3",
+        method=method,
+        padding_ms=(total - playable) * 1000 / first.sample_rate,
+    )
+
+
+def _skip_id3v2(data: mmap.mmap | bytes):
+    """Get the offset of the first byte after any ID3v2 tags."""
+    offset = 0
+    while data[offset : offset + 3] == b"ID3" and len(data) >= offset + 10:
+        size_bytes = data[offset + 6 : offset + 10]
+        # the tag size is a 28-bit "syncsafe" integer
+        size = 0
+        for b in size_bytes:
+            size = (size << 7) | (b & 0x7F)
+        has_footer = data[offset + 5] & 0x10
+        offset += 10 + size + (10 if has_footer else 0)
+    return offset
+
+
+def probe_wav(path: Path):
+    """Probe a RIFF/WAVE file from its header.
+
+    Args:
+        path (Path): The file.
+
+    Returns:
+        info (MediaInfo | None): The media info, or None if the header could not be parsed.
+    """
+    with open(path, "rb") as f:
+        riff = f.read(12)
+        if len(riff) < 12 or riff[:4] != b"RIFF" or riff[8:12] != b"WAVE":
+            return None
+        channels = sample_rate = block_align = None
+        while chunk_header := f.read(8):
+            if len(chunk_header) < 8:
+                break
+            chunk_id, chunk_size = struct.unpack("<4sI", chunk_header)
+            if chunk_id == b"fmt ":
+                fmt = f.read(chunk_size)
+                _, channels, sample_rate, _, block_align = struct.unpack(
+                    "<HHIIH", fmt[:14]
+                )
+                f.seek(chunk_size % 2, 1)
+            elif chunk_id == b"data":
+                if not sample_rate or not block_align:
+                    return None
+                # a streamed wav may leave the data size unset; fall back to the file size
+                data_size = (
+                    chunk_size
+                    if chunk_size not in (0, 0xFFFFFFFF)
+                    else path.stat().st_size - f.tell()
+                )
+                n_frames = data_size // block_align
+                return MediaInfo(
+                    duration_ms=n_frames * 1000 / sample_rate,
+                    sample_rate=sample_rate,
+                    channels=channels,
+                    codec="pcm",
+                    method="wav-header",
+                )
+            else:
+                f.seek(chunk_size + chunk_size % 2, 1)
+    return None
+
+
+def _sync(data: mmap.mmap | bytes, offset: int):
+    """Find the first frame at or after `offset` which is followed by another frame.
+
+    Requiring a second header (or the end of the data) keeps stray sync bytes in tags and
+    damaged data from being taken for frames.
+
+    Returns:
+        found (tuple[int, _MP3Frame] | None): The offset and header of the frame, or None.
+    """
+    while (offset := data.find(b"\xff", offset)) != -1 and offset + 4 <= len(data):
+        frame = _parse_mp3_header(data[offset : offset + 4])
+        if frame is not None:
+            following = offset + frame.length
+            if following >= len(data) or _parse_mp3_header(
+                data[following : following + 4]
+            ):
+                return offset, frame
+        offset += 1
+    return None
+
+
+def _read_vbr_tag(data: mmap.mmap | bytes, offset: int, first: _MP3Frame):
+    """Read the Xing/Info header, with any LAME extension, or the VBRI header of a frame.
+
+    Returns:
+        tag (_MP3Tag | None): The frame count, if given, and the encoder delay and padding
+            in samples, or None if the frame carries no header.
+    """
+    # the Xing/Info header sits after the side information
+    if first.mpeg1:
+        side_info = 17 if first.channels == 1 else 32
+    else:
+        side_info = 9 if first.channels == 1 else 17
+    xing = offset + 4 + side_info
+    if data[xing : xing + 4] in (b"Xing", b"Info"):
+        (flags,) = struct.unpack(">I", data[xing + 4 : xing + 8])
+        n_frames = None
+        if flags & 0x1:
+            (n_frames,) = struct.unpack(">I", data[xing + 8 : xing + 12])
+        lame = xing + 8 + sum(size for bit, size in _XING_FIELDS if flags & bit)
+        delay = padding = 0
+        if data[lame : lame + 4] in (b"LAME", b"Lavf", b"Lavc"):
+            # two 12-bit sample counts, 21 bytes into the LAME extension
+            packed = int.from_bytes(data[lame + 21 : lame + 24], "big")
+            delay, padding = packed >> 12, packed & 0xFFF
+        return _MP3Tag(n_frames, delay, padding, "mp3-xing")
+    vbri = offset + 4 + 32
+    if data[vbri : vbri + 4] == b"VBRI":
+        (n_frames,) = struct.unpack(">I", data[vbri + 14 : vbri + 18])
+        return _MP3Tag(n_frames, 0, 0, "mp3-vbri")
+    return None
+
+
+def _count_frames(data: mmap.mmap | bytes, offset: int):
+    """Count the complete frames from `offset`, resynchronizing past anything else."""
+    n_frames = 0
+    while offset + 4 <= len(data):
+        frame = _parse_mp3_header(data[offset : offset + 4])
+        if frame is None:
+            found = _sync(data, offset + 1)
+            if found is None:
+                break
+            offset, frame = found
+        if offset + frame.length > len(data):
+            break
+        n_frames += 1
+        offset += frame.length
+    return n_frames
+
+
+def probe_mp3(path: Path):
+    """Probe an MP3 file from its Xing/Info or VBRI header, or by scanning its frames.
+
+    The encoder delay and padding from a LAME extension are subtracted, so the duration
+    is that of the decoded audio.
+
+    Args:
+        path (Path): The file.
+
+    Returns:
+        info (MediaInfo | None): The media info, or None if no valid frames were found.
+    """
+    with open(path, "rb") as f:
+        if path.stat().st_size == 0:
+            return None
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    with data:
+        found = _sync(data, _skip_id3v2(data))
+        if found is None:
+            return None
+        offset, first = found
+        tag = _read_vbr_tag(data, offset, first)
+        if tag is None:
+            return _mp3_info(first, _count_frames(data, offset), 0, 0, "mp3-frames")
+        if tag.n_frames is None:
+            # the tag's frame decodes to nothing, so count only the frames after it
+            n_frames = _count_frames(data, offset + first.length)
+            return _mp3_info(first, n_frames, tag.delay, tag.padding, "mp3-frames")
+        return _mp3_info(first, tag.n_frames, tag.delay, tag.padding, tag.method)
+
+
+def probe_decoded(path: Path):
+    """Probe a file by decoding it and counting samples.
+
+    The decoded PCM is kept in the PCM cache, so this also warms the load path.
+
+    Args:
+        path (Path): The file.
+
+    Returns:
+        info (MediaInfo): The media info.
+    """
+    from ak_rpi.audio import init_mixer
+    from ak_rpi.pcm_cache import PCMCache
+
+    frequency, size, channels = init_mixer()
+    pcm, _ = PCMCache().open(path)
+    with pcm:
+        n_frames = len(pcm) // (abs(size) // 8 * channels)
+    return MediaInfo(
+        duration_ms=n_frames * 1000 / frequency,
+        sample_rate=frequency,
+        channels=channels,
+        codec=path.suffix.lstrip(".").lower(),
+        method="decoded",
+    )
+
+
+@functools.lru_cache(maxsize=256)
+def _probe(path: Path, size: int, mtime_ns: int):
+    suffix = path.suffix.lower()
+    info = None
+    if suffix == ".wav":
+        info = probe_wav(path)
+    elif suffix == ".mp3":
+        info = probe_mp3(path)
+    if info is None:
+        logger.warning(f"Could not probe {path} from its headers, decoding it.")
+        info = probe_decoded(path)
+    return info
+
+
+def probe(path: Path | str):
+    """Determine the duration and format of a media file without spawning a process.
+
+    Results are cached per file path, size and modification time.
+
+    Args:
+        path (Path | str): The file.
+
+    Returns:
+        info (MediaInfo): The media info.
+    """
+    path = Path(path).resolve()
+    stat = path.stat()
+    return _probe(path, stat.st_size, stat.st_mtime_ns)
+
+
+def compare_with_ffprobe(paths: list[Path]):
+    """Compare probed durations with those reported by ffprobe.
+
+    Requires ffmpeg to be installed; intended for checking accuracy on a test corpus.
+    ffprobe reports the duration of all frames, so it is compared with the probed
+    duration plus the encoder delay and padding.
+
+    Args:
+        paths (list[Path]): The files to compare.
+
+    Returns:
+        errors (dict[Path, float]): The probed minus ffprobe duration for each file in ms.
+    """
+    from pydub.utils import mediainfo
+
+    errors: dict[Path, float] = {}
+    for path in paths:
+        expected = float(mediainfo(Path(path).as_posix())["duration"]) * 1000
+        info = probe(path)
+        errors[path] = info.duration_ms + info.padding_ms - expected
+        logger.info(
+            f"{path}: probed {info.duration_ms:.1f}ms via {info.method}, "
+            f"ffprobe {expected:.1f}ms"
+        )
+    return errors
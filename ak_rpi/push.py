@@ -0,0 +1,231 @@
+"""Settings updates pushed from the server over server-sent events."""
+
+import contextlib
+import json
+import logging
+import threading
+from collections.abc import Callable, Iterable, Iterator
+from typing import Any
+
+import httpx
+from pydantic import BaseModel, Field, PrivateAttr
+
+from ak_rpi.client import Client
+
+logger = logging.getLogger(__name__)
+
+
+class ServerEvent(BaseModel):
+    """A server-sent event, see the `text/event-stream` format in the HTML standard."""
+
+    event: str = Field(default="message", description="The event type.")
+    data: str = Field(default="", description="The event data.")
+    id: str | None = Field(default=None, description="The event id, if it set one.")
+    retry_ms: int | None = Field(
+        default=None,
+        description="The reconnection delay requested by the server in ms.",
+    )
+
+
+def parse_events(lines: Iterable[str]) -> Iterator[ServerEvent]:
+    """Parse a stream of lines into server-sent events.
+
+    Args:
+        lines (Iterable[str]): The lines of the stream, without line endings.
+
+    Returns:
+        events (Iterator[ServerEvent]): The events, dispatched at each blank line.
+    """
+    fields: dict[str, Any] = {}
+    data: list[str] = []
+    for line in lines:
+        if not line:
+            if data or fields:
+                yield ServerEvent(**fields, data="\n".join(data))
+            fields, data = {}, []
+            continue
+        if line.startswith(":"):
+            # a comment, which servers send as a heartbeat
+            continue
+        name, _, value = line.partition(":")
+        value = value.removeprefix(" ")
+        if name == "data":
+            data.append(value)
+        elif name == "event":
+            fields["event"] = value
+        elif name == "id" and "\0" not in value:
+            fields["id"] = value
+        elif name == "retry" and value.isdigit():
+            fields["retry_ms"] = int(value)
+
+
+class SettingsPush(BaseModel, arbitrary_types_allowed=True):
+    """Keeps a player's settings current from a persistent server-sent event stream.
+
+    The stream carries `settings` events whose data is a JSON object of changed
+    fields. Each time the stream (re)connects, the full settings are fetched with
+    `If-None-Match` on the last seen ETag, after the stream is open so that no update
+    can fall between the two; an unchanged player costs a 304. The `Last-Event-ID`
+    header lets a server that keeps a history replay missed events instead, and a
+    `resync` event forces a full fetch. Reconnects back off exponentially while the
+    server is unreachable and reset once a stream is established.
+    """
+
+    client: Client
+    player_id: int
+    on_update: Callable[[dict[str, Any]], Any] = Field(
+        ..., description="Called on the push thread with each set of changed fields."
+    )
+    url_template: str = Field(
+        default="/api/mediaplayer/{id}/events",
+        description="The url of the event stream relative to the sync server.",
+    )
+    reconnect_base_s: float = Field(
+        default=1.0, gt=0, description="The delay before the first reconnect in s."
+    )
+    reconnect_max_s: float = Field(
+        default=60.0, gt=0, description="The longest delay between reconnects in s."
+    )
+    read_timeout_s: float = Field(
+        default=90.0,
+        gt=0,
+        description="How long to wait for data or a heartbeat before reconnecting in s.",
+    )
+    last_event_id: str | None = Field(
+        default=None, description="The id of the last event received."
+    )
+    etag: str | None = Field(
+        default=None, description="The ETag of the last full settings fetched."
+    )
+    _stop_requested: threading.Event = PrivateAttr(default_factory=threading.Event)
+    _worker: threading.Thread | None = PrivateAttr(default=None)
+    _response: httpx.Response | None = PrivateAttr(default=None)
+    _connected: bool = PrivateAttr(default=False)
+    _retry_ms: int | None = PrivateAttr(default=None)
+
+    @property
+    def url(self):
+        """Get the url of the event stream."""
+        return self.url_template.format(id=self.player_id)
+
+    def start(self):
+        """Start listening for updates on a daemon thread."""
+        if self._worker is not None and self._worker.is_alive():
+            return
+        self._stop_requested.clear()
+        self._worker = threading.Thread(
+            target=self._run, name="settings-push", daemon=True
+        )
+        self._worker.start()
+
+    def stop(self, timeout_s: float | None = 5.0):
+        """Stop listening for updates.
+
+        Args:
+            timeout_s (float | None): How long to wait for the thread to finish.
+        """
+        self._stop_requested.set()
+        response = self._response
+        if response is not None:
+            # closing unblocks the push thread's read; the stream is discarded anyway
+            with contextlib.suppress(httpx.HTTPError, httpx.StreamError, OSError):
+                response.close()
+        if self._worker is not None:
+            self._worker.join(timeout_s)
+            self._worker = None
+
+    def resync(self):
+        """Fetch the full settings unless they are unchanged since the last fetch.
+
+        Returns:
+            changed (bool): Whether the settings changed.
+        """
+        headers = {} if self.etag is None else {"If-None-Match": self.etag}
+        response = self.client.request(
+            "GET", f"/api/mediaplayer/{self.player_id}", headers=headers
+        )
+        if response.status_code == 304:
+            return False
+        response.raise_for_status()
+        self.etag = response.headers.get("ETag")
+        self.on_update(response.json())
+        return True
+
+    def handle_event(self, event: ServerEvent):
+        """Apply a server-sent event.
+
+        Args:
+            event (ServerEvent): The event.
+        """
+        if event.event == "settings":
+            try:
+                update = json.loads(event.data)
+            except json.JSONDecodeError as e:
+                logger.warning(f"Ignoring malformed settings event: {e!r}")
+                return
+            logger.info(f"Pushed settings update: {sorted(update)}")
+            self.on_update(update)
+            # the cached settings no longer match what we hold
+            self.etag = None
+        elif event.event == "resync":
+            self.resync()
+        if event.id is not None:
+            self.last_event_id = event.id
+
+    def _listen(self):
+        """Consume the stream until it ends."""
+        headers = {"Accept": "text/event-stream", "Cache-Control": "no-cache"}
+        if self.last_event_id is not None:
+            headers["Last-Event-ID"] = self.last_event_id
+        timeout = httpx.Timeout(
+            self.client.options.timeout_s,
+            connect=self.client.options.connect_timeout_s,
+            read=self.read_timeout_s,
+        )
+        with self.client.client.stream(
+            "GET", self.url, headers=headers, timeout=timeout
+        ) as response:
+            if response.status_code != 200:
+                response.read()
+                msg = f"{response.status_code}: {response.text}"
+                raise httpx.HTTPStatusError(
+                    msg, request=response.request, response=response
+                )
+            self._response = response
+            try:
+                self.resync()
+                self._connected = True
+                for event in parse_events(response.iter_lines()):
+                    if event.retry_ms is not None:
+                        self._retry_ms = event.retry_ms
+                    self.handle_event(event)
+            finally:
+                self._response = None
+
+    def _run(self):
+        delay_s = self.reconnect_base_s
+        while not self._stop_requested.is_set():
+            self._connected = False
+            error = None
+            try:
+                self._listen()
+            except Exception as e:
+                error = e
+            if self._stop_requested.is_set():
+                return
+            if self._connected:
+                # the server was reachable, so start backing off afresh
+                delay_s = (
+                    self.reconnect_base_s
+                    if self._retry_ms is None
+                    else self._retry_ms / 1000
+                )
+            if error is None:
+                logger.info(f"Settings stream ended, reconnecting in {delay_s:.0f}s.")
+            else:
+                logger.warning(
+                    f"Settings stream failed ({error!r}), reconnecting in {delay_s:.0f}s."
+                )
+            if self._stop_requested.wait(delay_s):
+                return
+            delay_s = min(delay_s * 2, self.reconnect_max_s)
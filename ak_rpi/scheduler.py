@@ -0,0 +1,161 @@
+"""A timed-callback scheduler which sleeps until the next deadline."""
+
+import heapq
+import itertools
+import logging
+import threading
+from collections.abc import Callable
+from typing import Any
+
+from pydantic import BaseModel, Field, PrivateAttr
+
+from ak_rpi.timebase import NS_PER_MS, monotonic_ms, wait_until_ms
+
+logger = logging.getLogger(__name__)
+
+
+class ScheduledCallback(BaseModel, arbitrary_types_allowed=True):
+    """A handle for a callback registered with the scheduler."""
+
+    when_ms: float = Field(..., description="The monotonic deadline in ms.")
+    callback: Callable[..., Any]
+    args: tuple = ()
+    cancelled: bool = False
+
+    def cancel(self):
+        """Cancel the callback; it will be skipped when its deadline arrives."""
+        self.cancelled = True
+
+
+class Scheduler(BaseModel):
+    """A scheduler which runs callbacks at monotonic deadlines.
+
+    Rather than polling, the scheduler sleeps until shortly before the next
+    deadline and then spins for the remaining `spin_ms` so that callbacks fire
+    with sub-millisecond accuracy while leaving the CPU idle in between.
+    Callbacks may be registered from other threads; doing so wakes the scheduler
+    so it can recompute its next deadline.
+    """
+
+    spin_ms: float = Field(
+        default=0.3,
+        ge=0,
+        description="How long before a deadline to stop sleeping and start spinning in ms.",
+    )
+    _queue: list[tuple[float, int, ScheduledCallback]] = PrivateAttr(
+        default_factory=list
+    )
+    _counter: itertools.count = PrivateAttr(default_factory=itertools.count)
+    _lock: threading.Lock = PrivateAttr(default_factory=threading.Lock)
+    _wakeup: threading.Event = PrivateAttr(default_factory=threading.Event)
+    _running: bool = PrivateAttr(default=False)
+
+    def call_at(
+        self, when_ms: float, callback: Callable[..., Any], *args: Any
+    ) -> ScheduledCallback:
+        """Register a callback to run at a monotonic deadline.
+
+        Args:
+            when_ms (float): The monotonic deadline in ms (see `ak_rpi.timebase.monotonic_ms`).
+            callback (Callable): The callback to run.
+            *args (Any): Positional arguments for the callback.
+
+        Returns:
+            handle (ScheduledCallback): A handle which can be used to cancel the callback.
+        """
+        handle = ScheduledCallback(when_ms=when_ms, callback=callback, args=args)
+        with self._lock:
+            heapq.heappush(self._queue, (when_ms, next(self._counter), handle))
+        self._wakeup.set()
+        return handle
+
+    def call_later(
+        self, delay_ms: float, callback: Callable[..., Any], *args: Any
+    ) -> ScheduledCallback:
+        """Register a callback to run after a delay.
+
+        Args:
+            delay_ms (float): The delay in ms.
+            callback (Callable): The callback to run.
+            *args (Any): Positional arguments for the callback.
+
+        Returns:
+            handle (ScheduledCallback): A handle which can be used to cancel the callback.
+        """
+        return self.call_at(monotonic_ms() + delay_ms, callback, *args)
+
+    def call_soon(self, callback: Callable[..., Any], *args: Any) -> ScheduledCallback:
+        """Register a callback to run as soon as possible.
+
+        Args:
+            callback (Callable): The callback to run.
+            *args (Any): Positional arguments for the callback.
+
+        Returns:
+            handle (ScheduledCallback): A handle which can be used to cancel the callback.
+        """
+        return self.call_at(monotonic_ms(), callback, *args)
+
+    @property
+    def next_deadline_ms(self) -> float | None:
+        """Get the deadline of the next pending callback.
+
+        Returns:
+            deadline (float | None): The monotonic deadline in ms, or None if nothing is scheduled.
+        """
+        with self._lock:
+            while self._queue and self._queue[0][2].cancelled:
+                heapq.heappop(self._queue)
+            return self._queue[0][0] if self._queue else None
+
+    def wait_until(self, deadline_ms: float):
+        """Block until a monotonic deadline.
+
+        Sleeps until `spin_ms` before the deadline, then spins (see
+        `ak_rpi.timebase.wait_until_ns`). The sleep is interrupted if a new callback is
+        registered, so the caller can re-evaluate the next deadline.
+
+        Args:
+            deadline_ms (float): The monotonic deadline in ms.
+        """
+        wait_until_ms(deadline_ms, round(self.spin_ms * NS_PER_MS), self._wakeup)
+
+    def run_pending(self) -> int:
+        """Run all callbacks whose deadline has passed.
+
+        Returns:
+            n_run (int): The number of callbacks run.
+        """
+        # private attributes are slow to read on a model, so bind them once: this runs
+        # between a deadline and its callback
+        lock, queue = self._lock, self._queue
+        n_run = 0
+        while True:
+            with lock:
+                if not queue or queue[0][0] > monotonic_ms():
+                    return n_run
+                _, _, handle = heapq.heappop(queue)
+            if handle.cancelled:
+                continue
+            handle.callback(*handle.args)
+            n_run += 1
+
+    def run(self):
+        """Run callbacks as their deadlines arrive until stopped or nothing is scheduled."""
+        self._running = True
+        wakeup = self._wakeup
+        while self._running:
+            if wakeup.is_set():
+                wakeup.clear()
+            self.run_pending()
+            deadline = self.next_deadline_ms
+            if deadline is None:
+                logger.info("No callbacks scheduled, stopping scheduler.")
+                break
+            self.wait_until(deadline)
+        self._running = False
+
+    def stop(self):
+        """Stop the scheduler after the current callback returns."""
+        self._running = False
+        self._wakeup.set()
@@ -0,0 +1,218 @@
+"""Snapshots of the player settings and clock model for booting without the server."""
+
+import logging
+import os
+import threading
+import time
+from pathlib import Path
+from typing import TYPE_CHECKING, Any
+
+from pydantic import BaseModel, Field, PrivateAttr, ValidationError
+
+from ak_rpi.client import Client
+from ak_rpi.ntp import NTP, ClockModel, ClockSample
+
+if TYPE_CHECKING:
+    from ak_rpi.player import PlayerSettings
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_PATH = Path("snapshot.json")
+
+
+class ClockSnapshot(BaseModel):
+    """The state of the clock estimate.
+
+    The model is expressed in `NTP.local_time`, which is anchored to the wall clock at
+    startup, so it remains meaningful across restarts as long as the system clock is.
+    """
+
+    model: ClockModel
+    samples: list[ClockSample] = Field(
+        default_factory=list, description="The estimator's window of samples."
+    )
+
+    @classmethod
+    def Capture(cls, ntp: NTP):
+        """Capture the clock estimate of an NTP instance.
+
+        Args:
+            ntp (NTP): The NTP instance.
+
+        Returns:
+            snapshot (ClockSnapshot | None): The snapshot, or None if no sync has succeeded.
+        """
+        model = ntp.clock_model
+        if model is None:
+            return None
+        return cls(model=model, samples=list(ntp.estimator.samples))
+
+
+class PlayerSnapshot(BaseModel):
+    """The last known player settings and clock estimate."""
+
+    settings: dict[str, Any] = Field(
+        ..., description="The serialized player settings, as returned by the server."
+    )
+    clock: ClockSnapshot | None = None
+    output_latency_ms: float | None = Field(
+        default=None, description="The player's calibrated output latency in ms."
+    )
+    saved_at: float = Field(
+        default_factory=time.time, description="The wall-clock time it was saved in s."
+    )
+
+    @property
+    def player_id(self) -> int | None:
+        """Get the id of the player the snapshot belongs to."""
+        return self.settings.get("id")
+
+    @classmethod
+    def Capture(cls, player: "PlayerSettings"):
+        """Capture the settings and clock estimate of a player.
+
+        Args:
+            player (PlayerSettings): The player.
+
+        Returns:
+            snapshot (PlayerSnapshot): The snapshot.
+        """
+        return cls(
+            settings=player.model_dump(mode="json", by_alias=True),
+            clock=ClockSnapshot.Capture(player.ntp),
+            output_latency_ms=player.output_latency_ms,
+        )
+
+    def save(self, path: Path = SNAPSHOT_PATH):
+        """Atomically write the snapshot to disk.
+
+        Args:
+            path (Path): The file to write.
+        """
+        tmp = path.with_suffix(".tmp")
+        with open(tmp, "w") as f:
+            f.write(self.model_dump_json())
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+
+    @classmethod
+    def Load(cls, path: Path = SNAPSHOT_PATH):
+        """Read a snapshot from disk.
+
+        Args:
+            path (Path): The file to read.
+
+        Returns:
+            snapshot (PlayerSnapshot | None): The snapshot, or None if it is missing or invalid.
+        """
+        try:
+            with open(path) as f:
+                return cls.model_validate_json(f.read())
+        except FileNotFoundError:
+            return None
+        except ValidationError as e:
+            logger.exception(f"Ignoring invalid snapshot {path}.", exc_info=e)
+            return None
+
+    def restore(self, client: Client):
+        """Rebuild the player from the snapshot.
+
+        Args:
+            client (Client): The client to bind the player to.
+
+        Returns:
+            player (PlayerSettings): The player, marked as restored from a snapshot.
+        """
+        from ak_rpi.player import PlayerSettings
+
+        ntp = NTP(client=client)
+        if self.clock is not None:
+            ntp.restore(self.clock.model, self.clock.samples)
+        age_s = time.time() - self.saved_at
+        logger.info(
+            f"Restored player {self.player_id} from a snapshot {age_s:.0f}s old."
+        )
+        player = PlayerSettings(
+            **self.settings, client=client, ntp=ntp, restored_from_snapshot=True
+        )
+        if self.output_latency_ms is not None:
+            player.output_latency_ms = self.output_latency_ms
+        return player
+
+
+class SnapshotWriter(BaseModel):
+    """Writes snapshots on a daemon thread, so the fsync never stalls the caller.
+
+    Only the latest snapshot is kept, so snapshots taken while one is being written
+    coalesce into a single write.
+    """
+
+    path: Path = Field(default=SNAPSHOT_PATH, description="The file to write.")
+    _latest: PlayerSnapshot | None = PrivateAttr(default=None)
+    _lock: threading.Lock = PrivateAttr(default_factory=threading.Lock)
+    _wakeup: threading.Event = PrivateAttr(default_factory=threading.Event)
+    _idle: threading.Event = PrivateAttr(default_factory=threading.Event)
+    _worker: threading.Thread | None = PrivateAttr(default=None)
+    _stop_requested: threading.Event = PrivateAttr(default_factory=threading.Event)
+
+    def put(self, snapshot: PlayerSnapshot):
+        """Queue a snapshot to be written, replacing any not yet written.
+
+        Args:
+            snapshot (PlayerSnapshot): The snapshot.
+        """
+        with self._lock:
+            self._latest = snapshot
+            self._idle.clear()
+            if self._worker is None or not self._worker.is_alive():
+                self._stop_requested.clear()
+                self._worker = threading.Thread(
+                    target=self._run, name="snapshot", daemon=True
+                )
+                self._worker.start()
+        self._wakeup.set()
+
+    def model_post_init(self, __context):
+        """Start out with nothing to write."""
+        self._idle.set()
+
+    def wait(self, timeout_s: float | None = None):
+        """Wait until every queued snapshot has been written.
+
+        Args:
+            timeout_s (float | None): How long to wait in seconds.
+
+        Returns:
+            written (bool): True if nothing is left to write.
+        """
+        return self._idle.wait(timeout_s)
+
+    def stop(self, timeout_s: float | None = 5.0):
+        """Stop the writing thread once the queued snapshot is written.
+
+        Args:
+            timeout_s (float | None): How long to wait for the thread to finish.
+        """
+        self._stop_requested.set()
+        self._wakeup.set()
+        if self._worker is not None:
+            self._worker.join(timeout_s)
+            self._worker = None
+
+    def _run(self):
+        while True:
+            self._wakeup.wait()
+            self._wakeup.clear()
+            with self._lock:
+                snapshot, self._latest = self._latest, None
+            if snapshot is not None:
+                try:
+                    snapshot.save(self.path)
+                except OSError as e:
+                    logger.exception("Failed to save snapshot.", exc_info=e)
+            with self._lock:
+                if self._latest is None:
+                    self._idle.set()
+            if self._stop_requested.is_set() and self._idle.is_set():
+                return
@@ -0,0 +1,456 @@
+"""Streaming audio playback with continuous drift correction."""
+
+import logging
+import math
+import threading
+import time
+import warnings
+from collections.abc import Callable
+from pathlib import Path
+
+import psutil
+import pygame
+from pydantic import BaseModel, Field, PrivateAttr
+
+from ak_rpi.audio import AudioPlayer, init_mixer, silence
+from ak_rpi.errors import StreamingError
+from ak_rpi.pcm_cache import PCMCache
+from ak_rpi.pcm_source import (
+    BufferedSource,
+    FFmpegSource,
+    MappedSource,
+    MemorySource,
+    PCMSource,
+    WavSource,
+)
+from ak_rpi.probe import probe
+from ak_rpi.timebase import monotonic_ms
+
+with warnings.catch_warnings():
+    # audioop is deprecated but available on every python this package supports,
+    # and is the only dependency-free C resampler in the standard library.
+    warnings.simplefilter("ignore", DeprecationWarning)
+    import audioop
+
+logger = logging.getLogger(__name__)
+
+
+def silence_bytes(n_frames: int, frame_bytes: int):
+    """Get silent signed PCM.
+
+    Args:
+        n_frames (int): The number of frames.
+        frame_bytes (int): The number of bytes per frame.
+
+    Returns:
+        pcm (bytes): The silence.
+    """
+    return bytes(n_frames * frame_bytes)
+
+
+class StreamStats(BaseModel):
+    """Statistics about the blocks produced by a stream."""
+
+    n_blocks: int = 0
+    total_cpu_us: float = 0
+    max_cpu_us: float = 0
+    underruns: int = 0
+    decode_underruns: int = Field(
+        default=0,
+        description="Blocks which came up short because decoding fell behind.",
+    )
+    seeks: int = 0
+    last_error_ms: float = 0
+    last_ratio: float = 1
+
+    @property
+    def mean_cpu_us(self):
+        """Get the mean CPU time spent preparing a block in µs."""
+        return self.total_cpu_us / self.n_blocks if self.n_blocks else 0.0
+
+
+class StreamingAudioPlayer(AudioPlayer):
+    """An audio player which feeds the mixer in small blocks and slews towards a reference.
+
+    Before each block is queued, the source position it will start at is compared with
+    the position the `reference` expects at the time the block will be heard. The error
+    is worked off gradually by resampling the block at a slightly different rate (at
+    most `max_slew`), so playback converges on the schedule without audible jumps. Errors
+    larger than `max_error_ms` are corrected with a seek instead.
+
+    Audio is read from a `source` which is decoded incrementally into a ring buffer of
+    `buffer_ms`, so memory use does not depend on the length of the track.
+    """
+
+    block_ms: int = Field(
+        default=100, gt=0, description="The duration of each queued block in ms."
+    )
+    max_slew: float = Field(
+        default=0.002,
+        ge=0,
+        lt=0.1,
+        description="The largest relative rate change used for correction.",
+    )
+    correction_horizon_ms: float = Field(
+        default=2000,
+        gt=0,
+        description="The time over which an error is worked off in ms.",
+    )
+    max_error_ms: float = Field(
+        default=250,
+        gt=0,
+        description="The largest error corrected by slewing rather than seeking in ms.",
+    )
+    reference: Callable[[float], float] | None = Field(
+        default=None,
+        exclude=True,
+        description="Maps a monotonic time in ms to the expected playback position in ms.",
+    )
+    buffer_ms: int = Field(
+        default=2000, gt=0, description="How much audio to decode ahead in ms."
+    )
+    source: PCMSource | None = Field(
+        default=None,
+        exclude=True,
+        description="The source to stream; defaults to the decoded sound.",
+    )
+    stats: StreamStats = Field(default_factory=StreamStats)
+    _reader: BufferedSource | None = PrivateAttr(default=None)
+    _position: int = PrivateAttr(default=0)
+    _out_time: float = PrivateAttr(default=0)
+    _resample_state: tuple | None = PrivateAttr(default=None)
+    _resample_rates: tuple[int, int] = PrivateAttr(default=(1, 1))
+    _stop_requested: threading.Event = PrivateAttr(default_factory=threading.Event)
+    _feeder: threading.Thread | None = PrivateAttr(default=None)
+
+    @property
+    def format(self):
+        """Get the mixer format.
+
+        Returns:
+            format (tuple[int, int, int]): The frequency, signed sample size in bits, and channel count.
+        """
+        return init_mixer()
+
+    @property
+    def frame_bytes(self):
+        """Get the number of bytes per frame."""
+        _, size, channels = self.format
+        return abs(size) // 8 * channels
+
+    @classmethod
+    def Load(cls, audio_file: str, cache: PCMCache | None = None):
+        """Open an audio file for streaming without decoding it up front.
+
+        Cached PCM is memory-mapped, WAV files are read directly, and other formats are
+        decoded through ffmpeg. Without ffmpeg an uncached file in another format cannot
+        be streamed, and a `StreamingError` is raised rather than decoding it whole.
+
+        Args:
+            audio_file (str): The path of the audio file.
+            cache (PCMCache | None): The PCM cache; the default cache in `media/` is used if not provided.
+
+        Returns:
+            player (StreamingAudioPlayer): The audio player
+        """
+        logger.info(f"Streaming {audio_file}")
+        started = time.perf_counter()
+        frequency, size, channels = init_mixer()
+        path = Path(audio_file)
+        cache = cache or PCMCache()
+        pcm = cache.get(path)
+        hit = pcm is not None
+        source: PCMSource
+        if pcm is not None:
+            source = MappedSource(
+                pcm=pcm, frequency=frequency, size=size, channels=channels
+            )
+        elif path.suffix.lower() == ".wav":
+            source = WavSource(
+                path=path, frequency=frequency, size=size, channels=channels
+            )
+        elif FFmpegSource.available():
+            source = FFmpegSource(
+                path=path,
+                duration_ms=probe(path).duration_ms,
+                frequency=frequency,
+                size=size,
+                channels=channels,
+            )
+        else:
+            msg = f"Cannot stream {path}: ffmpeg is not installed and it is not cached."
+            logger.error(msg)
+            raise StreamingError(msg)
+        channel = pygame.mixer.find_channel()
+        if channel is None:
+            msg = "No available channels."
+            logger.error(msg)
+            raise ValueError(msg)
+        return cls(
+            channel=channel,
+            duration=round(source.n_frames * 1000 / frequency),
+            audio_file=path,
+            load_ms=(time.perf_counter() - started) * 1000,
+            cache_hit=hit,
+            source=source,
+        )
+
+    @property
+    def pcm_source(self):
+        """Get the source to stream from.
+
+        Returns:
+            source (PCMSource): The source.
+        """
+        if self.source is None:
+            frequency, size, channels = self.format
+            self.source = MemorySource(
+                pcm=self.pcm, frequency=frequency, size=size, channels=channels
+            )
+        return self.source
+
+    @property
+    def reader(self):
+        """Get the ring-buffered reader over the source.
+
+        Returns:
+            reader (BufferedSource): The reader.
+        """
+        if self._reader is None:
+            self._reader = BufferedSource(
+                source=self.pcm_source, capacity_ms=self.buffer_ms
+            )
+        return self._reader
+
+    @property
+    def n_frames(self):
+        """Get the number of frames in the source."""
+        return self.pcm_source.n_frames
+
+    @property
+    def sound_ms(self):
+        """Get the exact length of the source in ms."""
+        frequency, _, _ = self.format
+        return self.n_frames * 1000 / frequency
+
+    def can_queue_at(self, start_time: float):
+        """Streams are restarted at each loop so the feeder can realign them.
+
+        Args:
+            start_time (float): The target start time in ms.
+
+        Returns:
+            can_queue (bool): Always False.
+        """
+        return False
+
+    def play(self):
+        """Stream the audio file starting now."""
+        self.play_at(monotonic_ms() + self.block_ms)
+
+    def play_at(self, start_time: float, offset_ms: float = 0):
+        """Start streaming the audio at a monotonic time.
+
+        Args:
+            start_time (float): The monotonic time at which to start in ms.
+            offset_ms (float): Where in the audio to start in ms, e.g. to join a loop mid-way.
+        """
+        self._stop_feeder()
+        channel = self.channel
+        if channel.get_busy():
+            channel = pygame.mixer.find_channel() or channel
+            channel.stop()
+        frequency, _, _ = self.format
+        self.use_channel(channel)
+        self.start_time = start_time - offset_ms
+        self._position = min(max(round(offset_ms * frequency / 1000), 0), self.n_frames)
+        self._out_time = start_time
+        self._resample_state = None
+        self.reader.start(self._position)
+        preroll = silence(max(start_time - monotonic_ms(), 0))
+        # the mixer crashes on an empty sound; a late start just queues the first block
+        if preroll.get_length() > 0:
+            channel.play(preroll)
+        self._stop_requested.clear()
+        self._feeder = threading.Thread(
+            target=self._feed, name="audio-stream", daemon=True
+        )
+        self._feeder.start()
+
+    def stop(self):
+        """Stop the audio."""
+        self._stop_feeder()
+        if self._reader is not None:
+            self._reader.stop()
+        super().stop()
+
+    def close(self):
+        """Stop the audio and release the source."""
+        self.stop()
+        if self._reader is not None:
+            self._reader.close()
+            self._reader = None
+        elif self.source is not None:
+            self.source.close()
+
+    def _stop_feeder(self):
+        self._stop_requested.set()
+        if self._feeder is not None and self._feeder is not threading.current_thread():
+            self._feeder.join()
+        self._feeder = None
+
+    def _feed(self):
+        frequency, _, _ = self.format
+        channel = self.channel
+        poll_s = self.block_ms / 4000
+        while not self._stop_requested.is_set():
+            if channel.get_queue() is None:
+                now = monotonic_ms()
+                if not channel.get_busy() and now > self._out_time:
+                    # the mixer ran dry; restart the output timeline from now
+                    self.stats.underruns += 1
+                    self._out_time = now
+                block = self.next_block()
+                if block is None:
+                    return
+                channel.queue(pygame.mixer.Sound(buffer=block))
+                self._out_time += len(block) / self.frame_bytes * 1000 / frequency
+            self._stop_requested.wait(poll_s)
+
+    def next_block(self):
+        """Prepare the next block, resampled to slew towards the reference.
+
+        Returns:
+            block (bytes | None): The PCM for the next block, or None at the end of the source.
+        """
+        started = time.process_time()
+        frequency, size, channels = self.format
+        n_frames = self.n_frames
+        if self._position >= n_frames:
+            return None
+        block_frames = round(self.block_ms * frequency / 1000)
+        expected_ms = (
+            self.reference(self._out_time)
+            if self.reference is not None
+            else self._out_time - self.start_time
+        )
+        error_ms = expected_ms - self._position * 1000 / frequency
+        if abs(error_ms) > self.max_error_ms:
+            logger.warning(f"Stream is off by {error_ms:.1f}ms, seeking.")
+            self._position = min(
+                max(round(expected_ms * frequency / 1000), 0), n_frames
+            )
+            self.reader.seek(self._position)
+            self._resample_state = None
+            self.stats.seeks += 1
+            error_ms = 0.0
+        ratio = 1 + min(
+            max(error_ms / self.correction_horizon_ms, -self.max_slew), self.max_slew
+        )
+        n_in = min(round(block_frames * ratio), n_frames - self._position)
+        if n_in <= 0:
+            return None
+        fb = self.frame_bytes
+        chunk = self.reader.read(n_in, timeout=self.block_ms / 2000)
+        if len(chunk) < n_in * fb:
+            if not chunk and self.reader.exhausted:
+                return None
+            if not self.reader.exhausted:
+                self.stats.decode_underruns += 1
+            n_in = len(chunk) // fb
+        if n_in == 0:
+            return silence_bytes(block_frames, fb)
+        n_out = round(n_in / ratio)
+        self._position += n_in
+        if n_in == n_out or size > 0 or size == 32:
+            # unsigned and float formats are passed through uncorrected
+            block = bytes(chunk)
+        else:
+            block = self._resample(chunk, abs(size) // 8, channels, n_in, n_out)
+        cpu_us = (time.process_time() - started) * 1e6
+        self.stats.n_blocks += 1
+        self.stats.total_cpu_us += cpu_us
+        self.stats.max_cpu_us = max(self.stats.max_cpu_us, cpu_us)
+        self.stats.last_error_ms = error_ms
+        self.stats.last_ratio = ratio
+        return block
+
+    def _resample(self, chunk: bytes, width: int, channels: int, n_in: int, n_out: int):
+        g = math.gcd(n_in, n_out)
+        rates = (n_in // g, n_out // g)
+        state = self._resample_state
+        if state is not None and rates != self._resample_rates:
+            # rescale the interpolation phase to the new rates
+            d, history = state
+            state = (d * rates[0] // self._resample_rates[0], history)
+        block, self._resample_state = audioop.ratecv(
+            chunk, width, channels, n_in, n_out, state
+        )
+        self._resample_rates = rates
+        return block
+
+    @property
+    def end_time(self):
+        """Get the monotonic time at which the stream ends, accounting for the correction applied so far.
+
+        Returns:
+            end_time (float): The end time in ms.
+        """
+        frequency, _, _ = self.format
+        unread_ms = (self.n_frames - self._position) * 1000 / frequency
+        return self._out_time + unread_ms
+
+    @property
+    def remaining_ms(self):
+        """Get the remaining time in ms.
+
+        Returns:
+            remaining_time (float): The remaining time in ms.
+        """
+        return self.end_time - monotonic_ms()
+
+
+class StreamBenchmark(BaseModel):
+    """The result of streaming a file for a while."""
+
+    audio_file: Path
+    duration_ms: int
+    played_ms: float
+    peak_rss_mb: float
+    baseline_rss_mb: float
+    stats: StreamStats
+
+
+def benchmark(audio_file: str, seconds: float = 30, cache: PCMCache | None = None):
+    """Stream a file and report peak memory use and underruns.
+
+    Peak RSS should not grow with the length of the track; compare a short and a long file.
+
+    Args:
+        audio_file (str): The file to stream.
+        seconds (float): How long to play for.
+        cache (PCMCache | None): The PCM cache to read from.
+
+    Returns:
+        result (StreamBenchmark): The benchmark result.
+    """
+    process = psutil.Process()
+    baseline = process.memory_info().rss
+    player = StreamingAudioPlayer.Load(audio_file, cache=cache)
+    peak = process.memory_info().rss
+    started = time.perf_counter()
+    player.play()
+    while (
+        elapsed := time.perf_counter() - started
+    ) < seconds and player.remaining_ms > 0:
+        peak = max(peak, process.memory_info().rss)
+        time.sleep(0.1)
+    player.close()
+    return StreamBenchmark(
+        audio_file=Path(audio_file),
+        duration_ms=player.duration,
+        played_ms=elapsed * 1000,
+        peak_rss_mb=peak / 1024**2,
+        baseline_rss_mb=baseline / 1024**2,
+        stats=player.stats,
+    )
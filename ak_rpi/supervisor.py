@@ -0,0 +1,236 @@
+"""Supervises the player, falling back to offline playback and recovering from it."""
+
+import logging
+import threading
+import time
+from pathlib import Path
+
+from pydantic import BaseModel, Field, PrivateAttr
+
+from ak_rpi.audio import AudioPlayer
+from ak_rpi.client import RegistrationData
+from ak_rpi.errors import NoRegistrationPossibleError
+from ak_rpi.offline import OfflineLooper, start_offline
+from ak_rpi.player import PlayerSettings
+from ak_rpi.scheduler import Scheduler
+from ak_rpi.timebase import monotonic_ms
+
+logger = logging.getLogger(__name__)
+
+
+class RecoveryReport(BaseModel):
+    """How a return from offline to synced playback went."""
+
+    offline_ms: float = Field(
+        ...,
+        description="The time from going offline to the first loop on the synced schedule in ms.",
+    )
+    attempts: int = Field(
+        ..., description="The number of attempts to reach the server."
+    )
+    converge_ms: float = Field(
+        ..., description="The time from reaching the server to a converged clock in ms."
+    )
+    converged: bool = Field(
+        ...,
+        description="Whether the clock met the sync policy's target before the handoff.",
+    )
+    correction_ms: float = Field(
+        ..., description="How far the loop schedule moved at the handoff in ms."
+    )
+
+
+class Supervisor(BaseModel, arbitrary_types_allowed=True):
+    """Runs the player, and keeps audio playing whenever it cannot.
+
+    If the player cannot be set up, or fails while running, the supervisor switches to
+    offline playback and keeps trying to reach the server on a background thread. Once
+    it has and the clock estimate has converged, the already-playing audio is handed to
+    the player at the next loop boundary, where it is queued gaplessly if it is within
+    `AudioPlayer.max_gapless_error_ms` of the synced schedule or re-aligned otherwise.
+    Playback is never restarted.
+    """
+
+    retry_base_s: float = Field(
+        default=2.0, gt=0, description="The delay before the first retry in s."
+    )
+    retry_max_s: float = Field(
+        default=120.0, gt=0, description="The longest delay between retries in s."
+    )
+    max_converge_syncs: int = Field(
+        default=5,
+        gt=0,
+        description="The most syncs to wait for the clock to converge before handing off anyway.",
+    )
+    scheduler: Scheduler = Field(default_factory=Scheduler)
+    player: PlayerSettings | None = None
+    recoveries: list[RecoveryReport] = Field(default_factory=list)
+    _audio: AudioPlayer | None = PrivateAttr(default=None)
+    _looper: OfflineLooper | None = PrivateAttr(default=None)
+    _offline_since: float | None = PrivateAttr(default=None)
+    _recovery: threading.Thread | None = PrivateAttr(default=None)
+
+    @property
+    def offline(self):
+        """Whether the supervisor is playing offline."""
+        return self._offline_since is not None
+
+    def run(self):
+        """Run the player, switching to and from offline playback as needed."""
+        self.start()
+        while True:
+            try:
+                self.scheduler.run()
+            except Exception as e:
+                logger.exception(
+                    "Failure in main loop, switching to offline mode.", exc_info=e
+                )
+                self.go_offline()
+                continue
+            if self._recovery is not None and self._recovery.is_alive():
+                # nothing to play offline, so wait for the recovery to schedule the handoff
+                self._recovery.join()
+                continue
+            return
+
+    def start(self):
+        """Set up the player, or go offline if it cannot be acquired."""
+        try:
+            player = RegistrationData.FromConfig()
+        except Exception as e:
+            logger.exception(
+                "Failed to acquire player settings; will start in offline mode.",
+                exc_info=e,
+            )
+            self.go_offline()
+            return
+        self.player = player
+        try:
+            player.setup()
+        except Exception as e:
+            logger.exception(
+                "Failed to set up player, switching to offline mode.", exc_info=e
+            )
+            self.go_offline()
+            return
+        self.scheduler.call_soon(player.step, self.scheduler)
+
+    def go_offline(self):
+        """Stop the player, start offline playback and start trying to recover."""
+        if self.player is not None:
+            self.player.close()
+            self.player = None
+        if self._looper is not None:
+            self._looper.stop()
+        if self._audio is not None:
+            self._audio.stop_looping()
+            self._audio.stop()
+        # drop anything the failed player had scheduled
+        self.scheduler = Scheduler()
+        self._audio, self._looper = start_offline(self.scheduler)
+        if self._offline_since is None:
+            self._offline_since = monotonic_ms()
+        if self._recovery is None or not self._recovery.is_alive():
+            self._recovery = threading.Thread(
+                target=self._recover, name="recovery", daemon=True
+            )
+            self._recovery.start()
+
+    def _recover(self):
+        attempts = 0
+        delay_s = self.retry_base_s
+        while True:
+            attempts += 1
+            try:
+                player = RegistrationData.FromConfig(prefer_snapshot=False)
+                break
+            except NoRegistrationPossibleError as e:
+                logger.exception(
+                    "Player cannot be registered; staying offline.", exc_info=e
+                )
+                return
+            except Exception as e:
+                logger.exception(
+                    f"Recovery attempt {attempts} failed, retrying in {delay_s:.0f}s.",
+                    exc_info=e,
+                )
+            time.sleep(delay_s)
+            delay_s = min(delay_s * 2, self.retry_max_s)
+        contact = monotonic_ms()
+        converged = False
+        for _ in range(self.max_converge_syncs):
+            try:
+                player.ntp.sync()
+            except Exception as e:
+                logger.exception("Sync failed during recovery.", exc_info=e)
+            if not player.ntp.needs_sync:
+                converged = True
+                break
+            time.sleep(self.retry_base_s)
+        converge_ms = monotonic_ms() - contact
+        if not converged:
+            logger.warning("Clock did not converge, handing off anyway.")
+        self.scheduler.call_soon(self.handoff, player, attempts, converge_ms, converged)
+
+    def handoff(
+        self,
+        player: PlayerSettings,
+        attempts: int = 0,
+        converge_ms: float = 0,
+        converged: bool = True,
+    ):
+        """Hand the offline audio over to a synced player without interrupting it.
+
+        Must be called on the scheduler's thread.
+
+        Args:
+            player (PlayerSettings): The player, with a synced clock.
+            attempts (int): The number of attempts it took to reach the server.
+            converge_ms (float): How long the clock took to converge in ms.
+            converged (bool): Whether the clock converged.
+        """
+        audio = self._audio
+        if self._looper is not None:
+            self._looper.stop()
+        if audio is None:
+            player.setup()
+        else:
+            audio.stop_looping()
+            # the offline audio is still playing, so only a stored profile can be used
+            player.calibrate_output_latency(measure=False)
+            boundary = player.ntp.server_time_from_monotonic(audio.boundary_time)
+            loop_start = player.scheduled_loop_start(boundary)
+            player.audio = audio
+            player.apply_gain()
+            player.loop_start_server_time = loop_start
+            player.media_state = "waiting_to_sync"
+            if (
+                player.scoped_media_path is not None
+                and player.scoped_media_path.resolve()
+                != Path(audio.audio_file).resolve()
+            ):
+                player.schedule_media_reload()
+            player.ntp.start_background_sync()
+            player.reporter.start()
+            player.push.start()
+            if player.peers is not None:
+                player.peers.start()
+            player.save_snapshot()
+            report = RecoveryReport(
+                offline_ms=audio.end_time - (self._offline_since or audio.end_time),
+                attempts=attempts,
+                converge_ms=converge_ms,
+                converged=converged,
+                correction_ms=loop_start - boundary,
+            )
+            self.recoveries.append(report)
+            logger.info(
+                f"Recovered after {report.offline_ms / 1000:.1f}s offline "
+                f"({report.attempts} attempts); schedule corrected by "
+                f"{report.correction_ms:.1f}ms at the next loop."
+            )
+        self.player = player
+        self._audio = None
+        self._looper = None
+        self._offline_since = None
+        self.scheduler.call_soon(player.step, self.scheduler)
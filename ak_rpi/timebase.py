@@ -0,0 +1,209 @@
+"""The monotonic timebase shared by sync, audio and the player, and a precise deadline waiter."""
+
+import statistics
+import threading
+import time
+
+from pydantic import BaseModel, Field
+
+NS_PER_MS = 1_000_000
+DEFAULT_SPIN_NS = 300_000
+
+
+def monotonic_ns() -> int:
+    """Get the monotonic time in integer ns.
+
+    This is `CLOCK_MONOTONIC` on Linux, the clock `threading` waits are timed on, so
+    deadlines read from it and sleeps towards them agree. `CLOCK_MONOTONIC_RAW` is not
+    used: it is immune to NTP slewing, but waits would then drift against deadlines at
+    the slew rate, and the clock estimator fits any skew against the server regardless.
+
+    Returns:
+        now (int): The monotonic time in ns.
+    """
+    return time.perf_counter_ns()
+
+
+def monotonic_ms() -> float:
+    """Get the monotonic time in fractional ms, from the same integer ns reading.
+
+    Returns:
+        now (float): The monotonic time in ms.
+    """
+    return time.perf_counter_ns() / NS_PER_MS
+
+
+def wall_ns() -> int:
+    """Get the wall-clock time in integer ns.
+
+    Only for anchoring the monotonic timebase once; it steps when the system clock is set.
+
+    Returns:
+        now (int): The time since the epoch in ns.
+    """
+    return time.time_ns()
+
+
+def wall_ms() -> float:
+    """Get the wall-clock time in fractional ms, see `wall_ns`.
+
+    Returns:
+        now (float): The time since the epoch in ms.
+    """
+    return time.time_ns() / NS_PER_MS
+
+
+def wait_until_ns(
+    deadline_ns: int,
+    spin_ns: int = DEFAULT_SPIN_NS,
+    wakeup: threading.Event | None = None,
+):
+    """Block until a monotonic deadline, sleeping coarsely and then spinning.
+
+    The OS wakes a sleeping thread late by tens to hundreds of µs, so the sleep ends
+    `spin_ns` early and the rest is spent polling the clock, which holds the GIL for at
+    most `spin_ns` at a time.
+
+    Args:
+        deadline_ns (int): The monotonic deadline in ns (see `monotonic_ns`).
+        spin_ns (int): How long before the deadline to stop sleeping and start spinning in ns.
+        wakeup (threading.Event | None): Ends the sleep early when set.
+
+    Returns:
+        reached (bool): True if the deadline was reached, False if `wakeup` interrupted the wait.
+    """
+    clock = time.perf_counter_ns
+    remaining_ns = deadline_ns - clock()
+    if remaining_ns > spin_ns:
+        timeout_s = (remaining_ns - spin_ns) / 1e9
+        if wakeup is None:
+            time.sleep(timeout_s)
+        elif wakeup.wait(timeout_s):
+            return False
+    while clock() < deadline_ns:
+        pass
+    return True
+
+
+def wait_until_ms(
+    deadline_ms: float,
+    spin_ns: int = DEFAULT_SPIN_NS,
+    wakeup: threading.Event | None = None,
+):
+    """Block until a monotonic deadline in ms, see `wait_until_ns`.
+
+    Args:
+        deadline_ms (float): The monotonic deadline in ms (see `monotonic_ms`).
+        spin_ns (int): How long before the deadline to stop sleeping and start spinning in ns.
+        wakeup (threading.Event | None): Ends the sleep early when set.
+
+    Returns:
+        reached (bool): True if the deadline was reached, False if `wakeup` interrupted the wait.
+    """
+    return wait_until_ns(round(deadline_ms * NS_PER_MS), spin_ns, wakeup)
+
+
+class WaitBenchmark(BaseModel):
+    """How precisely one way of waiting hits its deadlines."""
+
+    method: str
+    n_waits: int
+    late_p50_us: float = Field(..., description="The median lateness in µs.")
+    late_p99_us: float
+    late_max_us: float
+    cpu_fraction: float = Field(
+        ..., description="The CPU time spent per unit of wall time while waiting."
+    )
+
+
+class TimebaseBenchmark(BaseModel):
+    """The cost and resolution of the timebase and the precision of waiting on it."""
+
+    clock_resolution_ns: float = Field(
+        ..., description="The resolution the OS reports for the monotonic clock in ns."
+    )
+    read_cost_ns: float = Field(
+        ..., description="The cost of one `monotonic_ns` call in ns."
+    )
+    int_ms_error_max_us: float = Field(
+        ...,
+        description="The largest error of truncating readings to integer ms, as the timebase used to, in µs.",
+    )
+    waits: list[WaitBenchmark]
+
+
+def _measure_waits(method: str, n_waits: int, interval_ms: float, wait):
+    lateness_us = []
+    cpu_started = time.thread_time()
+    wall_started = time.perf_counter()
+    deadline_ns = monotonic_ns()
+    for _ in range(n_waits):
+        deadline_ns += round(interval_ms * NS_PER_MS)
+        wait(deadline_ns)
+        lateness_us.append((monotonic_ns() - deadline_ns) / 1000)
+    cpu_fraction = (time.thread_time() - cpu_started) / (
+        time.perf_counter() - wall_started
+    )
+    lateness_us.sort()
+    return WaitBenchmark(
+        method=method,
+        n_waits=n_waits,
+        late_p50_us=statistics.median(lateness_us),
+        late_p99_us=lateness_us[min(int(n_waits * 0.99), n_waits - 1)],
+        late_max_us=lateness_us[-1],
+        cpu_fraction=cpu_fraction,
+    )
+
+
+def benchmark(n_waits: int = 500, interval_ms: float = 10.0):
+    """Measure the timebase and compare ways of waiting for a deadline.
+
+    Args:
+        n_waits (int): The number of deadlines per method.
+        interval_ms (float): The time between deadlines in ms.
+
+    Returns:
+        result (TimebaseBenchmark): The benchmark result.
+    """
+    n_reads = 100_000
+    started = time.perf_counter_ns()
+    for _ in range(n_reads):
+        monotonic_ns()
+    read_cost_ns = (time.perf_counter_ns() - started) / n_reads
+    readings = [monotonic_ns() + i * 137_731 for i in range(1000)]
+    int_ms_error_max_us = max(r / 1000 - r // NS_PER_MS * 1000 for r in readings)
+
+    def sleep(deadline_ns: int):
+        remaining_ns = deadline_ns - monotonic_ns()
+        if remaining_ns > 0:
+            time.sleep(remaining_ns / 1e9)
+
+    event = threading.Event()
+    waits = [
+        _measure_waits("sleep", n_waits, interval_ms, sleep),
+        _measure_waits(
+            "event",
+            n_waits,
+            interval_ms,
+            lambda d: event.wait((d - monotonic_ns()) / 1e9),
+        ),
+    ]
+    for spin_us in (100, 300, 1000):
+        waits.append(
+            _measure_waits(
+                f"hybrid-{spin_us}us",
+                n_waits,
+                interval_ms,
+                lambda d, s=spin_us: wait_until_ns(d, s * 1000, event),
+            )
+        )
+    return TimebaseBenchmark(
+        clock_resolution_ns=time.get_clock_info("perf_counter").resolution * 1e9,
+        read_cost_ns=read_cost_ns,
+        int_ms_error_max_us=int_ms_error_max_us,
+        waits=waits,
+    )
+
+
+if __name__ == "__main__":
+    print(benchmark().model_dump_json(indent=2))
@@ -0,0 +1,438 @@
+"""A compact UDP time-sync protocol, its reference server and a transport benchmark.
+
+Each exchange is one datagram each way. The client stamps the request and the reply on
+its monotonic clock with nanosecond resolution; the server stamps arrival, using the
+kernel's receive timestamp where available, and departure on its wall clock. Nothing
+between the stamps parses text or allocates much, so a sample's error is dominated by
+the network rather than by request handling as it is over HTTP.
+
+Request:  magic (4s) | version (B) | pad | seq (H) | t1 (q)
+Response: magic (4s) | version (B) | pad | seq (H) | t1 (q) | t2 (q) | t3 (q)
+
+`t1` is opaque to the server and echoed back; `t2` and `t3` are server times in ns.
+"""
+
+import json
+import logging
+import random
+import socket
+import statistics
+import struct
+import threading
+import time
+from collections.abc import Callable
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import cast
+from urllib.parse import parse_qs, urlparse
+
+from pydantic import BaseModel, Field, HttpUrl, PrivateAttr, SecretStr
+
+from ak_rpi.ntp import ClockSample, HTTPSyncTransport, SyncTransport
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"AKTS"
+VERSION = 1
+DEFAULT_PORT = 12321
+REQUEST = struct.Struct("!4sBxHq")
+RESPONSE = struct.Struct("!4sBxHqqq")
+
+# not exported by the socket module on all versions; see socket(7)
+_SO_TIMESTAMPNS = getattr(socket, "SO_TIMESTAMPNS", 35)
+_TIMESPEC = struct.Struct("@qq")
+
+_rng = random.Random()  # noqa: S311
+
+
+class UDPSyncTransport(SyncTransport):
+    """Exchanges timestamps with a `SyncServer` over UDP.
+
+    Replies are matched to requests by sequence number, so a late reply to an earlier
+    request is discarded rather than measured. After `fallback_after` consecutive
+    timeouts, e.g. because the server does not run a UDP sync server, exchanges go
+    through `fallback` instead if one is given.
+    """
+
+    host: str
+    port: int = Field(default=DEFAULT_PORT, gt=0, lt=65536)
+    timeout_s: float = Field(
+        default=0.5, gt=0, description="How long to wait for a reply in s."
+    )
+    fallback: SyncTransport | None = Field(
+        default=None, description="The transport to use if the server does not answer."
+    )
+    fallback_after: int = Field(
+        default=10, gt=0, description="The consecutive timeouts before falling back."
+    )
+    _sock: socket.socket | None = PrivateAttr(default=None)
+    _seq: int = PrivateAttr(default=0)
+    _failures: int = PrivateAttr(default=0)
+
+    @property
+    def sock(self):
+        """Get the socket, connecting it if needed."""
+        if self._sock is None:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.connect((self.host, self.port))
+            sock.settimeout(self.timeout_s)
+            self._sock = sock
+        return self._sock
+
+    @property
+    def falling_back(self):
+        """Whether exchanges currently go through the fallback transport."""
+        return self.fallback is not None and self._failures >= self.fallback_after
+
+    def exchange(self, clock: Callable[[], float]):
+        """Perform a single exchange.
+
+        Args:
+            clock (Callable[[], float]): Reads the local time in ms.
+
+        Returns:
+            sample (ClockSample | None): The sample, or None if the exchange failed.
+        """
+        if self.fallback is not None and self.falling_back:
+            return self.fallback.exchange(clock)
+        self._seq = (self._seq + 1) & 0xFFFF
+        seq = self._seq
+        t1 = clock()
+        try:
+            self.sock.send(REQUEST.pack(MAGIC, VERSION, seq, round(t1 * 1e6)))
+            t2, t3, t4 = self._receive(seq, clock)
+        except (TimeoutError, OSError) as e:
+            self._failures += 1
+            if self.falling_back:
+                logger.warning(
+                    f"No UDP sync replies from {self.host}:{self.port}, falling back."
+                )
+            else:
+                logger.debug(f"UDP sync exchange failed: {e!r}")
+            return None
+        finally:
+            if self._sock is not None:
+                self._sock.settimeout(self.timeout_s)
+        self._failures = 0
+        t2_ms, t3_ms = t2 / 1e6, t3 / 1e6
+        return ClockSample(
+            local_time=(t1 + t4) / 2,
+            offset=((t2_ms - t1) + (t3_ms - t4)) / 2,
+            rtt=(t4 - t1) - (t3_ms - t2_ms),
+        )
+
+    def _receive(self, seq: int, clock: Callable[[], float]):
+        deadline = time.monotonic() + self.timeout_s
+        while True:
+            data = self.sock.recv(RESPONSE.size)
+            t4 = clock()
+            if len(data) == RESPONSE.size:
+                magic, version, reply_seq, _, t2, t3 = RESPONSE.unpack(data)
+                if magic == MAGIC and version == VERSION and reply_seq == seq:
+                    return t2, t3, t4
+            # a stale or foreign datagram; keep waiting for ours
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise TimeoutError
+            self.sock.settimeout(remaining)
+
+    def close(self):
+        """Close the socket."""
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+        if self.fallback is not None:
+            self.fallback.close()
+
+
+class LinkProfile(BaseModel):
+    """Emulated network delay, applied by the benchmark servers around their stamps."""
+
+    latency_ms: float = Field(
+        default=0, ge=0, description="The base one-way delay in ms."
+    )
+    jitter_ms: float = Field(
+        default=0, ge=0, description="The mean of the exponential queueing delay in ms."
+    )
+    asymmetry_ms: float = Field(
+        default=0,
+        description="How much longer the path to the server is than the path back in ms.",
+    )
+
+    def delays_s(self, rng: random.Random | None = None):
+        """Draw the inbound and outbound delays of an exchange.
+
+        Args:
+            rng (random.Random | None): The random source; a shared one if not provided.
+
+        Returns:
+            inbound (float): The delay to the server in s.
+            outbound (float): The delay back from the server in s.
+        """
+        rng = rng or _rng
+
+        def draw(base_ms: float):
+            jitter = rng.expovariate(1 / self.jitter_ms) if self.jitter_ms else 0
+            return max(base_ms + jitter, 0) / 1000
+
+        return (
+            draw(self.latency_ms + self.asymmetry_ms / 2),
+            draw(self.latency_ms - self.asymmetry_ms / 2),
+        )
+
+
+class SyncServer(BaseModel, arbitrary_types_allowed=True):
+    """The reference UDP sync server.
+
+    Serves the wall clock, or `clock` if given, e.g. a player's estimate of server time.
+    Arrival is stamped with the kernel's receive timestamp where the platform provides
+    it and the wall clock is served, and departure immediately before sending.
+    """
+
+    host: str = "0.0.0.0"  # noqa: S104
+    port: int = Field(default=DEFAULT_PORT, ge=0, lt=65536)
+    offset_ms: float = Field(
+        default=0, description="Added to the server's wall clock, for testing."
+    )
+    link: LinkProfile | None = Field(
+        default=None, description="Emulated network delay, for testing."
+    )
+    clock: Callable[[], float] | None = Field(
+        default=None,
+        description="Reads the time to serve in ms; the wall clock if not provided.",
+    )
+    _sock: socket.socket | None = PrivateAttr(default=None)
+    _kernel_timestamps: bool = PrivateAttr(default=False)
+    _stop_requested: threading.Event = PrivateAttr(default_factory=threading.Event)
+    _worker: threading.Thread | None = PrivateAttr(default=None)
+
+    def bind(self):
+        """Bind the socket.
+
+        Returns:
+            address (tuple[str, int]): The bound address.
+        """
+        return self._bind().getsockname()
+
+    def _bind(self):
+        if self._sock is None:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            # kernel timestamps are on the wall clock, so only usable when serving it
+            if self.clock is None:
+                try:
+                    sock.setsockopt(socket.SOL_SOCKET, _SO_TIMESTAMPNS, 1)
+                    self._kernel_timestamps = True
+                except OSError:
+                    self._kernel_timestamps = False
+            sock.bind((self.host, self.port))
+            sock.settimeout(0.5)
+            self._sock = sock
+        return self._sock
+
+    def now_ns(self):
+        """Get the server time in ns."""
+        if self.clock is not None:
+            return round((self.clock() + self.offset_ms) * 1e6)
+        return time.time_ns() + round(self.offset_ms * 1e6)
+
+    def handle(self, data: bytes, ancdata: list, address: tuple):
+        """Answer a single request.
+
+        Args:
+            data (bytes): The datagram.
+            ancdata (list): The ancillary data received with it.
+            address (tuple): The sender.
+        """
+        t2 = None
+        for level, kind, value in ancdata:
+            if level == socket.SOL_SOCKET and kind == _SO_TIMESTAMPNS:
+                sec, nsec = _TIMESPEC.unpack(value[: _TIMESPEC.size])
+                t2 = sec * 1_000_000_000 + nsec + round(self.offset_ms * 1e6)
+        if t2 is None:
+            t2 = self.now_ns()
+        if len(data) != REQUEST.size:
+            return
+        magic, version, seq, t1 = REQUEST.unpack(data)
+        if magic != MAGIC or version != VERSION:
+            return
+        outbound_s = 0.0
+        if self.link is not None:
+            inbound_s, outbound_s = self.link.delays_s()
+            # the datagram arrives later by the emulated delay
+            time.sleep(inbound_s)
+            t2 += round(inbound_s * 1e9)
+        reply = RESPONSE.pack(MAGIC, VERSION, seq, t1, t2, self.now_ns())
+        if outbound_s:
+            time.sleep(outbound_s)
+        self._bind().sendto(reply, address)
+
+    def serve_forever(self):
+        """Answer requests until stopped."""
+        sock = self._bind()
+        ancbufsize = socket.CMSG_SPACE(_TIMESPEC.size)
+        logger.info(
+            f"Serving UDP sync on {sock.getsockname()} "
+            f"({'kernel' if self._kernel_timestamps else 'user-space'} receive timestamps)."
+        )
+        while not self._stop_requested.is_set():
+            try:
+                data, ancdata, _, address = sock.recvmsg(REQUEST.size, ancbufsize)
+            except TimeoutError:
+                continue
+            except OSError:
+                if self._stop_requested.is_set():
+                    return
+                raise
+            self.handle(data, ancdata, address)
+
+    def start(self):
+        """Serve on a daemon thread.
+
+        Returns:
+            address (tuple[str, int]): The bound address.
+        """
+        address = self.bind()
+        self._stop_requested.clear()
+        self._worker = threading.Thread(
+            target=self.serve_forever, name="udp-sync-server", daemon=True
+        )
+        self._worker.start()
+        return address
+
+    def stop(self):
+        """Stop serving and close the socket."""
+        self._stop_requested.set()
+        if self._worker is not None:
+            self._worker.join()
+            self._worker = None
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+
+
+class _HTTPSyncHandler(BaseHTTPRequestHandler):
+    """A stand-in for the server's `/api/sync` endpoint."""
+
+    def log_message(self, format, *args):  # noqa: A002
+        pass
+
+    def do_GET(self):
+        server = cast(_HTTPSyncServer, self.server)
+        inbound_s, outbound_s = server.link.delays_s()
+        time.sleep(inbound_s)
+        received = server.now_ms()
+        query = parse_qs(urlparse(self.path).query)
+        body = {
+            "reqSentAt": int(query["reqSentAt"][0]),
+            "reqReceivedAt": int(received),
+            "resSentAt": int(server.now_ms()),
+        }
+        data = json.dumps(body).encode()
+        time.sleep(outbound_s)
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class _HTTPSyncServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, offset_ms: float, link: LinkProfile):
+        super().__init__(("127.0.0.1", 0), _HTTPSyncHandler)
+        self.offset_ms = offset_ms
+        self.link = link
+
+    def now_ms(self):
+        return time.time_ns() / 1e6 + self.offset_ms
+
+
+class TransportBenchmark(BaseModel):
+    """The accuracy of a sync transport against a server with a known offset."""
+
+    transport: str
+    n_samples: int = Field(..., description="The number of successful exchanges.")
+    median_error_ms: float = Field(
+        ..., description="The median absolute error of individual samples in ms."
+    )
+    p95_error_ms: float = Field(
+        ...,
+        description="The 95th percentile absolute error of individual samples in ms.",
+    )
+    median_rtt_ms: float = Field(..., description="The median round trip time in ms.")
+    model_error_ms: float = Field(
+        ..., description="The absolute error of the fitted clock model in ms."
+    )
+
+
+def benchmark(
+    n_samples: int = 200,
+    link: LinkProfile | None = None,
+    offset_ms: float = 12345.678,
+):
+    """Compare the offset error of the HTTP and UDP transports on loopback.
+
+    Both servers run in-process with the same emulated link and a known clock offset, so
+    the error of every sample can be measured exactly.
+
+    Args:
+        n_samples (int): The number of exchanges per transport.
+        link (LinkProfile | None): The emulated network delay; none if not provided.
+        offset_ms (float): The true offset of the servers' clock in ms.
+
+    Returns:
+        results (list[TransportBenchmark]): The results for HTTP and then UDP.
+    """
+    import httpx
+
+    from ak_rpi.client import Client
+    from ak_rpi.ntp import NTP
+
+    link = link or LinkProfile()
+    http_server = _HTTPSyncServer(offset_ms, link)
+    threading.Thread(target=http_server.serve_forever, daemon=True).start()
+    udp_server = SyncServer(host="127.0.0.1", port=0, offset_ms=offset_ms, link=link)
+    _, udp_port = udp_server.start()
+    url = f"http://127.0.0.1:{http_server.server_port}"
+    client = Client(
+        syncUrl=HttpUrl(url), password=SecretStr(""), client=httpx.Client(base_url=url)
+    )
+    transports: list[tuple[str, SyncTransport]] = [
+        ("http", HTTPSyncTransport(client=client)),
+        ("udp", UDPSyncTransport(host="127.0.0.1", port=udp_port)),
+    ]
+    results = []
+    try:
+        for name, transport in transports:
+            ntp = NTP(client=client, transport=transport)
+            # the true offset of the server clock from this NTP instance's local time
+            truth = time.time_ns() / 1e6 + offset_ms - ntp.precise_local_time
+            samples = [ntp.sample() for _ in range(n_samples)]
+            samples = [sample for sample in samples if sample is not None]
+            model = ntp.estimator.update(samples)
+            if model is None:
+                logger.warning(f"No {name} exchanges succeeded.")
+                continue
+            errors = sorted(abs(sample.offset - truth) for sample in samples)
+            results.append(
+                TransportBenchmark(
+                    transport=name,
+                    n_samples=len(samples),
+                    median_error_ms=statistics.median(errors),
+                    p95_error_ms=errors[min(int(len(errors) * 0.95), len(errors) - 1)],
+                    median_rtt_ms=statistics.median(sample.rtt for sample in samples),
+                    model_error_ms=abs(model.offset_at(ntp.precise_local_time) - truth),
+                )
+            )
+            transport.close()
+    finally:
+        udp_server.stop()
+        http_server.shutdown()
+        http_server.server_close()
+    return results
+
+
+def serve():
+    """Run the reference UDP sync server on the default port."""
+    logging.basicConfig(level=logging.INFO)
+    SyncServer().serve_forever()
@@ -1,6 +1,7 @@
 """Utility functions."""
 
 import socket
+import time
 import uuid
 from pathlib import Path
 
@@ -89,3 +90,25 @@ def scan_for_exts(
     for ext in exts:
         files.extend(dirpath.glob(f"*.{ext}" if not recursive else f"**/*.{ext}"))
     return files
+
+
+def boot_time_ms():
+    """Get the time since the device was powered on, including time spent suspended.
+
+    Returns:
+        boot_time (float): The time since boot in ms.
+    """
+    try:
+        return time.clock_gettime(time.CLOCK_BOOTTIME) * 1000
+    except AttributeError:
+        # CLOCK_BOOTTIME is linux-only
+        return (time.time() - psutil.boot_time()) * 1000
+
+
+def process_uptime_ms():
+    """Get the time since this process started.
+
+    Returns:
+        uptime (float): The time since the process started in ms.
+    """
+    return (time.time() - psutil.Process().create_time()) * 1000
@@ -0,0 +1,137 @@
+"""Shared fixtures for the tests."""
+
+import math
+import os
+import struct
+import wave
+from collections.abc import Callable
+from pathlib import Path
+
+import httpx
+import pygame
+import pytest
+from pydantic import HttpUrl, SecretStr
+
+from ak_rpi.client import Client, ClientOptions
+from ak_rpi.ntp import NTP
+from ak_rpi.pcm_cache import PCMCache
+from ak_rpi.player import PlayerSettings
+
+SYNC_URL = "http://server.test"
+
+
+@pytest.fixture
+def make_client() -> Callable[..., Client]:
+    """Make sync and async clients which answer requests with a handler instead of the network."""
+
+    def make(
+        handler: Callable[[httpx.Request], httpx.Response],
+        options: ClientOptions | None = None,
+    ):
+        client = Client(
+            syncUrl=HttpUrl(SYNC_URL),
+            password=SecretStr("secret"),
+            client=httpx.Client(
+                base_url=SYNC_URL,
+                params={"password": "secret"},
+                transport=httpx.MockTransport(handler),
+            ),
+            options=options or ClientOptions(backoff_base_s=0.001, backoff_max_s=0.002),
+        )
+        client.async_client.client = httpx.AsyncClient(
+            base_url=SYNC_URL,
+            params={"password": "secret"},
+            transport=httpx.MockTransport(handler),
+        )
+        return client
+
+    return make
+
+
+@pytest.fixture
+def offline_client(make_client: Callable[..., Client]) -> Client:
+    """Make a client whose every request fails in transport."""
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        raise httpx.ConnectError("offline", request=request)
+
+    return make_client(handler)
+
+
+@pytest.fixture
+def make_settings(offline_client: Client) -> Callable[..., PlayerSettings]:
+    """Make player settings which never reach a server."""
+
+    def make(**kwargs):
+        return PlayerSettings.model_validate({
+            "id": 1,
+            "nickname": "test",
+            "ipAddress": "127.0.0.1",
+            "macAddress": "00:00:00:00:00:00",
+            "syncUrl": SYNC_URL,
+            "firmwareUrl": SYNC_URL,
+            "volume": 100,
+            "quietMode": 0,
+            "serialNumber": "0",
+            "tenantId": 1,
+            "client": offline_client,
+            "ntp": NTP(client=offline_client),
+            **kwargs,
+        })
+
+    return make
+
+
+@pytest.fixture(scope="session")
+def mixer():
+    """Initialize the mixer on SDL's dummy driver, which plays to nowhere in real time."""
+    os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+    from ak_rpi.audio import init_mixer
+
+    try:
+        mixer_format = init_mixer()
+    except pygame.error as e:
+        pytest.skip(f"No SDL audio driver available: {e}")
+    yield mixer_format
+    pygame.mixer.quit()
+
+
+def write_wav(
+    path: Path,
+    duration_ms: float,
+    frequency: int = 44100,
+    channels: int = 2,
+    tone_hz: float = 440.0,
+):
+    """Write a 16-bit sine tone to a WAV file.
+
+    Returns:
+        path (Path): The file.
+    """
+    n_frames = round(duration_ms * frequency / 1000)
+    frames = bytearray()
+    for i in range(n_frames):
+        sample = round(8000 * math.sin(2 * math.pi * tone_hz * i / frequency))
+        frames += struct.pack("<h", sample) * channels
+    with wave.open(path.as_posix(), "wb") as f:
+        f.setnchannels(channels)
+        f.setsampwidth(2)
+        f.setframerate(frequency)
+        f.writeframes(bytes(frames))
+    return path
+
+
+@pytest.fixture
+def make_wav(tmp_path: Path) -> Callable[..., Path]:
+    """Make sine-tone WAV files in a temporary directory."""
+
+    def make(name: str = "tone.wav", duration_ms: float = 1000.0, **kwargs):
+        return write_wav(tmp_path / name, duration_ms, **kwargs)
+
+    return make
+
+
+@pytest.fixture
+def pcm_cache(tmp_path: Path) -> PCMCache:
+    """Make a PCM cache in a temporary directory rather than `media/`."""
+    return PCMCache(cache_dir=tmp_path / ".pcm-cache")
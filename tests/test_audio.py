@@ -0,0 +1,155 @@
+"""Tests for scheduled, gapless and mid-way playback on SDL's dummy audio driver."""
+
+import threading
+from collections.abc import Callable
+from pathlib import Path
+
+import pytest
+
+from ak_rpi.audio import AudioPlayer, silence
+from ak_rpi.client import Client
+from ak_rpi.ntp import NTP
+from ak_rpi.pcm_cache import PCMCache
+from ak_rpi.timebase import monotonic_ms
+
+
+@pytest.fixture
+def player(
+    mixer: tuple[int, int, int],
+    make_wav: Callable[..., Path],
+    pcm_cache: PCMCache,
+):
+    """Load a one-second tone."""
+    audio = AudioPlayer.Load(make_wav(duration_ms=1000).as_posix(), cache=pcm_cache)
+    yield audio
+    audio.stop()
+
+
+def test_silence_is_exact_to_the_sample(mixer: tuple[int, int, int]):
+    """A pre-roll is rounded to the nearest sample, not the nearest ms."""
+    frequency, size, channels = mixer
+    frame_bytes = abs(size) // 8 * channels
+    for duration_ms in (0.0, 1.0, 12.345, 50.0):
+        raw = silence(duration_ms).get_raw()
+        assert len(raw) == round(duration_ms * frequency / 1000) * frame_bytes
+        assert not any(raw)
+
+
+def test_play_at_queues_the_sound_behind_a_preroll(player: AudioPlayer):
+    """The sound is queued behind silence ending at the target, so it starts on time."""
+    start_time = monotonic_ms() + 40
+    player.play_at(start_time)
+    assert player.channel.get_busy()
+    assert player.channel.get_queue() is not None
+    assert player.boundary_time == start_time
+    assert player.start_time == start_time
+    assert player.next_boundary_time == pytest.approx(start_time + 1000, abs=0.05)
+
+
+def test_late_play_at_starts_immediately(player: AudioPlayer):
+    """A start which is already due plays straight away rather than waiting a pre-roll."""
+    before = monotonic_ms()
+    player.play_at(before - 10)
+    assert player.channel.get_busy()
+    assert player.channel.get_queue() is None
+    assert player.boundary_time >= before
+
+
+def test_play_at_server_time_converts_through_the_clock(
+    player: AudioPlayer, offline_client: Client
+):
+    """A server time is converted to the monotonic clock with the synced offset."""
+    ntp = NTP(client=offline_client, server_time_offset=5000)
+    start_server_time = ntp.server_time + 40
+    player.play_at_server_time(start_server_time, ntp)
+    assert player.boundary_time == pytest.approx(
+        ntp.monotonic_from_server_time(start_server_time)
+    )
+    assert player.channel.get_queue() is not None
+
+
+def test_load_decodes_once_into_the_cache(
+    mixer: tuple[int, int, int], make_wav: Callable[..., Path], pcm_cache: PCMCache
+):
+    """The first load decodes into the cache, and later loads read the same PCM from it."""
+    path = make_wav(duration_ms=250).as_posix()
+    cold = AudioPlayer.Load(path, cache=pcm_cache)
+    warm = AudioPlayer.Load(path, cache=pcm_cache)
+    assert cold.cache_hit is False
+    assert warm.cache_hit is True
+    assert bytes(warm.pcm) == bytes(cold.pcm)
+    assert len(list(pcm_cache.cache_dir.glob("*.pcm"))) == 1
+
+
+def test_load_releases_the_cache_map(
+    mixer: tuple[int, int, int], make_wav: Callable[..., Path], pcm_cache: PCMCache
+):
+    """Once loaded, only the mixer's copy of the PCM is resident, not the cache file too."""
+    maps = Path("/proc/self/maps")
+    if not maps.exists():
+        pytest.skip("Needs /proc to list memory maps.")
+    path = make_wav(duration_ms=250).as_posix()
+    AudioPlayer.Load(path, cache=pcm_cache)
+    player = AudioPlayer.Load(path, cache=pcm_cache)
+    assert player.cache_hit
+    assert pcm_cache.cache_dir.as_posix() not in maps.read_text()
+
+
+def test_pcm_is_a_view_of_the_mixer_buffer(player: AudioPlayer):
+    """The PCM view aliases the sound the mixer plays rather than copying it."""
+    pcm = player.pcm
+    assert len(pcm) == len(player.loaded_sound.get_raw())
+    pcm[:4] = b"\x01\x02\x03\x04"
+    assert player.loaded_sound.get_raw()[:4] == b"\x01\x02\x03\x04"
+
+
+def test_join_chunks_cover_the_rest_exactly(player: AudioPlayer):
+    """The chunks of a mid-way start join up to the rest of the sound, sample for sample."""
+    player.join_chunk_ms = 120
+    offset_ms = 333.3
+    start = round(offset_ms * 44100 / 1000) * 4
+    chunks = []
+    chunk_start = offset_ms
+    while chunk_start < player.sound_ms:
+        chunk_end = player.join_chunk_end(chunk_start)
+        chunks.append(player.sound_from(chunk_start, chunk_end - chunk_start).get_raw())
+        chunk_start = chunk_end
+    assert b"".join(chunks) == bytes(player.pcm[start:])
+    assert len(chunks) == 6
+    # the short tail is merged rather than left as a chunk of its own
+    assert len(chunks[-1]) >= 60 * 44100 // 1000 * 4
+
+
+def test_joining_queues_the_rest_a_chunk_at_a_time(player: AudioPlayer):
+    """Only the first chunk is queued up front; the next follows once it is playing."""
+    # not a whole number of cycles of the tone, so consecutive chunks differ
+    player.join_chunk_ms = 110
+    start_time = monotonic_ms() + 20
+    player.play_at(start_time, offset_ms=700)
+    first = player.channel.get_queue()
+    assert first is not None
+    assert first.get_length() == pytest.approx(0.11, abs=1e-4)
+    assert player.start_time == pytest.approx(start_time - 700)
+    # halfway through the first chunk the second is queued behind it
+    for _ in range(100):
+        queued = player.channel.get_queue()
+        if queued is not None and queued.get_raw() != first.get_raw():
+            break
+        threading.Event().wait(0.005)
+    assert queued is not None
+    assert queued.get_raw() == player.sound_from(810, 110).get_raw()
+    player.stop()
+    assert player._joiner is None
+
+
+def test_the_gain_follows_playback_to_a_spare_channel(player: AudioPlayer):
+    """A re-aligned start on a spare channel, while the tail still plays, keeps the gain."""
+    player.set_gain(0.5)
+    tail = player.channel
+    tail.play(player.loaded_sound)
+    player.play_at(monotonic_ms() + 40)
+    try:
+        assert player.channel is not tail
+        assert player.channel.get_volume() == pytest.approx(0.5, abs=1 / 128)
+    finally:
+        tail.stop()
@@ -0,0 +1,74 @@
+"""Tests for the HTTP clients' retries."""
+
+import asyncio
+from collections.abc import Callable
+
+import httpx
+import pytest
+
+from ak_rpi.client import Client, ClientOptions
+from ak_rpi.errors import RegistrationError
+
+
+def flaky(responses: list[int | type[httpx.TransportError]]):
+    """Make a handler answering each request with the next status, or raising the next error."""
+    requests: list[httpx.Request] = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        requests.append(request)
+        outcome = responses[min(len(requests), len(responses)) - 1]
+        if isinstance(outcome, int):
+            return httpx.Response(outcome, json={})
+        raise outcome("failed", request=request)
+
+    return handler, requests
+
+
+def test_overload_responses_are_retried(make_client: Callable[..., Client]):
+    """A 503 is retried with backoff until the server answers."""
+    handler, requests = flaky([503, 503, 200])
+    response = make_client(handler).request("GET", "/api/mediaplayer/1")
+    assert response.status_code == 200
+    assert len(requests) == 3
+
+
+def test_client_errors_are_not_retried(make_client: Callable[..., Client]):
+    """A 404 is returned straight away."""
+    handler, requests = flaky([404, 200])
+    assert make_client(handler).request("GET", "/").status_code == 404
+    assert len(requests) == 1
+
+
+def test_retries_stop_after_max_retries(make_client: Callable[..., Client]):
+    """A transport error is raised once the retries are used up."""
+    handler, requests = flaky([httpx.ReadError])
+    client = make_client(
+        handler,
+        ClientOptions(max_retries=2, backoff_base_s=0.001, backoff_max_s=0.002),
+    )
+    with pytest.raises(httpx.ReadError):
+        client.request("GET", "/")
+    assert len(requests) == 3
+
+
+def test_async_client_shares_the_retry_policy(make_client: Callable[..., Client]):
+    """The async client retries the same way as the sync one."""
+    handler, requests = flaky([httpx.ConnectError, 502, 200])
+    response = asyncio.run(make_client(handler).async_client.request("GET", "/"))
+    assert response.status_code == 200
+    assert len(requests) == 3
+
+
+def test_registration_is_only_retried_if_never_sent(
+    make_client: Callable[..., Client],
+):
+    """A POST which may have reached the server is not repeated; one which never connected is."""
+    handler, requests = flaky([httpx.ConnectError, 503, 200])
+    with pytest.raises(RegistrationError):
+        make_client(handler).register_new("127.0.0.1", "00:00:00:00:00:00", "0")
+    assert [r.method for r in requests] == ["POST", "POST"]
+
+    handler, requests = flaky([httpx.ReadTimeout, 200])
+    with pytest.raises(httpx.ReadTimeout):
+        make_client(handler).register_new("127.0.0.1", "00:00:00:00:00:00", "0")
+    assert len(requests) == 1
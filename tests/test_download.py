@@ -0,0 +1,162 @@
+"""Tests for resumable, verified media downloads against a local stand-in server."""
+
+import hashlib
+import threading
+from collections.abc import Iterator
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+import httpx
+import pytest
+from pydantic import HttpUrl, SecretStr
+
+from ak_rpi.client import Client, ClientOptions
+from ak_rpi.download import ETAG_SUFFIX, PART_SUFFIX, MediaDownloader
+from ak_rpi.errors import ChecksumMismatchError, DownloadError
+
+CONTENT = bytes(range(256)) * 1200
+ETAG = '"v1"'
+
+
+class MediaServer(ThreadingHTTPServer):
+    """Serves `CONTENT` with range requests, optionally dropping the first response."""
+
+    cut_after: int | None = None
+    ranges: list[str | None]
+    paths: list[str]
+
+    def __init__(self):
+        """Listen on a free local port."""
+        super().__init__(("127.0.0.1", 0), MediaHandler)
+        self.ranges = []
+        self.paths = []
+
+
+class MediaHandler(BaseHTTPRequestHandler):
+    """Answers media requests the way the sync server does."""
+
+    server: MediaServer
+
+    def do_GET(self):
+        """Send the whole file, the requested range of it, or a 416."""
+        requested = self.headers.get("Range")
+        self.server.ranges.append(requested)
+        self.server.paths.append(self.path)
+        start = 0
+        if requested is not None and self.headers.get("If-Range") in (None, ETAG):
+            start = int(requested.removeprefix("bytes=").rstrip("-"))
+        if start >= len(CONTENT):
+            self.send_response(416)
+            self.send_header("Content-Range", f"bytes */{len(CONTENT)}")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        body = CONTENT[start:]
+        self.send_response(206 if start else 200)
+        if start:
+            self.send_header(
+                "Content-Range", f"bytes {start}-{len(CONTENT) - 1}/{len(CONTENT)}"
+            )
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("ETag", ETAG)
+        self.send_header("X-Content-SHA256", hashlib.sha256(CONTENT).hexdigest())
+        self.end_headers()
+        cut_after, self.server.cut_after = self.server.cut_after, None
+        # a dropped connection leaves the body short of its Content-Length
+        self.wfile.write(body if cut_after is None else body[:cut_after])
+
+    def log_message(self, format: str, *args: object):  # noqa: A002
+        """Keep the test output quiet."""
+
+
+@pytest.fixture
+def server() -> Iterator[MediaServer]:
+    """Run the stand-in server on a background thread."""
+    server = MediaServer()
+    thread = threading.Thread(target=server.serve_forever, args=(0.01,), daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def downloader(server: MediaServer, tmp_path: Path):
+    """Make a downloader into a temporary media dir, without pre-warming the decoder."""
+    url = f"http://127.0.0.1:{server.server_address[1]}"
+    client = Client(
+        syncUrl=HttpUrl(url),
+        password=SecretStr("secret"),
+        client=httpx.Client(base_url=url),
+        options=ClientOptions(backoff_base_s=0.001, backoff_max_s=0.002),
+    )
+    yield MediaDownloader(
+        client=client, root=tmp_path / "media", chunk_size=4096, prewarm=False
+    )
+    client.client.close()
+
+
+def test_an_interrupted_download_resumes(
+    server: MediaServer, downloader: MediaDownloader
+):
+    """A dropped connection is resumed with a range request, not started over."""
+    server.cut_after = 100_000
+    result = downloader.fetch("track.wav")
+    assert result.path.read_bytes() == CONTENT
+    assert result.verified
+    assert 0 < result.resumed_from <= 100_000
+    assert result.downloaded_bytes == len(CONTENT) - result.resumed_from
+    assert server.ranges == [None, f"bytes={result.resumed_from}-"]
+    assert not list(result.path.parent.glob(f"*{PART_SUFFIX}*"))
+
+
+def test_a_changed_file_is_restarted(server: MediaServer, downloader: MediaDownloader):
+    """A partial download of an older version is discarded rather than spliced."""
+    media = downloader.root
+    media.mkdir()
+    (media / f"track.wav{PART_SUFFIX}").write_bytes(b"old contents")
+    (media / f"track.wav{PART_SUFFIX}{ETAG_SUFFIX}").write_text('"v0"')
+    result = downloader.fetch("track.wav")
+    assert result.path.read_bytes() == CONTENT
+    assert result.resumed_from == 0
+    assert server.ranges == ["bytes=12-"]
+
+
+def test_a_complete_part_file_is_only_verified(
+    server: MediaServer, downloader: MediaDownloader
+):
+    """A part file which already holds everything is verified without a transfer."""
+    media = downloader.root
+    media.mkdir()
+    (media / f"track.wav{PART_SUFFIX}").write_bytes(CONTENT)
+    result = downloader.fetch("track.wav", hashlib.sha256(CONTENT).hexdigest())
+    assert result.path.read_bytes() == CONTENT
+    assert result.downloaded_bytes == 0
+    assert result.verified
+
+
+def test_a_checksum_mismatch_leaves_nothing_behind(downloader: MediaDownloader):
+    """Contents which do not match the expected hash are deleted, not renamed into place."""
+    with pytest.raises(ChecksumMismatchError):
+        downloader.fetch("track.wav", expected_sha256="0" * 64)
+    assert not list(downloader.root.iterdir())
+
+
+@pytest.mark.parametrize("media_path", ["../x", "/etc/x"])
+def test_a_path_outside_the_media_dir_is_refused(
+    server: MediaServer, downloader: MediaDownloader, media_path: str
+):
+    """A path escaping the media directory fails before anything is requested or written."""
+    with pytest.raises(DownloadError):
+        downloader.fetch(media_path)
+    assert not server.paths
+    assert not downloader.root.parent.joinpath("x").exists()
+
+
+def test_the_path_is_quoted_in_the_url(
+    server: MediaServer, downloader: MediaDownloader
+):
+    """Characters with a meaning in URLs are sent quoted and saved as named."""
+    result = downloader.fetch("album/track #1?.wav")
+    assert server.paths == ["/api/media/album/track%20%231%3F.wav"]
+    assert result.path == downloader.root / "album" / "track #1?.wav"
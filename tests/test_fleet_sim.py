@@ -0,0 +1,51 @@
+"""Tests for the virtual-time fleet simulation."""
+
+import httpx
+import pytest
+
+from ak_rpi.fleet_sim import FleetSimulation, SimulatedClock, StandInServer, VirtualTime
+from ak_rpi.udp_sync import LinkProfile
+
+
+def test_the_oscillator_maps_back_to_true_time():
+    """A skewed oscillator's reading converts back to the true time it was taken at."""
+    time_source = VirtualTime(now_ms=60_000)
+    clock = SimulatedClock(
+        time_source=time_source, skew=50e-6, monotonic_origin_ms=1234.5
+    )
+    assert clock.monotonic_ms() == pytest.approx(1234.5 + 60_003)
+    assert clock.true_time(clock.monotonic_ms()) == pytest.approx(60_000)
+
+
+def test_the_stand_in_server_advances_virtual_time():
+    """An exchange takes the link's delays and the processing time, stamped in whole ms."""
+    time_source = VirtualTime(now_ms=1000.7)
+    server = StandInServer(
+        time_source=time_source, link=LinkProfile(latency_ms=10), processing_ms=0.5
+    )
+    request = httpx.Request("GET", "http://sim/api/sync", params={"reqSentAt": 1000})
+    body = server.handle(request).json()
+    assert body == {"reqSentAt": 1000, "reqReceivedAt": 1010, "resSentAt": 1011}
+    assert time_source.now_ms == pytest.approx(1021.2)
+    assert server.request_times == [pytest.approx(1010.7)]
+
+
+def test_a_small_fleet_converges_within_its_budget():
+    """Every player settles within the target error without exceeding its request budget."""
+    simulation = FleetSimulation(
+        n_players=5, link=LinkProfile(latency_ms=1, jitter_ms=0.2)
+    )
+    report = simulation.run(duration_s=600)
+    assert report.n_players == 5
+    assert report.n_unconverged == 0
+    assert report.error_p95_ms <= simulation.policy.target_error_ms
+    assert report.requests_per_player_hour <= simulation.policy.budget_per_hour
+
+
+def test_a_seeded_run_is_reproducible():
+    """Two runs with the same seed report the same errors and load."""
+    first, second = (
+        FleetSimulation(n_players=3, seed=7).run(duration_s=300) for _ in range(2)
+    )
+    exclude = {"wall_s", "server_capacity_rps"}
+    assert first.model_dump(exclude=exclude) == second.model_dump(exclude=exclude)
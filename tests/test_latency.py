@@ -0,0 +1,97 @@
+"""Tests for output latency calibration."""
+
+from pathlib import Path
+
+import pytest
+
+from ak_rpi.latency import (
+    DEFAULT_OUTPUT_LATENCY_MS,
+    LatencyCalibrator,
+    LatencyStore,
+    OutputDevice,
+    SimulatedOutputDevice,
+    benchmark,
+    read_alsa_status,
+)
+
+
+def write_substream(root: Path, card: int, status: str, hw_params: str):
+    """Write the procfs files of a playback substream."""
+    sub = root / f"card{card}" / "pcm0p" / "sub0"
+    sub.mkdir(parents=True)
+    (root / f"card{card}" / "id").write_text(f"Card{card}\n")
+    (sub / "status").write_text(status)
+    (sub / "hw_params").write_text(hw_params)
+
+
+def test_the_stream_owned_by_the_process_is_read(tmp_path: Path):
+    """Fields are parsed as numbers, and closed streams and other owners are skipped."""
+    hw_params = (
+        "access: RW_INTERLEAVED\n"
+        "rate: 48000 (48000/1)\n"
+        "period_size: 1024\n"
+        "buffer_size: 4096\n"
+    )
+    write_substream(tmp_path, 0, "closed\n", "closed\n")
+    write_substream(
+        tmp_path, 1, "state: RUNNING\nowner_pid   : 41\ndelay       : 2400\n", hw_params
+    )
+    write_substream(tmp_path, 2, "state: PREPARED\nowner_pid   : 42\n", hw_params)
+    status = read_alsa_status(tmp_path, pid=41)
+    assert status is not None
+    assert status.device_id == "alsa:Card1:0"
+    assert (status.owner_pid, status.rate, status.period_size) == (41, 48000, 1024)
+    assert status.delay_ms == 50
+    other = read_alsa_status(tmp_path, pid=42)
+    assert other is not None
+    assert other.delay_frames is None
+    # without a delay the whole ring buffer is assumed
+    assert other.delay_ms == pytest.approx(4096 / 48)
+    assert read_alsa_status(tmp_path, pid=43) is None
+
+
+def test_output_device_is_abstract():
+    """An output must identify itself and its mixer format."""
+    with pytest.raises(TypeError):
+        OutputDevice()  # type: ignore[abstract]
+
+
+def test_calibration_measures_and_is_reused(tmp_path: Path):
+    """The estimate misses the hidden delay, the measurement finds it, and it is kept."""
+    device = SimulatedOutputDevice(jitter_ms=0.1)
+    store = LatencyStore(path=tmp_path / "latency.json")
+    calibrator = LatencyCalibrator(device=device, store=store)
+    estimated = calibrator.calibrate(measure=False)
+    assert estimated.measured_ms is None
+    assert estimated.latency_ms == pytest.approx(
+        device.true_latency_ms - device.hidden_delay_ms, abs=0.05
+    )
+    measured = calibrator.calibrate()
+    assert measured.n_measurements == calibrator.n_impulses
+    assert measured.latency_ms == pytest.approx(device.true_latency_ms, abs=0.5)
+    reloaded = LatencyCalibrator(
+        device=device, store=LatencyStore.Load(store.path)
+    ).calibrate()
+    assert reloaded == measured
+
+
+def test_a_silent_device_falls_back_to_the_default(tmp_path: Path):
+    """A device that reports no delay and is never detected gets the old constant."""
+    device = SimulatedOutputDevice(reported_delay_ms=None, detect_rate=0)
+    profile = LatencyCalibrator(
+        device=device, store=LatencyStore(path=tmp_path / "latency.json")
+    ).calibrate()
+    assert profile.device_ms is None
+    assert profile.measured_ms is None
+    assert profile.latency_ms == DEFAULT_OUTPUT_LATENCY_MS
+
+
+def test_calibration_narrows_a_mixed_fleet(tmp_path: Path):
+    """A mixed fleet is heard closer together estimated, and closer still measured."""
+    report = benchmark(tmp_path)
+    assert (
+        report.measured_spread_ms
+        < report.estimated_spread_ms
+        < report.constant_spread_ms
+    )
+    assert report.measured_spread_ms < 5
@@ -0,0 +1,109 @@
+"""Tests for the persistent media index and its directory watcher."""
+
+import threading
+from collections.abc import Callable
+from pathlib import Path
+
+import pytest
+
+from ak_rpi import media_index as media_index_module
+from ak_rpi.media_index import MediaIndex
+
+
+@pytest.fixture
+def hashes(monkeypatch: pytest.MonkeyPatch):
+    """Record the files the index hashes."""
+    hashed: list[str] = []
+    hash_file = media_index_module.hash_file
+
+    def counting_hash_file(path: Path):
+        hashed.append(path.name)
+        return hash_file(path)
+
+    monkeypatch.setattr(media_index_module, "hash_file", counting_hash_file)
+    return hashed
+
+
+def make_index(tmp_path: Path):
+    """Load an index of `tmp_path/media`, persisted outside it."""
+    return MediaIndex.Load(root=tmp_path / "media", index_path=tmp_path / "index.json")
+
+
+@pytest.fixture
+def media(make_wav: Callable[..., Path], tmp_path: Path):
+    """Make a media dir with two tones, one in a subdirectory, and some clutter."""
+    root = tmp_path / "media"
+    (root / "sub").mkdir(parents=True)
+    (root / ".hidden").mkdir()
+    for rel in ("b.wav", "sub/a.wav", ".hidden/c.wav"):
+        make_wav(name="tone.wav", duration_ms=100).rename(root / rel)
+    (root / "notes.txt").write_text("not media")
+    return root
+
+
+def test_only_new_or_changed_files_are_hashed(
+    media: Path, tmp_path: Path, hashes: list[str]
+):
+    """A rescan of an unchanged directory hashes nothing, and a change only that file."""
+    index = make_index(tmp_path)
+    assert sorted(index.entries) == ["b.wav", "sub/a.wav"]
+    assert sorted(hashes) == ["a.wav", "b.wav"]
+    hashes.clear()
+    assert not index.refresh()
+    assert hashes == []
+    (media / "b.wav").write_bytes((media / "b.wav").read_bytes() + bytes(4))
+    assert index.refresh()
+    assert hashes == ["b.wav"]
+
+
+def test_the_index_persists_between_runs(
+    media: Path, tmp_path: Path, hashes: list[str]
+):
+    """A reloaded index keeps its hashes and durations without rehashing."""
+    first = make_index(tmp_path)
+    hashes.clear()
+    second = make_index(tmp_path)
+    assert hashes == []
+    assert second.entries == first.entries
+    entry = second.get("sub/a.wav")
+    assert entry is not None
+    assert entry.duration_ms == pytest.approx(100, abs=0.05)
+    # the tones are identical, so their contents are found under the first path
+    assert second.find_by_hash(entry.content_hash) == second.get("b.wav")
+
+
+def test_selection_is_deterministic(media: Path, tmp_path: Path):
+    """The preferred file is selected if indexed, else the first by path."""
+    index = make_index(tmp_path)
+    assert index.select() == media / "b.wav"
+    assert index.select(preferred="sub/a.wav") == media / "sub/a.wav"
+    assert index.select(preferred="missing.wav") == media / "b.wav"
+
+
+@pytest.mark.parametrize("inotify", [True, False])
+def test_watch_reports_changes(
+    media: Path,
+    tmp_path: Path,
+    make_wav: Callable[..., Path],
+    monkeypatch: pytest.MonkeyPatch,
+    inotify: bool,
+):
+    """The watcher picks up a new file and calls back, with inotify or by polling."""
+    if not inotify:
+
+        def unavailable():
+            raise OSError
+
+        monkeypatch.setattr(media_index_module, "_Inotify", unavailable)
+    index = make_index(tmp_path)
+    index.poll_interval_s = index.settle_s = 0.01
+    changed = threading.Event()
+    index.watch(on_change=changed.set)
+    try:
+        # give the watcher time to set up before the change
+        threading.Event().wait(0.05)
+        make_wav(name="tone.wav", duration_ms=100).rename(media / "sub" / "new.wav")
+        assert changed.wait(timeout=5)
+        assert index.get("sub/new.wav") is not None
+    finally:
+        index.stop()
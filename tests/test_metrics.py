@@ -0,0 +1,85 @@
+"""Tests for the metrics registry and its exposition."""
+
+from pathlib import Path
+
+import httpx
+import pytest
+
+from ak_rpi.metrics import Counter, Histogram, Metric, MetricsRegistry
+
+
+def test_labelled_metrics_render_per_child():
+    """Each set of label values is its own child, rendered under the parent's name."""
+    registry = MetricsRegistry()
+    failures = registry.counter("failures", "Failed requests.", ("status",))
+    failures.labels("500").inc()
+    failures.labels(503).inc(2)
+    child = failures.labels("500")
+    assert isinstance(child, Counter)
+    assert child.value == 1
+    registry.gauge("offset_ms").set(-1.5)
+    assert registry.render() == (
+        "# HELP failures Failed requests.\n"
+        "# TYPE failures counter\n"
+        'failures_total{status="500"} 1.0\n'
+        'failures_total{status="503"} 2.0\n'
+        "# HELP offset_ms \n"
+        "# TYPE offset_ms gauge\n"
+        "offset_ms -1.5\n"
+    )
+
+
+def test_metric_is_abstract():
+    """A metric must declare its Prometheus type and the samples it exposes."""
+    with pytest.raises(TypeError):
+        Metric(name="bare")  # type: ignore[abstract]
+
+
+def test_histogram_buckets_are_cumulative():
+    """Observations count into every bucket at or above them, and quantiles interpolate."""
+    registry = MetricsRegistry()
+    histogram = registry.histogram("rtt_ms", buckets=(1, 2, 4))
+    for value in (0.5, 1.5, 1.5, 3, 10):
+        histogram.observe(value)
+    assert histogram.count == 5
+    assert histogram.sum == pytest.approx(16.5)
+    assert list(histogram.samples()) == [
+        ("_bucket", 'le="1.0"', 1),
+        ("_bucket", 'le="2.0"', 3),
+        ("_bucket", 'le="4.0"', 4),
+        ("_bucket", 'le="+Inf"', 5),
+        ("_sum", "", 16.5),
+        ("_count", "", 5),
+    ]
+    assert histogram.quantile(0.5) == pytest.approx(1.75)
+    assert histogram.quantile(1) == 4
+
+
+def test_a_name_is_registered_once():
+    """Getting a metric again returns it, but not as a different kind."""
+    registry = MetricsRegistry()
+    histogram = registry.histogram("latency_ms")
+    assert registry.histogram("latency_ms") is histogram
+    assert isinstance(registry.get("latency_ms"), Histogram)
+    with pytest.raises(ValueError, match="histogram"):
+        registry.counter("latency_ms")
+
+
+def test_metrics_are_served_and_exported(tmp_path: Path):
+    """The exposition is served over HTTP and written for the textfile collector."""
+    registry = MetricsRegistry()
+    registry.counter("requests").inc()
+    collected = []
+    registry.add_collector(lambda: collected.append(True))
+    host, port = registry.serve(0)
+    try:
+        response = httpx.get(f"http://{host}:{port}/metrics")
+        assert response.status_code == 200
+        assert "requests_total 1.0" in response.text
+        assert httpx.get(f"http://{host}:{port}/other").status_code == 404
+    finally:
+        registry.stop()
+    path = tmp_path / "ak.prom"
+    registry.write_textfile(path)
+    assert path.read_text() == registry.render()
+    assert len(collected) == 3
@@ -0,0 +1,325 @@
+"""Tests for NTP sync, the clock estimator and the sync policy."""
+
+import threading
+from collections.abc import Callable
+
+import httpx
+import pytest
+
+from ak_rpi.client import Client
+from ak_rpi.metrics import SYNC_FAILURES
+from ak_rpi.ntp import (
+    NTP,
+    Clock,
+    ClockEstimator,
+    ClockModel,
+    ClockSample,
+    SyncPolicy,
+    SyncTransport,
+)
+from ak_rpi.timebase import NS_PER_MS
+
+
+class FixedOffsetTransport(SyncTransport):
+    """Answers every exchange with the same offset, counting the exchanges."""
+
+    offset: float = 250.0
+    rtt: float = 4.0
+    n_exchanges: int = 0
+    exchanged: threading.Event | None = None
+
+    def exchange(self, clock: Callable[[], float]):
+        """Measure the fixed offset at the current local time."""
+        self.n_exchanges += 1
+        if self.exchanged is not None:
+            self.exchanged.set()
+        return ClockSample(local_time=clock(), offset=self.offset, rtt=self.rtt)
+
+
+def test_sync_publishes_the_fitted_offset(offline_client: Client):
+    """A foreground sync fits a model and moves server time by its offset."""
+    transport = FixedOffsetTransport()
+    ntp = NTP(client=offline_client, transport=transport)
+    assert ntp.clock_model is None
+    assert ntp.sync(8) == 250
+    assert transport.n_exchanges == 8
+    assert ntp.clock_model is not None
+    assert abs(ntp.server_time - ntp.local_time - 250) <= 1
+
+
+class BlockingTransport(FixedOffsetTransport):
+    """Holds every exchange until released."""
+
+    started: threading.Event
+    release: threading.Event
+
+    def exchange(self, clock: Callable[[], float]):
+        """Wait for the release, then measure the fixed offset."""
+        self.started.set()
+        self.release.wait()
+        return super().exchange(clock)
+
+
+def test_switching_transport_waits_for_a_sync_in_progress(offline_client: Client):
+    """A sync under way finishes on its transport; the new one starts from no samples."""
+    old = BlockingTransport(started=threading.Event(), release=threading.Event())
+    new = FixedOffsetTransport(offset=-100.0)
+    ntp = NTP(client=offline_client, transport=old)
+    syncing = threading.Thread(target=ntp.sync, args=(4,))
+    syncing.start()
+    assert old.started.wait(timeout=2)
+    switching = threading.Thread(target=ntp.set_transport, args=(new,))
+    switching.start()
+    switching.join(timeout=0.1)
+    assert switching.is_alive()
+    assert ntp.transport is old
+    old.release.set()
+    syncing.join(timeout=2)
+    switching.join(timeout=2)
+    assert not switching.is_alive()
+    assert old.n_exchanges == 4
+    assert ntp.transport is new
+    assert not ntp.estimator.samples
+    assert ntp.clock_model is not None
+    assert ntp.clock_model.offset == pytest.approx(250)
+
+
+class FailingTransport(SyncTransport):
+    """Fails every exchange, as on a lost or garbled response."""
+
+    def exchange(self, clock: Callable[[], float]):
+        """Fail the exchange."""
+        return None
+
+
+def test_failed_exchanges_keep_the_previous_offset(offline_client: Client):
+    """A sync in which every exchange fails leaves the estimate untouched."""
+    ntp = NTP(
+        client=offline_client, server_time_offset=42, transport=FailingTransport()
+    )
+    assert ntp.sync(2) == 42
+    assert ntp.clock_model is None
+
+
+def test_a_dropped_exchange_does_not_abort_the_sync(
+    make_client: Callable[..., Client],
+):
+    """An exchange failing in transport is counted as failed and the burst goes on."""
+    n_requests = 0
+
+    def handler(request: httpx.Request):
+        nonlocal n_requests
+        n_requests += 1
+        if n_requests == 2:
+            raise httpx.ReadTimeout("dropped", request=request)
+        sent = int(request.url.params["reqSentAt"])
+        return httpx.Response(
+            200, json={"reqReceivedAt": sent + 100, "resSentAt": sent + 100}
+        )
+
+    ntp = NTP(client=make_client(handler))
+    failures = SYNC_FAILURES.labels("HTTPSyncTransport")
+    failed_before = failures.value
+    ntp.sync(4)
+    assert n_requests == 4
+    assert failures.value == failed_before + 1
+    model = ntp.clock_model
+    assert model is not None
+    assert model.n_samples <= 3
+    assert abs(model.offset - 100) < 2
+
+
+def test_background_sync_runs_on_request(offline_client: Client):
+    """A requested sync runs on the worker thread without blocking the caller."""
+    exchanged = threading.Event()
+    transport = FixedOffsetTransport(exchanged=exchanged)
+    ntp = NTP(client=offline_client, transport=transport)
+    ntp.start_background_sync()
+    try:
+        ntp.request_sync()
+        assert exchanged.wait(timeout=2)
+        for _ in range(200):
+            if ntp.clock_model is not None:
+                break
+            threading.Event().wait(0.01)
+        assert ntp.clock_model is not None
+        assert not ntp.needs_sync
+    finally:
+        ntp.stop_background_sync()
+    assert ntp._worker is None
+
+
+class Oscillator(Clock):
+    """A local clock running fast against a true time the test controls."""
+
+    now_ms: float = 0.0
+    skew: float = 0.0
+    wall_error_ms: float = 0.0
+
+    def monotonic_ms(self):
+        """Read the oscillator in ms."""
+        return 5000.0 + self.now_ms * (1 + self.skew)
+
+    def monotonic_ns(self):
+        """Read the oscillator."""
+        return round(self.monotonic_ms() * NS_PER_MS)
+
+    def wall_ns(self):
+        """Read the wall clock, which is off by `wall_error_ms`."""
+        return round((self.now_ms * (1 + self.skew) + self.wall_error_ms) * NS_PER_MS)
+
+
+class TrueTimeTransport(SyncTransport):
+    """Exchanges with a server whose clock is the true time, over a symmetric link."""
+
+    oscillator: Oscillator
+    one_way_ms: float = 2.0
+
+    def exchange(self, clock: Callable[[], float]):
+        """Take one sample, advancing true time by the round trip."""
+        sent = clock()
+        self.oscillator.now_ms += self.one_way_ms
+        server_time = self.oscillator.now_ms
+        self.oscillator.now_ms += self.one_way_ms
+        received = clock()
+        midpoint = (sent + received) / 2
+        return ClockSample(
+            local_time=midpoint, offset=server_time - midpoint, rtt=received - sent
+        )
+
+
+def burst(
+    at: float, offset: float, skew: float, queueing: list[float]
+) -> list[ClockSample]:
+    """Make a burst of samples in which queueing on the way out biases the offset."""
+    return [
+        ClockSample(
+            local_time=at + i * 10,
+            offset=offset + skew * (at + i * 10) + delay / 2,
+            rtt=2.0 + delay,
+        )
+        for i, delay in enumerate(queueing)
+    ]
+
+
+def test_estimator_discards_queued_samples():
+    """Only the lowest-RTT half of a burst is kept, so queueing does not bias the fit."""
+    estimator = ClockEstimator()
+    model = estimator.update(burst(0, 100.0, 0.0, [0, 40, 0, 80, 0, 30, 0, 60]))
+    assert model is not None
+    assert model.n_samples == 4
+    assert model.min_rtt == 2.0
+    assert model.offset == pytest.approx(100.0)
+    assert model.skew == 0.0
+
+
+def test_estimator_fits_skew_once_the_window_spans_enough_time():
+    """Skew is left at zero on a short window and recovered once it spans long enough."""
+    skew = 20e-6
+    estimator = ClockEstimator(min_skew_span_ms=30000)
+    model = estimator.update(burst(0, 100.0, skew, [0, 0, 0, 0]))
+    assert model is not None
+    assert model.skew == 0.0
+    for at in range(30000, 300001, 30000):
+        model = estimator.update(burst(at, 100.0, skew, [0, 0, 50, 0, 50, 0]))
+    assert model is not None
+    assert model.skew == pytest.approx(skew, rel=1e-6)
+    assert model.offset_at(600000) == pytest.approx(100.0 + skew * 600000, abs=1e-6)
+
+
+def test_estimator_clamps_implausible_skew():
+    """A fitted skew beyond `max_abs_skew` is clamped."""
+    estimator = ClockEstimator(min_skew_span_ms=0, max_abs_skew=100e-6)
+    model = estimator.update(burst(0, 0.0, 1e-3, [0] * 8))
+    assert model is not None
+    assert model.skew == 100e-6
+
+
+def test_server_time_tracks_a_drifting_oscillator(offline_client: Client):
+    """Server time converges on the true time from a fast oscillator and a wrong wall clock."""
+    oscillator = Oscillator(skew=50e-6, wall_error_ms=-1234.5)
+    ntp = NTP(
+        client=offline_client,
+        clock=oscillator,
+        transport=TrueTimeTransport(oscillator=oscillator),
+        startup_time_ns=oscillator.wall_ns(),
+        startup_time_monotonic_ns=oscillator.monotonic_ns(),
+        estimator=ClockEstimator(min_skew_span_ms=60000),
+    )
+    for _ in range(20):
+        ntp.sync(8)
+        oscillator.now_ms += 60000
+    error = (
+        ntp.server_time_from_monotonic(oscillator.monotonic_ms()) - oscillator.now_ms
+    )
+    assert abs(error) < 0.5
+    model = ntp.clock_model
+    assert model is not None
+    # the offset grows at the oscillator's rate error, expressed per local ms
+    assert model.skew == pytest.approx(-50e-6 / (1 + 50e-6), rel=1e-3)
+
+
+def test_policy_syncs_often_without_a_model():
+    """Without a model the policy syncs at the shortest interval with the largest burst."""
+    policy = SyncPolicy(jitter_fraction=0)
+    assert policy.plan(None, ClockEstimator(), 0) == policy.min_interval_ms
+    assert policy.next_samples == policy.max_samples
+    assert policy.reason == "no clock model"
+
+
+def test_policy_backs_off_for_a_stable_clock():
+    """A tight model with a known skew is left alone for longer than a noisy one."""
+    policy = SyncPolicy(jitter_fraction=0)
+    stable = ClockModel(
+        offset=0.0,
+        skew=10e-6,
+        reference_time=0.0,
+        sigma=0.5,
+        offset_se=0.2,
+        skew_se=10e-6,
+        n_samples=16,
+        min_rtt=2.0,
+    )
+    stable_interval = policy.plan(stable, ClockEstimator(), 0)
+    assert policy.reason == "predicted drift uncertainty"
+    assert stable_interval > policy.min_interval_ms
+    assert policy.next_samples == policy.min_samples
+    noisy = stable.model_copy(update={"sigma": 8.0, "offset_se": 2.0})
+    assert policy.plan(noisy, ClockEstimator(), 0) < stable_interval
+    assert policy.next_samples > policy.min_samples
+
+
+def test_policy_waits_for_an_exhausted_budget():
+    """Once the hourly budget is spent the next sync waits for requests to age out."""
+    policy = SyncPolicy(jitter_fraction=0, budget_per_hour=20, max_samples=10)
+    policy.record_requests(20, 0)
+    assert policy.remaining_budget(1000) == 0
+    assert policy.plan(None, ClockEstimator(), 1000) == 3600000 - 1000
+    assert policy.reason == "request budget exhausted"
+    assert policy.remaining_budget(3600001) == 20
+
+
+def test_requested_syncs_respect_the_budget(offline_client: Client):
+    """A requested sync takes only what is left of the budget, and nothing once it is spent."""
+    exchanged = threading.Event()
+    transport = FixedOffsetTransport(exchanged=exchanged)
+    ntp = NTP(
+        client=offline_client,
+        transport=transport,
+        policy=SyncPolicy(budget_per_hour=10, min_samples=4, max_samples=8),
+    )
+    ntp.sync(8)
+    ntp.start_background_sync()
+    try:
+        ntp.request_sync()
+        for _ in range(200):
+            if transport.n_exchanges >= 10:
+                break
+            threading.Event().wait(0.01)
+        assert transport.n_exchanges == 10
+        ntp.request_sync()
+        threading.Event().wait(0.2)
+        assert transport.n_exchanges == 10
+        assert ntp.policy.reason == "request budget exhausted"
+    finally:
+        ntp.stop_background_sync()
@@ -0,0 +1,71 @@
+"""Tests for offline clock extrapolation and looping on the fleet's schedule."""
+
+from collections.abc import Callable
+from pathlib import Path
+
+import pytest
+
+from ak_rpi.audio import AudioPlayer
+from ak_rpi.client import Client
+from ak_rpi.ntp import NTP, ClockModel
+from ak_rpi.offline import OfflineClock, OfflineLooper
+from ak_rpi.pcm_cache import PCMCache
+from ak_rpi.timebase import NS_PER_MS
+
+MODEL = ClockModel(
+    offset=1234.5,
+    skew=20e-6,
+    reference_time=0.0,
+    sigma=0.5,
+    offset_se=0.2,
+    skew_se=0.0,
+    n_samples=8,
+    min_rtt=2.0,
+)
+
+
+def test_offline_clock_agrees_with_ntp(offline_client: Client):
+    """The offline clock converts exactly as NTP does with the same model and anchors."""
+    clock = OfflineClock(
+        model=MODEL, startup_time_ns=10_000_000 * NS_PER_MS, startup_time_monotonic_ns=0
+    )
+    ntp = NTP(
+        client=offline_client,
+        startup_time_ns=clock.startup_time_ns,
+        startup_time_monotonic_ns=clock.startup_time_monotonic_ns,
+    )
+    ntp.restore(MODEL, [])
+    for monotonic_time in (0.0, 12.25, 3_600_000.5):
+        server_time = clock.server_time_from_monotonic(monotonic_time)
+        assert server_time == ntp.server_time_from_monotonic(monotonic_time)
+        assert clock.monotonic_from_server_time(server_time) == pytest.approx(
+            monotonic_time, abs=1e-6
+        )
+    assert abs(clock.server_time - ntp.server_time) <= 1
+
+
+def test_error_grows_with_the_prior_skew():
+    """Without a fitted skew the error bound widens with the model's age."""
+    clock = OfflineClock(model=MODEL, startup_time_ns=0, startup_time_monotonic_ns=0)
+    assert clock.error_ms(0) == pytest.approx(MODEL.ci)
+    hour = clock.error_ms(3_600_000)
+    assert hour > clock.error_ms(60_000) > MODEL.ci
+    # the prior skew is a 95% bound, so it contributes its full drift to a 95% bound
+    assert hour == pytest.approx(3_600_000 * clock.prior_skew, rel=1e-3)
+
+
+def test_loops_start_on_the_fleet_schedule(
+    mixer: tuple[int, int, int], make_wav: Callable[..., Path], pcm_cache: PCMCache
+):
+    """The next loop start is on the anchor's schedule and at least half a pre-roll away."""
+    audio = AudioPlayer.Load(make_wav(duration_ms=250).as_posix(), cache=pcm_cache)
+    clock = OfflineClock(model=MODEL)
+    anchor = clock.server_time - 10 * audio.sound_ms + 3.5
+    looper = OfflineLooper(
+        audio=audio, clock=clock, anchor_server_time=anchor, duration=audio.sound_ms
+    )
+    start = looper.next_loop_start_server_time
+    periods = (start - anchor) / audio.sound_ms
+    assert periods == pytest.approx(round(periods), abs=1e-6)
+    assert start >= clock.server_time + looper.preroll_ms / 2 - 1
+    assert start < clock.server_time + looper.preroll_ms / 2 + audio.sound_ms + 1
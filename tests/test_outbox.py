@@ -0,0 +1,129 @@
+"""Tests for the coalescing, persistent outbox."""
+
+import json
+import threading
+from collections.abc import Callable
+from pathlib import Path
+
+import httpx
+import pytest
+
+from ak_rpi.client import Client
+from ak_rpi.outbox import Outbox
+
+
+class Server:
+    """Records reports and answers them with a status the test sets."""
+
+    def __init__(self):
+        """Start answering 200."""
+        self.status = 200
+        self.received: list[tuple[str, dict]] = []
+        self.got_request = threading.Event()
+
+    def __call__(self, request: httpx.Request) -> httpx.Response:
+        """Record a report."""
+        self.received.append((request.url.path, json.loads(request.content)))
+        self.got_request.set()
+        return httpx.Response(self.status, json={})
+
+
+@pytest.fixture
+def server():
+    """Make a stand-in server."""
+    return Server()
+
+
+@pytest.fixture
+def client(make_client: Callable[..., Client], server: Server):
+    """Make a client of the stand-in server."""
+    return make_client(server)
+
+
+@pytest.fixture
+def journal(tmp_path: Path):
+    """Get a journal path in a temporary directory."""
+    return tmp_path / "outbox.jsonl"
+
+
+def test_reports_of_a_field_coalesce(client: Client, server: Server, journal: Path):
+    """Only the latest value of each field is sent."""
+    outbox = Outbox(client=client, journal_path=journal)
+    for value in range(10):
+        outbox.put_lastTimestamp(1, 1000 + value)
+    outbox.put_duration(1, 5000)
+    assert outbox.flush()
+    assert sorted(server.received) == [
+        ("/api/mediaplayer/1/duration", {"duration": 5000}),
+        ("/api/mediaplayer/1/timestamp", {"lastTimestamp": 1009}),
+    ]
+    assert outbox.pending == []
+
+
+def test_pending_reports_survive_a_restart(
+    client: Client, server: Server, journal: Path
+):
+    """Unacknowledged reports are replayed from the journal; acknowledged ones are not."""
+    outbox = Outbox(client=client, journal_path=journal)
+    outbox.put_duration(1, 5000)
+    assert outbox.flush()
+    outbox.put_lastTimestamp(1, 1234)
+    # a torn write from a power cut
+    with open(journal, "a") as f:
+        f.write('{"player_id": 1, "fie')
+    restored = Outbox(client=client, journal_path=journal)
+    assert [(e.field, e.value) for e in restored.pending] == [("lastTimestamp", 1234)]
+
+
+def test_server_errors_are_kept_and_back_off(
+    client: Client, server: Server, journal: Path
+):
+    """A report the server fails is kept for the next flush, and flushes back off."""
+    server.status = 503
+    outbox = Outbox(
+        client=client, journal_path=journal, backoff_base_ms=100, backoff_max_ms=400
+    )
+    outbox.put_lastTimestamp(1, 1234)
+    assert not outbox.flush()
+    assert len(outbox.pending) == 1
+    delays = []
+    for failures in range(1, 5):
+        outbox._failures = failures
+        delays.append(outbox.backoff_ms)
+    assert delays == [100, 200, 400, 400]
+    server.status = 200
+    assert outbox.flush()
+    assert outbox.pending == []
+
+
+def test_rejected_reports_are_dropped(client: Client, server: Server, journal: Path):
+    """A report the server rejects is dropped rather than retried forever."""
+    server.status = 400
+    outbox = Outbox(client=client, journal_path=journal)
+    outbox.put_duration(1, 5000)
+    assert outbox.flush()
+    assert outbox.pending == []
+
+
+def test_journal_is_compacted(client: Client, server: Server, journal: Path):
+    """The journal is rewritten with only the pending reports once it grows too long."""
+    outbox = Outbox(client=client, journal_path=journal, max_journal_entries=8)
+    for value in range(20):
+        outbox.put_lastTimestamp(1, value)
+    assert len(journal.read_text().splitlines()) <= 8
+    restored = Outbox(client=client, journal_path=journal)
+    assert [e.value for e in restored.pending] == [19]
+
+
+def test_worker_flushes_in_the_background(
+    client: Client, server: Server, journal: Path
+):
+    """Queued reports are sent by the worker without the caller flushing."""
+    outbox = Outbox(client=client, journal_path=journal, flush_delay_ms=10)
+    outbox.start()
+    try:
+        outbox.put_lastTimestamp(1, 1234)
+        assert server.got_request.wait(timeout=2)
+    finally:
+        outbox.stop()
+    assert outbox.pending == []
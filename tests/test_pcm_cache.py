@@ -0,0 +1,61 @@
+"""Tests for the on-disk PCM cache and its content hash memo."""
+
+import json
+import threading
+from collections.abc import Callable
+from pathlib import Path
+
+import pygame
+
+from ak_rpi.pcm_cache import PCMCache
+
+
+def test_a_cold_decode_caches_the_mixer_pcm(
+    mixer: tuple[int, int, int], make_wav: Callable[..., Path], pcm_cache: PCMCache
+):
+    """The cached PCM is exactly what the mixer decodes, and is then a hit."""
+    path = make_wav(duration_ms=100)
+    pcm, hit = pcm_cache.open(path)
+    try:
+        assert not hit
+        assert pcm[:] == pygame.mixer.Sound(path.as_posix()).get_raw()
+    finally:
+        pcm.close()
+    pcm, hit = pcm_cache.open(path)
+    pcm.close()
+    assert hit
+
+
+def test_the_hash_memo_drops_changed_and_deleted_files(
+    make_wav: Callable[..., Path], pcm_cache: PCMCache
+):
+    """Memos are kept only for files which are still on disk unchanged."""
+    kept, changed, deleted = (make_wav(name=f"{n}.wav", duration_ms=10) for n in "abc")
+    for path in (kept, changed, deleted):
+        pcm_cache.content_hash(path)
+    changed.write_bytes(changed.read_bytes() + bytes(4))
+    deleted.unlink()
+    pcm_cache.content_hash(changed)
+    memo = json.loads(pcm_cache.hashes_path.read_text())
+    assert sorted(Path(key.rsplit(":", 2)[0]).name for key in memo) == [
+        "a.wav",
+        "b.wav",
+    ]
+
+
+def test_concurrent_hashing_keeps_every_memo(
+    make_wav: Callable[..., Path], pcm_cache: PCMCache
+):
+    """Loader threads hashing at once neither lose memos nor leave temporary files."""
+    paths = [
+        make_wav(name=f"{i}.wav", duration_ms=10, tone_hz=100 + i) for i in range(8)
+    ]
+    threads = [
+        threading.Thread(target=pcm_cache.content_hash, args=(path,)) for path in paths
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(json.loads(pcm_cache.hashes_path.read_text())) == len(paths)
+    assert not list(pcm_cache.cache_dir.glob("*.tmp"))
@@ -0,0 +1,165 @@
+"""Tests for the PCM sources, the ring buffer and the buffered reader."""
+
+import threading
+from collections.abc import Callable
+from pathlib import Path
+
+import pytest
+
+from ak_rpi.errors import StreamingError
+from ak_rpi.pcm_cache import PCMCache
+from ak_rpi.pcm_source import (
+    BufferedSource,
+    MemorySource,
+    PCMSource,
+    RingBuffer,
+    WavSource,
+)
+from ak_rpi.stream import StreamingAudioPlayer
+
+FORMAT = {"frequency": 1000, "size": -16, "channels": 1}
+
+
+def counting_pcm(n_frames: int):
+    """Make mono 16-bit PCM whose every frame holds its index."""
+    return memoryview(b"".join(i.to_bytes(2, "little") for i in range(n_frames)))
+
+
+class SlowSource(MemorySource):
+    """Blocks every read until the test lets it through, as a stalled decoder would."""
+
+    proceed: threading.Event
+    reading: threading.Event
+
+    def read(self, n_frames: int):
+        """Wait for the test, then read."""
+        self.reading.set()
+        self.proceed.wait()
+        return super().read(n_frames)
+
+
+def test_pcm_source_is_abstract():
+    """A source must implement reading and seeking."""
+    with pytest.raises(TypeError):
+        PCMSource(**FORMAT)
+
+
+def test_ring_buffer_wraps_around():
+    """Data written across the end of the buffer is read back in order."""
+    ring = RingBuffer(capacity=8)
+    assert ring.write(b"abcdef") == 6
+    assert ring.read(4) == b"abcd"
+    assert ring.write(memoryview(b"ghijkl")) == 6
+    assert ring.size == 8
+    assert ring.write(b"m", timeout=0) == 0
+    assert ring.read(8) == b"efghijkl"
+
+
+def test_ring_buffer_read_times_out_short():
+    """A read waits for at most its timeout and returns what there is."""
+    ring = RingBuffer(capacity=8)
+    ring.write(b"ab")
+    assert ring.read(4, timeout=0.01) == b"ab"
+    assert ring.size == 0
+
+
+def test_buffered_source_decodes_ahead_and_seeks():
+    """The reader returns the source in order, and only the new position after a seek."""
+    reader = BufferedSource(
+        source=MemorySource(pcm=counting_pcm(1000), **FORMAT), chunk_ms=10
+    )
+    reader.start(0)
+    try:
+        assert reader.read(20, timeout=1) == bytes(counting_pcm(20))
+        reader.seek(500)
+        assert reader.read(20, timeout=1) == bytes(counting_pcm(520)[1000:])
+        reader.seek(990)
+        assert reader.read(20, timeout=1) == bytes(counting_pcm(1000)[1980:])
+        for _ in range(100):
+            if reader.exhausted:
+                break
+            threading.Event().wait(0.01)
+        assert reader.exhausted
+    finally:
+        reader.close()
+
+
+def test_seeking_back_from_the_end_wakes_the_decoder():
+    """A seek after the source is exhausted is decoded without waiting out the idle poll."""
+    reader = BufferedSource(
+        source=MemorySource(pcm=counting_pcm(100), **FORMAT), chunk_ms=1000
+    )
+    reader.start(0)
+    try:
+        for _ in range(100):
+            if reader.exhausted or reader.buffered_ms >= 100:
+                break
+            threading.Event().wait(0.01)
+        assert reader.read(100, timeout=1) == bytes(counting_pcm(100))
+        # the decoder now idles for a whole chunk unless the seek wakes it
+        threading.Event().wait(0.05)
+        reader.seek(10)
+        assert reader.read(10, timeout=0.2) == bytes(counting_pcm(20)[20:])
+    finally:
+        reader.close()
+
+
+def test_a_slow_source_does_not_block_readers_or_seeks():
+    """Reads and seeks return while the decoder is stuck in the source."""
+    proceed, reading = threading.Event(), threading.Event()
+    reader = BufferedSource(
+        source=SlowSource(
+            pcm=counting_pcm(1000), proceed=proceed, reading=reading, **FORMAT
+        ),
+        chunk_ms=10,
+    )
+    reader.start(0)
+    try:
+        assert reading.wait(timeout=1)
+        done = threading.Event()
+
+        def read_and_seek():
+            reader.read(10, timeout=0)
+            reader.seek(100)
+            done.set()
+
+        threading.Thread(target=read_and_seek, daemon=True).start()
+        assert done.wait(timeout=1)
+        proceed.set()
+        # the chunk read before the seek is discarded
+        assert reader.read(10, timeout=1) == bytes(counting_pcm(110)[200:])
+    finally:
+        proceed.set()
+        reader.close()
+
+
+def test_wav_source_converts_to_the_mixer_format(make_wav: Callable[..., Path]):
+    """A mono 22.05kHz WAV is read as stereo at the mixer's rate."""
+    source = WavSource(
+        path=make_wav(duration_ms=100, frequency=22050, channels=1),
+        frequency=44100,
+        size=-16,
+        channels=2,
+    )
+    try:
+        assert source.n_frames == 4410
+        data = b""
+        while chunk := source.read(1000):
+            data += chunk
+        assert abs(len(data) // source.frame_bytes - 4410) <= 2
+    finally:
+        source.close()
+
+
+def test_streaming_without_ffmpeg_fails_loudly(
+    mixer, tmp_path: Path, pcm_cache: PCMCache, monkeypatch: pytest.MonkeyPatch
+):
+    """An uncached MP3 is not decoded whole when ffmpeg is missing."""
+    from ak_rpi.pcm_source import FFmpegSource
+
+    monkeypatch.setattr(FFmpegSource, "available", staticmethod(lambda: False))
+    path = tmp_path / "track.mp3"
+    path.write_bytes(b"\xff\xfb\x90\x44" + bytes(413))
+    with pytest.raises(StreamingError):
+        StreamingAudioPlayer.Load(path.as_posix(), cache=pcm_cache)
+    assert not list(pcm_cache.cache_dir.glob("*.pcm"))
@@ -0,0 +1,105 @@
+"""Tests for peer discovery, leader election and clock sharing between players."""
+
+import socket
+import threading
+from collections.abc import Callable, Iterator
+
+import pytest
+
+from ak_rpi.client import Client
+from ak_rpi.ntp import NTP, ClockModel
+from ak_rpi.peer import PeerSync
+from ak_rpi.udp_sync import UDPSyncTransport
+
+MODEL = ClockModel(
+    offset=1234.5,
+    skew=0.0,
+    reference_time=0.0,
+    sigma=0.5,
+    offset_se=0.2,
+    skew_se=0.0,
+    n_samples=8,
+    min_rtt=2.0,
+)
+
+
+def free_udp_port():
+    """Find a UDP port nothing is bound to."""
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.bind(("", 0))
+        return sock.getsockname()[1]
+
+
+def wait_for(condition: Callable[[], bool], timeout_s: float = 5):
+    """Poll until `condition` holds or the timeout passes."""
+    for _ in range(int(timeout_s / 0.01)):
+        if condition():
+            return True
+        threading.Event().wait(0.01)
+    return condition()
+
+
+@pytest.fixture
+def make_peers(offline_client: Client) -> Iterator[Callable[..., list[PeerSync]]]:
+    """Start players sharing a group and port on this host, stopping them afterwards."""
+    started: list[PeerSync] = []
+    port = free_udp_port()
+
+    def make(*player_ids: int):
+        for player_id in player_ids:
+            ntp = NTP(client=offline_client)
+            ntp.restore(MODEL, [])
+            peers = PeerSync(
+                ntp=ntp,
+                player_id=player_id,
+                tenant_id=1,
+                port=port,
+                interface="127.0.0.1",
+                announce_interval_s=0.05,
+            )
+            try:
+                peers.start()
+            except OSError as e:
+                pytest.skip(f"Multicast is unavailable: {e!r}")
+            started.append(peers)
+        return started
+
+    yield make
+    for peers in started:
+        peers.stop()
+
+
+def test_players_on_one_host_elect_a_leader_and_share_its_clock(
+    make_peers: Callable[..., list[PeerSync]],
+):
+    """The lowest id leads and serves its clock; the others sync to it over UDP."""
+    players = {peers.player_id: peers for peers in make_peers(3, 1, 2)}
+    leader, followers = players[1], [players[2], players[3]]
+    if not wait_for(lambda: all(p.following for p in followers)):
+        pytest.skip("Multicast is not delivered on this host.")
+    assert leader.is_leader
+    assert not leader.following
+    for follower in followers:
+        assert follower.leader_id == 1
+        assert set(follower.peers) == {1, 2, 3} - {follower.player_id}
+        transport = follower.ntp.transport
+        assert isinstance(transport, UDPSyncTransport)
+        sample = follower.ntp.sample()
+        assert sample is not None
+        # both sides run the same model on the same monotonic clock
+        assert sample.offset == pytest.approx(MODEL.offset, abs=1)
+
+
+def test_followers_return_to_their_own_transport_when_the_leader_stops(
+    make_peers: Callable[..., list[PeerSync]],
+):
+    """A follower whose leader goes quiet takes over, syncing with the server again."""
+    first, second = make_peers(1, 2)
+    own_transport = second.ntp.transport
+    if not wait_for(lambda: second.following):
+        pytest.skip("Multicast is not delivered on this host.")
+    second.peer_timeout_s = 0.2
+    first.stop()
+    assert wait_for(lambda: second.is_leader)
+    assert not second.following
+    assert second.ntp.transport is own_transport
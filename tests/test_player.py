@@ -0,0 +1,118 @@
+"""Tests for the player's loop schedule."""
+
+from collections.abc import Callable
+from pathlib import Path
+
+import pytest
+
+from ak_rpi.audio import AudioPlayer
+from ak_rpi.media_index import MediaIndex
+from ak_rpi.outbox import Outbox
+from ak_rpi.pcm_cache import PCMCache
+from ak_rpi.player import PlayerSettings
+from ak_rpi.snapshot import SnapshotWriter
+
+
+@pytest.fixture
+def settings(
+    mixer,
+    make_wav: Callable[..., Path],
+    make_settings: Callable[..., PlayerSettings],
+    pcm_cache: PCMCache,
+):
+    """Make a player with a tone whose length is not a whole number of ms loaded."""
+    settings = make_settings()
+    # 44122 frames at 44.1kHz
+    settings.audio = AudioPlayer.Load(
+        make_wav(duration_ms=1000.5).as_posix(), cache=pcm_cache
+    )
+    yield settings
+    settings.audio.stop()
+
+
+def test_loop_period_is_the_exact_decoded_length(settings: PlayerSettings):
+    """The loop period is the decoded length, not the probed whole ms."""
+    assert settings.audio is not None
+    assert settings.audio.duration == 1000
+    assert settings.loop_period_ms == pytest.approx(44122 * 1000 / 44100, abs=1e-3)
+
+
+def test_next_loop_starts_exactly_one_period_on(settings: PlayerSettings):
+    """The next boundary is the exact period after the loop start, with no rounding."""
+    assert settings.audio is not None
+    loop_start = settings.ntp.server_time + 0.25
+    settings.loop_start_server_time = loop_start
+    assert settings.next_loop_start_server_time == loop_start + settings.audio.sound_ms
+
+
+def test_the_iteration_ends_after_the_exact_period(settings: PlayerSettings):
+    """The audio's end time, which paces the state machine, uses the decoded length."""
+    assert settings.audio is not None
+    settings.audio.play()
+    expected = settings.audio.start_time + 44122 * 1000 / 44100
+    assert settings.audio.end_time == pytest.approx(expected, abs=1e-3)
+
+
+def test_a_missed_boundary_snaps_to_the_schedule(settings: PlayerSettings):
+    """A loop end already in the past moves on by whole periods, not to now."""
+    assert settings.audio is not None
+    period = settings.audio.sound_ms
+    loop_start = settings.ntp.server_time - 3.5 * period
+    settings.loop_start_server_time = loop_start
+    assert settings.next_loop_start_server_time == loop_start + 4 * period
+
+
+def test_joining_starts_where_the_fleet_is(settings: PlayerSettings):
+    """A joining player starts part-way into the audio, on the fleet's schedule."""
+    assert settings.audio is not None
+    period = settings.audio.sound_ms
+    settings.join = True
+    settings.lastTimestamp = round(settings.ntp.server_time - 2.25 * period)
+    st, offset_ms = settings.plan_loop_start()
+    assert 0 < offset_ms < period
+    anchor = settings.lastTimestamp - settings.output_latency_ms
+    periods = (st - offset_ms - anchor) / period
+    assert periods == pytest.approx(round(periods), abs=1e-6)
+
+
+def test_media_dir_changes_reload_a_different_file(
+    settings: PlayerSettings, make_wav: Callable[..., Path], tmp_path: Path
+):
+    """A change to the media dir flags a reload only if another file should now play."""
+    assert settings.audio is not None
+    root = tmp_path / "media"
+    root.mkdir()
+    index = MediaIndex(root=root, index_path=tmp_path / "index.json")
+    settings._media_index = index
+    make_wav(name="tone.wav", duration_ms=100).rename(root / "b.wav")
+    index.refresh()
+    settings.handle_media_index_changed()
+    assert settings._reload_media
+    settings._reload_media = False
+    settings.audio.audio_file = root / "b.wav"
+    settings.handle_media_index_changed()
+    assert not settings._reload_media
+
+
+def test_closing_stops_the_background_threads(
+    make_settings: Callable[..., PlayerSettings], tmp_path: Path
+):
+    """A closed player leaves no outbox, media watcher or snapshot thread running."""
+    settings = make_settings(
+        outbox=Outbox(client=make_settings().client, journal_path=tmp_path / "outbox"),
+        snapshots=SnapshotWriter(path=tmp_path / "snapshot.json"),
+    )
+    settings.reporter.start()
+    settings.reporter.put_lastTimestamp(settings.id, 1)
+    index = MediaIndex(root=tmp_path, index_path=tmp_path / "index.json")
+    index.watch()
+    settings._media_index = index
+    settings.save_snapshot()
+    assert settings.outbox is not None and settings.snapshots is not None
+    workers = [settings.outbox._worker, index._watcher, settings.snapshots._worker]
+    settings.close()
+    for worker in workers:
+        assert worker is not None
+        worker.join(timeout=2)
+        assert not worker.is_alive()
+    assert settings._media_index is None
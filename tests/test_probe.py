@@ -0,0 +1,132 @@
+"""Tests for in-process media probing."""
+
+import shutil
+import struct
+import subprocess
+from collections.abc import Callable
+from pathlib import Path
+
+import pytest
+
+from ak_rpi.probe import compare_with_ffprobe, probe, probe_mp3
+
+# MPEG1 layer III, 128kbps, 44.1kHz, joint stereo: 417 bytes and 1152 samples per frame
+HEADER = bytes([0xFF, 0xFB, 0x90, 0x44])
+FRAME_LENGTH = 417
+FRAME_MS = 1152 * 1000 / 44100
+
+
+def frame(payload: bytes = b""):
+    """Make a frame of silence, optionally starting its data with `payload`."""
+    # the 32 bytes of stereo side information come first
+    body = bytes(32) + payload
+    return HEADER + body + bytes(FRAME_LENGTH - 4 - len(body))
+
+
+def info_frame(n_frames: int | None, delay: int = 0, padding: int = 0):
+    """Make an Info frame, with a LAME extension giving the delay and padding."""
+    flags = 0x1 if n_frames is not None else 0x0
+    tag = b"Info" + struct.pack(">I", flags)
+    if n_frames is not None:
+        tag += struct.pack(">I", n_frames)
+    lame = bytearray(b"LAME3.100" + bytes(27))
+    lame[21:24] = ((delay << 12) | padding).to_bytes(3, "big")
+    return frame(tag + bytes(lame))
+
+
+def test_wav_duration_comes_from_the_header(make_wav: Callable[..., Path]):
+    """A WAV file is probed from its data chunk size."""
+    info = probe(make_wav(duration_ms=250, frequency=22050, channels=1))
+    assert info.method == "wav-header"
+    assert info.duration_ms == pytest.approx(250, abs=0.05)
+    assert (info.sample_rate, info.channels, info.codec) == (22050, 1, "pcm")
+
+
+def test_cbr_frames_are_counted(tmp_path: Path):
+    """Without a tag the duration is the number of frames times their length."""
+    path = tmp_path / "cbr.mp3"
+    path.write_bytes(frame() * 40)
+    info = probe_mp3(path)
+    assert info is not None
+    assert info.method == "mp3-frames"
+    assert info.duration_ms == pytest.approx(40 * FRAME_MS)
+    assert (info.sample_rate, info.channels) == (44100, 2)
+
+
+def test_scan_resyncs_past_damaged_data(tmp_path: Path):
+    """Junk, stray sync bytes and trailing tags between and after frames are skipped."""
+    junk = b"\xff\xfb\x00garbage" * 10
+    id3v1 = b"TAG" + bytes(125)
+    id3v2 = b"ID3\x04\x00\x00\x00\x00\x00\x0a" + bytes(10)
+    path = tmp_path / "damaged.mp3"
+    path.write_bytes(id3v2 + junk + frame() * 10 + junk + frame() * 10 + id3v1)
+    info = probe_mp3(path)
+    assert info is not None
+    assert info.duration_ms == pytest.approx(20 * FRAME_MS)
+
+
+def test_lame_delay_and_padding_are_trimmed(tmp_path: Path):
+    """The Xing frame count is used and the LAME delay and padding are subtracted."""
+    path = tmp_path / "lame.mp3"
+    # the tag's count is trusted over the frames actually present
+    path.write_bytes(info_frame(100, delay=576, padding=1000) + frame() * 10)
+    info = probe_mp3(path)
+    assert info is not None
+    assert info.method == "mp3-xing"
+    assert info.duration_ms == pytest.approx((100 * 1152 - 1576) * 1000 / 44100)
+    assert info.padding_ms == pytest.approx(1576 * 1000 / 44100)
+
+
+def test_info_frame_without_a_count_is_not_audio(tmp_path: Path):
+    """Without a frame count the frames are counted, leaving out the Info frame itself."""
+    path = tmp_path / "info.mp3"
+    path.write_bytes(info_frame(None, delay=576, padding=576) + frame() * 10)
+    info = probe_mp3(path)
+    assert info is not None
+    assert info.method == "mp3-frames"
+    assert info.duration_ms == pytest.approx((10 * 1152 - 1152) * 1000 / 44100)
+
+
+def test_no_frames_is_not_an_mp3(tmp_path: Path):
+    """A file without two consecutive frame headers is not probed."""
+    path = tmp_path / "noise.mp3"
+    path.write_bytes(HEADER + b"not audio" * 100)
+    assert probe_mp3(path) is None
+
+
+@pytest.mark.skipif(
+    shutil.which("ffmpeg") is None or shutil.which("ffprobe") is None,
+    reason="ffmpeg is not installed",
+)
+def test_durations_match_ffprobe(make_wav: Callable[..., Path], tmp_path: Path):
+    """Probed durations of files encoded by ffmpeg agree with ffprobe's."""
+    paths = [make_wav(name="tone.wav", duration_ms=1234)]
+    for args, name in [
+        (["-b:a", "128k"], "cbr.mp3"),
+        (["-q:a", "4"], "vbr.mp3"),
+        (["-b:a", "64k", "-ar", "22050", "-ac", "1"], "mono.mp3"),
+    ]:
+        path = tmp_path / name
+        result = subprocess.run(  # noqa: S603
+            [  # noqa: S607
+                "ffmpeg",
+                "-v",
+                "error",
+                "-y",
+                "-i",
+                paths[0],
+                "-c:a",
+                "libmp3lame",
+                *args,
+                path,
+            ],
+            capture_output=True,
+        )
+        if result.returncode != 0:
+            pytest.skip(f"ffmpeg cannot encode MP3: {result.stderr.decode()}")
+        paths.append(path)
+    errors = compare_with_ffprobe(paths)
+    assert all(abs(error) < 1 for error in errors.values()), errors
+    # the decoded audio is as long as the source
+    for path in paths[1:]:
+        assert probe(path).duration_ms == pytest.approx(1234, abs=1)
@@ -0,0 +1,109 @@
+"""Tests for settings pushed over server-sent events."""
+
+import json
+from collections.abc import Callable
+from typing import Any
+
+import httpx
+import pytest
+
+from ak_rpi.client import Client
+from ak_rpi.push import SettingsPush, parse_events
+
+SETTINGS = {"volume": 50, "quietMode": 0}
+
+
+def test_events_are_parsed_from_lines():
+    """Fields accumulate until a blank line; comments and unknown fields are ignored."""
+    lines = [
+        ": heartbeat",
+        "event: settings",
+        'data: {"volume":',
+        "data:  80}",
+        "id: 7",
+        "retry: 2500",
+        "unknown: field",
+        "",
+        "",
+        "data: plain",
+        "",
+    ]
+    first, second = parse_events(lines)
+    assert first.event == "settings"
+    assert json.loads(first.data) == {"volume": 80}
+    assert (first.id, first.retry_ms) == ("7", 2500)
+    assert (second.event, second.data, second.id) == ("message", "plain", None)
+
+
+class Server:
+    """Serves the event stream and an ETag-guarded settings resource."""
+
+    def __init__(self, stream: str):
+        """Serve `stream` as the body of every event stream request."""
+        self.stream = stream
+        self.requests: list[httpx.Request] = []
+
+    def __call__(self, request: httpx.Request):
+        """Answer a request."""
+        self.requests.append(request)
+        if request.url.path.endswith("/events"):
+            return httpx.Response(
+                200,
+                headers={"Content-Type": "text/event-stream"},
+                content=self.stream.encode(),
+            )
+        if request.headers.get("If-None-Match") == '"e1"':
+            return httpx.Response(304)
+        return httpx.Response(200, headers={"ETag": '"e1"'}, json=SETTINGS)
+
+
+@pytest.fixture
+def make_push(make_client: Callable[..., Client]):
+    """Make a push listener against a server, collecting the updates it applies."""
+
+    def make(server: Server):
+        updates: list[dict[str, Any]] = []
+        push = SettingsPush(
+            client=make_client(server), player_id=1, on_update=updates.append
+        )
+        return push, updates
+
+    return make
+
+
+def test_a_stream_resyncs_then_applies_pushed_updates(
+    make_push: Callable[..., tuple[SettingsPush, list[dict[str, Any]]]],
+):
+    """Settings are fetched once the stream opens, then each pushed change applied."""
+    server = Server(
+        'event: settings\nid: 7\ndata: {"volume": 80}\n\n'
+        "event: settings\ndata: not json\n\n"
+        "event: resync\nid: 8\n\n"
+    )
+    push, updates = make_push(server)
+    push._listen()
+    # the push clears the ETag, so the resync is a full fetch
+    assert updates == [SETTINGS, {"volume": 80}, SETTINGS]
+    assert push.last_event_id == "8"
+    assert push.etag == '"e1"'
+    server.stream = ""
+    push._listen()
+    assert updates == [SETTINGS, {"volume": 80}, SETTINGS]
+    events, settings = server.requests[-2:]
+    assert events.headers["Last-Event-ID"] == "8"
+    assert settings.headers["If-None-Match"] == '"e1"'
+
+
+def test_stop_tolerates_a_stream_failing_to_close(
+    make_push: Callable[..., tuple[SettingsPush, list[dict[str, Any]]]],
+):
+    """A stream which errors while being closed does not stop the listener stopping."""
+
+    class ClosedStream:
+        def close(self):
+            raise httpx.StreamClosed
+
+    push, _ = make_push(Server(""))
+    push._response = ClosedStream()  # type: ignore[assignment]
+    push.stop()
+    assert push._stop_requested.is_set()
@@ -0,0 +1,63 @@
+"""Tests for the deadline scheduler."""
+
+import threading
+
+from ak_rpi.scheduler import Scheduler
+from ak_rpi.timebase import monotonic_ms
+
+
+def test_callbacks_run_in_deadline_order():
+    """Callbacks run in deadline order, not registration order, and no earlier."""
+    scheduler = Scheduler()
+    started = monotonic_ms()
+    ran: list[tuple[str, float]] = []
+    scheduler.call_later(20, lambda: ran.append(("late", monotonic_ms())))
+    scheduler.call_later(5, lambda: ran.append(("early", monotonic_ms())))
+    scheduler.call_soon(lambda: ran.append(("soon", monotonic_ms())))
+    scheduler.run()
+    assert [name for name, _ in ran] == ["soon", "early", "late"]
+    assert ran[1][1] >= started + 5
+    assert ran[2][1] >= started + 20
+
+
+def test_cancelled_callbacks_are_skipped():
+    """A cancelled callback never runs and does not keep the scheduler alive."""
+    scheduler = Scheduler()
+    ran: list[str] = []
+    scheduler.call_later(1, ran.append, "kept")
+    scheduler.call_later(1000, ran.append, "cancelled").cancel()
+    started = monotonic_ms()
+    scheduler.run()
+    assert ran == ["kept"]
+    assert monotonic_ms() - started < 500
+
+
+def test_callbacks_can_reschedule_themselves():
+    """A callback which registers another keeps the loop running without polling."""
+    scheduler = Scheduler()
+    ticks: list[int] = []
+
+    def tick(n: int):
+        ticks.append(n)
+        if n < 4:
+            scheduler.call_later(2, tick, n + 1)
+
+    scheduler.call_soon(tick, 0)
+    scheduler.run()
+    assert ticks == [0, 1, 2, 3, 4]
+
+
+def test_registering_from_another_thread_wakes_the_scheduler():
+    """An earlier deadline registered while the scheduler sleeps is not held back."""
+    scheduler = Scheduler()
+    ran: list[float] = []
+    scheduler.call_later(2000, scheduler.stop)
+    thread = threading.Thread(target=scheduler.run, daemon=True)
+    thread.start()
+    registered = monotonic_ms()
+    scheduler.call_later(10, lambda: ran.append(monotonic_ms()))
+    scheduler.call_later(20, scheduler.stop)
+    thread.join(timeout=1)
+    assert not thread.is_alive()
+    assert len(ran) == 1
+    assert ran[0] - registered < 500
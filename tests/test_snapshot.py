@@ -0,0 +1,133 @@
+"""Tests for player snapshots."""
+
+import json
+import threading
+from collections.abc import Callable
+from pathlib import Path
+
+import httpx
+import pytest
+
+from ak_rpi import client as client_module
+from ak_rpi import snapshot as snapshot_module
+from ak_rpi.client import Client
+from ak_rpi.ntp import ClockModel
+from ak_rpi.player import PlayerSettings
+from ak_rpi.snapshot import PlayerSnapshot, SnapshotWriter
+
+
+@pytest.fixture
+def settings(make_settings: Callable[..., PlayerSettings], tmp_path: Path):
+    """Make a player with a clock model which snapshots to a temporary directory."""
+    settings = make_settings(
+        lastTimestamp=123456,
+        snapshots=SnapshotWriter(path=tmp_path / "snapshot.json"),
+    )
+    settings.ntp.restore(
+        ClockModel(
+            offset=250.0,
+            skew=10e-6,
+            reference_time=1000.0,
+            sigma=0.5,
+            offset_se=0.2,
+            skew_se=1e-6,
+            n_samples=8,
+            min_rtt=2.0,
+        ),
+        [],
+    )
+    settings.output_latency_ms = 42.0
+    return settings
+
+
+def test_snapshot_restores_settings_and_clock(
+    settings: PlayerSettings, offline_client: Client, tmp_path: Path
+):
+    """A saved snapshot restores the settings, clock model and output latency."""
+    settings.save_snapshot()
+    assert settings.snapshot_writer.wait(timeout_s=2)
+    snapshot = PlayerSnapshot.Load(tmp_path / "snapshot.json")
+    assert snapshot is not None
+    assert snapshot.player_id == 1
+    restored = snapshot.restore(offline_client)
+    assert restored.restored_from_snapshot
+    assert restored.lastTimestamp == 123456
+    assert restored.output_latency_ms == 42.0
+    assert restored.ntp.clock_model == settings.ntp.clock_model
+
+
+def test_saving_does_not_wait_for_the_disk(
+    settings: PlayerSettings, tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+):
+    """A stalled fsync does not hold up the caller, and queued snapshots coalesce."""
+    release = threading.Event()
+    n_fsyncs = 0
+    fsync = snapshot_module.os.fsync
+
+    def stalled_fsync(fd: int):
+        nonlocal n_fsyncs
+        n_fsyncs += 1
+        release.wait()
+        fsync(fd)
+
+    monkeypatch.setattr(snapshot_module.os, "fsync", stalled_fsync)
+    for timestamp in range(10):
+        settings.lastTimestamp = timestamp
+        settings.save_snapshot()
+    assert not settings.snapshot_writer.wait(timeout_s=0.05)
+    release.set()
+    assert settings.snapshot_writer.wait(timeout_s=2)
+    snapshot = PlayerSnapshot.Load(tmp_path / "snapshot.json")
+    assert snapshot is not None
+    assert snapshot.settings["lastTimestamp"] == 9
+    # at most the write in progress, then one for everything queued behind it
+    assert n_fsyncs <= 2
+
+
+def test_a_missing_or_invalid_snapshot_is_ignored(tmp_path: Path):
+    """Loading returns None rather than failing on a missing or corrupt file."""
+    path = tmp_path / "snapshot.json"
+    assert PlayerSnapshot.Load(path) is None
+    path.write_text('{"settings": 1}')
+    assert PlayerSnapshot.Load(path) is None
+
+
+def test_a_reassigned_id_registers_again(
+    settings: PlayerSettings,
+    make_client: Callable[..., Client],
+    tmp_path: Path,
+    monkeypatch: pytest.MonkeyPatch,
+):
+    """A snapshot whose id now belongs to another device does not take its settings."""
+    monkeypatch.setattr(client_module, "get_serial_number", lambda: "0")
+    monkeypatch.setattr(client_module, "REGISTRATION_PATH", tmp_path / "registered")
+
+    def player(player_id: int, serial_number: str, nickname: str):
+        return {
+            "id": player_id,
+            "nickname": nickname,
+            "ipAddress": "127.0.0.1",
+            "macAddress": "00:00:00:00:00:00",
+            "syncUrl": str(settings.syncUrl),
+            "firmwareUrl": str(settings.firmwareUrl),
+            "volume": 100,
+            "quietMode": 0,
+            "serialNumber": serial_number,
+            "tenantId": 1,
+        }
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        if request.method == "POST":
+            return httpx.Response(200, json=player(7, "0", "registered"))
+        return httpx.Response(200, json=player(1, "someone-else", "taken"))
+
+    settings.save_snapshot()
+    assert settings.snapshot_writer.wait(timeout_s=2)
+    snapshot = PlayerSnapshot.Load(tmp_path / "snapshot.json")
+    assert snapshot is not None
+    restored = snapshot.restore(make_client(handler))
+    restored.snapshots = SnapshotWriter(path=tmp_path / "snapshot.json")
+    restored.reconcile_in_background()
+    assert not restored.restored_from_snapshot
+    assert (restored.id, restored.nickname) == (7, "registered")
+    assert json.loads((tmp_path / "registered").read_text())["id"] == 7
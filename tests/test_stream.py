@@ -0,0 +1,114 @@
+"""Tests for streaming playback and its drift correction."""
+
+import struct
+import threading
+from pathlib import Path
+
+import pygame
+import pytest
+
+from ak_rpi.pcm_source import MemorySource
+from ak_rpi.stream import StreamingAudioPlayer
+from ak_rpi.timebase import monotonic_ms
+
+
+def ramp_pcm(n_frames: int, channels: int):
+    """Make 16-bit PCM whose every frame holds its index, modulo the sample range."""
+    return memoryview(
+        b"".join(
+            struct.pack("<h", i % 32768 - 16384) * channels for i in range(n_frames)
+        )
+    )
+
+
+@pytest.fixture
+def stream(mixer: tuple[int, int, int]):
+    """A stream over two seconds of PCM, primed to read from its start without playing."""
+    frequency, size, channels = mixer
+    source = MemorySource(
+        pcm=ramp_pcm(2 * frequency, channels),
+        frequency=frequency,
+        size=size,
+        channels=channels,
+    )
+    channel = pygame.mixer.find_channel()
+    assert channel is not None
+    player = StreamingAudioPlayer(
+        channel=channel, duration=2000, audio_file=Path("ramp.pcm"), source=source
+    )
+    player.reader.start(0)
+    yield player
+    player.close()
+
+
+def test_stream_on_schedule_is_not_resampled(stream: StreamingAudioPlayer):
+    """A stream which is where the reference expects passes blocks through unchanged."""
+    frequency, _, _ = stream.format
+    stream.reference = lambda monotonic_time: 0.0
+    block = stream.next_block()
+    assert block is not None
+    assert len(block) == round(stream.block_ms * frequency / 1000) * stream.frame_bytes
+    assert stream.stats.last_ratio == 1
+
+
+@pytest.mark.parametrize("error_ms", [100.0, -100.0])
+def test_stream_slews_towards_the_reference(
+    stream: StreamingAudioPlayer, error_ms: float
+):
+    """A stream behind or ahead of the reference consumes more or less than it plays."""
+    frequency, _, _ = stream.format
+    if error_ms < 0:
+        # start ahead of the reference by seeking the reader past it
+        stream.reader.seek(round(-error_ms * frequency / 1000))
+        stream._position = round(-error_ms * frequency / 1000)
+    stream.reference = lambda monotonic_time: max(error_ms, 0.0)
+    block_frames = round(stream.block_ms * frequency / 1000)
+    position = stream._position
+    block = stream.next_block()
+    assert block is not None
+    direction = 1 if error_ms > 0 else -1
+    assert stream.stats.last_ratio == pytest.approx(1 + direction * stream.max_slew)
+    consumed = stream._position - position
+    assert consumed == round(block_frames * stream.stats.last_ratio)
+    assert abs(len(block) // stream.frame_bytes - block_frames) <= 1
+    assert stream.stats.seeks == 0
+
+
+def test_stream_seeks_past_large_errors(stream: StreamingAudioPlayer):
+    """An error beyond `max_error_ms` is corrected at once by seeking."""
+    frequency, _, _ = stream.format
+    stream.reference = lambda monotonic_time: 1000.0
+    block = stream.next_block()
+    assert block is not None
+    assert stream.stats.seeks == 1
+    assert stream.stats.last_error_ms == 0
+    # the block starts at the expected position in the ramp
+    (first,) = struct.unpack("<h", block[:2])
+    assert first == frequency % 32768 - 16384
+
+
+def test_the_gain_follows_the_stream_to_a_spare_channel(stream: StreamingAudioPlayer):
+    """Restarting while the old channel still plays moves to a spare one at the same gain."""
+    stream.set_gain(0.25)
+    tail, tail_sound = stream.channel, pygame.mixer.Sound(buffer=bytes(4096))
+    tail.play(tail_sound)
+    stream.play_at(monotonic_ms() + 40)
+    try:
+        assert stream.channel is not tail
+        assert stream.channel.get_volume() == pytest.approx(0.25, abs=1 / 128)
+    finally:
+        stream.stop()
+        tail.stop()
+
+
+def test_a_late_stream_starts_without_a_preroll(stream: StreamingAudioPlayer):
+    """A start already due plays straight away rather than behind an empty pre-roll."""
+    stream.play_at(monotonic_ms() - 10)
+    try:
+        for _ in range(100):
+            if stream.channel.get_busy():
+                break
+            threading.Event().wait(0.01)
+        assert stream.channel.get_busy()
+    finally:
+        stream.stop()
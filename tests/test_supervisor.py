@@ -0,0 +1,64 @@
+"""Tests for the supervisor's recovery from offline playback."""
+
+from collections.abc import Callable
+
+import pytest
+
+from ak_rpi.client import RegistrationData
+from ak_rpi.errors import NoRegistrationPossibleError
+from ak_rpi.ntp import NTP, ClockSample, SyncTransport
+from ak_rpi.player import PlayerSettings
+from ak_rpi.supervisor import Supervisor
+
+
+class BrokenOnceTransport(SyncTransport):
+    """Raises on the first exchange, as a bug in the sync path would, then works."""
+
+    n_exchanges: int = 0
+
+    def exchange(self, clock: Callable[[], float]):
+        """Raise once, then measure a fixed offset."""
+        self.n_exchanges += 1
+        if self.n_exchanges == 1:
+            raise RuntimeError
+        return ClockSample(local_time=clock(), offset=100.0, rtt=2.0)
+
+
+def test_recovery_retries_through_any_failure(
+    monkeypatch: pytest.MonkeyPatch,
+    make_settings: Callable[..., PlayerSettings],
+):
+    """Unexpected errors while registering or syncing are retried, then handed off."""
+    player = make_settings()
+    player.ntp = NTP(client=player.client, transport=BrokenOnceTransport())
+    failures = [ValueError("bad config"), KeyError("id")]
+
+    def from_config(prefer_snapshot: bool = True):
+        if failures:
+            raise failures.pop(0)
+        return player
+
+    monkeypatch.setattr(RegistrationData, "FromConfig", from_config)
+    supervisor = Supervisor(retry_base_s=0.001, retry_max_s=0.002)
+    supervisor._recover()
+    [(_, _, handle)] = supervisor.scheduler._queue
+    assert handle.callback == supervisor.handoff
+    recovered, attempts, _, converged = handle.args
+    assert recovered is player
+    assert attempts == 3
+    assert converged
+
+
+def test_recovery_gives_up_without_a_registration(monkeypatch: pytest.MonkeyPatch):
+    """A player which can never be registered stays offline without retrying."""
+    calls: list[bool] = []
+
+    def from_config(prefer_snapshot: bool = True):
+        calls.append(prefer_snapshot)
+        raise NoRegistrationPossibleError()
+
+    monkeypatch.setattr(RegistrationData, "FromConfig", from_config)
+    supervisor = Supervisor(retry_base_s=0.001)
+    supervisor._recover()
+    assert calls == [False]
+    assert not supervisor.scheduler._queue
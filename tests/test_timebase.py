@@ -0,0 +1,55 @@
+"""Tests for the monotonic timebase and the deadline waiter."""
+
+import threading
+
+from ak_rpi.ntp import ServerClock
+from ak_rpi.timebase import (
+    NS_PER_MS,
+    monotonic_ms,
+    monotonic_ns,
+    wait_until_ms,
+    wait_until_ns,
+    wall_ms,
+    wall_ns,
+)
+
+
+def test_ms_readings_come_from_the_ns_clocks():
+    """The ms readings are the ns readings scaled, not a separate clock."""
+    before = monotonic_ns()
+    now = monotonic_ms()
+    after = monotonic_ns()
+    assert before / NS_PER_MS <= now <= after / NS_PER_MS
+    before = wall_ns()
+    now = wall_ms()
+    after = wall_ns()
+    assert before / NS_PER_MS <= now <= after / NS_PER_MS
+
+
+def test_waits_are_never_early():
+    """A wait returns at or after its deadline, in ns or in ms."""
+    deadline_ns = monotonic_ns() + 2 * NS_PER_MS
+    assert wait_until_ns(deadline_ns)
+    assert monotonic_ns() >= deadline_ns
+    deadline_ms = monotonic_ms() + 2.5
+    assert wait_until_ms(deadline_ms, spin_ns=0)
+    assert monotonic_ms() >= deadline_ms
+
+
+def test_a_wakeup_interrupts_the_wait():
+    """Setting the wakeup ends the sleep early and reports the deadline as missed."""
+    wakeup = threading.Event()
+    wakeup.set()
+    deadline_ns = monotonic_ns() + 1000 * NS_PER_MS
+    assert not wait_until_ns(deadline_ns, wakeup=wakeup)
+    assert monotonic_ns() < deadline_ns
+
+
+def test_local_time_keeps_sub_millisecond_anchors():
+    """Startup anchors off whole ms are kept exactly rather than truncated."""
+    clock = ServerClock(
+        startup_time_ns=1_700_000_000_000_250_000, startup_time_monotonic_ns=750_000
+    )
+    assert clock.startup_offset_ms == 1_699_999_999_999.5
+    assert clock.local_from_monotonic(10.25) == 1_700_000_000_009.75
+    assert clock.monotonic_from_server_time(1_700_000_000_009.75) == 10.25
@@ -0,0 +1,100 @@
+"""Tests for the UDP sync protocol, its fallback and the HTTP transport it replaces."""
+
+import socket
+from collections.abc import Callable, Iterator
+
+import httpx
+import pytest
+
+from ak_rpi.client import Client
+from ak_rpi.ntp import ClockSample, HTTPSyncTransport, SyncTransport
+from ak_rpi.udp_sync import SyncServer, UDPSyncTransport, benchmark
+
+
+class FixedTransport(SyncTransport):
+    """Answers every exchange with the same sample."""
+
+    calls: int = 0
+
+    def exchange(self, clock: Callable[[], float]):
+        """Return a fixed sample at the local time."""
+        self.calls += 1
+        return ClockSample(local_time=clock(), offset=42.0, rtt=1.0)
+
+
+@pytest.fixture
+def silent_port() -> Iterator[int]:
+    """Bind a UDP port which never answers."""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(("127.0.0.1", 0))
+    yield sock.getsockname()[1]
+    sock.close()
+
+
+def test_sync_transport_is_abstract():
+    """A transport must implement the exchange."""
+    with pytest.raises(TypeError):
+        SyncTransport()  # type: ignore[abstract]
+
+
+def test_udp_exchange_measures_the_server_offset():
+    """A loopback exchange recovers the server's offset to well under a millisecond."""
+    server = SyncServer(host="127.0.0.1", port=0, offset_ms=5000, clock=lambda: 0.0)
+    _, port = server.start()
+    transport = UDPSyncTransport(host="127.0.0.1", port=port)
+    try:
+        sample = transport.exchange(lambda: 1000.0)
+        assert sample is not None
+        assert sample.offset == pytest.approx(4000)
+        assert sample.rtt == pytest.approx(0)
+    finally:
+        transport.close()
+        server.stop()
+
+
+def test_repeated_timeouts_fall_back(silent_port: int):
+    """After `fallback_after` unanswered requests, exchanges use the fallback."""
+    fallback = FixedTransport()
+    transport = UDPSyncTransport(
+        host="127.0.0.1",
+        port=silent_port,
+        timeout_s=0.01,
+        fallback=fallback,
+        fallback_after=2,
+    )
+    try:
+        assert transport.exchange(lambda: 0.0) is None
+        assert not transport.falling_back
+        assert transport.exchange(lambda: 0.0) is None
+        assert transport.falling_back
+        sample = transport.exchange(lambda: 7.0)
+        assert sample is not None
+        assert (sample.local_time, sample.offset) == (7.0, 42.0)
+        assert fallback.calls == 1
+    finally:
+        transport.close()
+
+
+def test_http_exchange_compensates_for_truncation(make_client: Callable[..., Client]):
+    """The server's truncated timestamps are shifted by `server_truncation_ms`."""
+
+    def handler(request: httpx.Request):
+        return httpx.Response(200, json={"reqReceivedAt": 1000, "resSentAt": 1000})
+
+    client = make_client(handler)
+    offsets = []
+    for truncation_ms in (0.0, 0.5):
+        transport = HTTPSyncTransport(client=client, server_truncation_ms=truncation_ms)
+        sample = transport.exchange(lambda: 500.25)
+        assert sample is not None
+        offsets.append(sample.offset)
+    assert offsets == [499.75, 500.25]
+
+
+def test_udp_is_more_accurate_than_http():
+    """On an unloaded loopback both transports work and UDP's samples are tighter."""
+    results = {result.transport: result for result in benchmark(n_samples=30)}
+    assert set(results) == {"http", "udp"}
+    assert results["udp"].n_samples == 30
+    assert results["udp"].median_error_ms < 1
+    assert results["udp"].median_error_ms <= results["http"].median_error_ms